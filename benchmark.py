@@ -0,0 +1,192 @@
+from jaipur import Jaipur
+from jaipur_players import RandomPlayer, MinimaxPlayer, AlphaBetaPlayer, forecast_move
+from jaipur_players import custom_score_1, custom_score_2, custom_score_3
+from tournament import play_game
+from jaipur_batch import BatchJaipur, rollout_policy
+import argparse
+import json
+import random
+import timeit
+
+# Benchmarks of the engine and search hot paths over a fixed corpus of seeded positions
+# Results are operations per second, higher is better
+# Rates depend on the machine, so no baseline is kept in the repository, checking for regressions is opt-in:
+#   python benchmark.py --save-baseline benchmark_baseline.json    on the commit to compare against
+#   python benchmark.py --compare benchmark_baseline.json          on the change, exits with 1 on a regression
+
+# Usual name of a baseline file
+BASELINE_FILE = 'benchmark_baseline.json'
+
+# Seeds of the corpus games and the stages each one is sampled at
+CORPUS_SEEDS = range(8)
+STAGES = ('opening', 'midgame', 'endgame')
+
+# Play a seeded game with random moves until the stage is reached
+def corpus_position(seed, stage):
+    random.seed(seed)
+    game = Jaipur(RandomPlayer('Player1'), RandomPlayer('Player2'))
+    game.initial_setup()
+
+    rng = random.Random(seed)
+    while game.has_legal_moves():
+        deck_left = len(game.deck)
+        if stage == 'opening' or (stage == 'midgame' and deck_left <= 25) or deck_left <= 5:
+            break
+        game.apply_move(rng.choice(list(game.iter_legal_moves())))
+    return game
+
+def corpus(seeds=CORPUS_SEEDS):
+    return [corpus_position(seed, stage) for seed in seeds for stage in STAGES]
+
+# Count the calls made to a method of a class while the block runs
+class count_calls:
+    def __init__(self, cls, name):
+        self.cls = cls
+        self.name = name
+        self.count = 0
+
+    def __enter__(self):
+        original = getattr(self.cls, self.name)
+        self.original = original
+
+        def counted(*args, **kwargs):
+            self.count += 1
+            return original(*args, **kwargs)
+
+        setattr(self.cls, self.name, counted)
+        return self
+
+    def __exit__(self, *exc):
+        setattr(self.cls, self.name, self.original)
+
+# Best time of a few repeats, returned as operations per second
+def rate(fn, ops, repeat):
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    return {'ops': ops, 'seconds': best, 'per_second': ops / best}
+
+def bench_legal_moves(positions, repeat):
+    def run():
+        for game in positions:
+            game.clear_move_cache()
+            game.get_legal_moves()
+    return rate(run, len(positions), repeat)
+
+def bench_board_copy(positions, repeat):
+    return rate(lambda: [game.board_copy() for game in positions], len(positions), repeat)
+
+def bench_snapshot(positions, repeat):
+    return rate(lambda: [game.snapshot() for game in positions], len(positions), repeat)
+
+def bench_forecast_move(positions, repeat):
+    moves = [(game, move) for game in positions for move in game.iter_legal_moves()]
+    return rate(lambda: [forecast_move(game, move) for game, move in moves], len(moves), repeat)
+
+# Each move is undone straight away so the corpus is unchanged between repeats
+def bench_apply_move(positions, repeat):
+    moves = [(game, move) for game in positions for move in game.iter_legal_moves()]
+
+    def run():
+        for game, move in moves:
+            game.apply_move(move)
+            game.undo_move()
+    return rate(run, len(moves), repeat)
+
+def bench_score(score_fn, positions, repeat):
+    player = RandomPlayer('Player1')
+
+    def run():
+        for game in positions:
+            game.clear_move_cache()
+            score_fn(game, player)
+    return rate(run, len(positions), repeat)
+
+# Nodes are counted as moves applied during a fixed depth search
+def bench_search(make_player, search, positions, depth, repeat):
+    player = make_player()
+    player.name = 'Player1'
+    player.time_left = lambda: float('inf')
+
+    with count_calls(Jaipur, 'apply_move') as calls:
+        for game in positions:
+            search(player, game, depth)
+    nodes = calls.count
+
+    def run():
+        for game in positions:
+            search(player, game, depth)
+    return rate(run, nodes, repeat)
+
+def bench_random_games(games, repeat):
+    players = (RandomPlayer('Player1'), RandomPlayer('Player2'))
+    return rate(lambda: [play_game(*players, seed=seed) for seed in range(games)], games, repeat)
+
+# Rollout policy games played in lockstep, dealing included
+# The policy leaves out most exchanges, so these games aren't comparable with random_games
+def bench_batch_rollouts(games, repeat):
+    return rate(lambda: BatchJaipur(range(games)).play(rollout_policy, rollout_policy, record=False), games, repeat)
+
+def run_benchmarks(seeds=CORPUS_SEEDS, repeat=3, depth=2, games=10):
+    positions = corpus(seeds)
+    search_positions = [game for game in positions if game.has_legal_moves()][:len(STAGES) * 2]
+
+    results = {
+        'get_legal_moves': bench_legal_moves(positions, repeat),
+        'board_copy': bench_board_copy(positions, repeat),
+        'snapshot': bench_snapshot(positions, repeat),
+        'forecast_move': bench_forecast_move(positions, repeat),
+        'apply_move': bench_apply_move(positions, repeat),
+    }
+    for score_fn in (custom_score_1, custom_score_2, custom_score_3):
+        results[score_fn.__name__] = bench_score(score_fn, positions, repeat)
+
+    results['minimax_nodes'] = bench_search(lambda: MinimaxPlayer(score_fn=custom_score_2),
+                                            lambda player, game, d: player.minimax(game, d),
+                                            search_positions, depth, repeat)
+    # The transposition table is left out so every repeat searches the same tree
+    results['alphabeta_nodes'] = bench_search(lambda: AlphaBetaPlayer(score_fn=custom_score_2, tt_mb=None),
+                                              lambda player, game, d: player.alphabeta(game, d),
+                                              search_positions, depth + 1, repeat)
+    results['random_games'] = bench_random_games(games, repeat)
+    results['batch_rollouts'] = bench_batch_rollouts(100 * games, repeat)
+    return results
+
+# Benchmarks whose rate fell by more than the threshold fraction of the baseline
+def compare(results, baseline, threshold=0.1):
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result['per_second'] / baseline[name]['per_second'] - 1
+        if change < -threshold:
+            regressions[name] = change
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Jaipur engine and search players.")
+    parser.add_argument('--output', default=None, help="write the results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE', default=None,
+                        help="compare against these JSON results, e.g. {}, and fail on a regression".format(BASELINE_FILE))
+    parser.add_argument('--save-baseline', metavar='BASELINE', default=None,
+                        help="store these results as a baseline to compare against later")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown fraction counted as a regression")
+    parser.add_argument('--repeat', type=int, default=3, help="repeats per benchmark, the best is kept")
+    args = parser.parse_args()
+
+    results = run_benchmarks(repeat=args.repeat)
+    for name, result in results.items():
+        print('{:<18}{:>14,.0f} /s'.format(name, result['per_second']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, change in regressions.items():
+            print('Regression in {}: {:.1%}'.format(name, change))
+        if regressions:
+            raise SystemExit(1)
@@ -1,10 +1,7 @@
 import random
-import copy
-from collections import Counter
-from itertools import combinations
 import timeit
+from array import array
 # from jaipur_players import *
-import pandas as pd
 
 cards = {
     'Diamond': 6,
@@ -16,25 +13,252 @@ cards = {
     'Camel': 8 # 11 total camels but 3 are in the initial setup
 }
 
+# Goods are stored as small integers indexing into GOODS, camels last
+GOODS = tuple(cards)
+GOOD_INDEX = {good: i for i, good in enumerate(GOODS)}
+CAMEL = GOOD_INDEX['Camel']
+NUM_GOODS = CAMEL # Tradeable goods, camels excluded
+NUM_CARDS = len(GOODS)
+JEWELS = (GOOD_INDEX['Diamond'], GOOD_INDEX['Gold'], GOOD_INDEX['Silver'])
+# Jewels sell in twos or more
+MIN_SELL = tuple(2 if g in JEWELS else 1 for g in range(NUM_GOODS))
+
+# Fixed token piles, the game only tracks how many have been taken from each
+GOODS_TOKENS = (
+    (7,7,5,5,5),
+    (6,6,5,5,5),
+    (5,5,5,5,5),
+    (5,3,3,2,2,1,1),
+    (5,3,3,2,2,1,1),
+    (4,3,2,1,1,1,1,1,1)
+)
+PILE_SIZES = tuple(len(pile) for pile in GOODS_TOKENS)
+BONUS_TOKENS = {
+    3: (1,1,2,2,2,3,3),
+    4: (4,4,5,5,6,6),
+    5: (8,8,9,10,10)
+}
+
+# Names of the values in Jaipur.features, from one player's side
+# Both players' hands and herds, the market, the goods tokens left in each pile and the next one's value,
+# the bonus tokens left in each pile, the deck size, the camel token (1 held, -1 held by the opponent),
+# both players' goods and bonus token scores, and whether the player is to move
+FEATURE_NAMES = (tuple('hand_' + GOODS[g] for g in range(NUM_GOODS)) + ('herd',)
+                 + tuple('opponent_hand_' + GOODS[g] for g in range(NUM_GOODS)) + ('opponent_herd',)
+                 + tuple('market_' + good for good in GOODS)
+                 + tuple('tokens_left_' + GOODS[g] for g in range(NUM_GOODS))
+                 + tuple('next_token_' + GOODS[g] for g in range(NUM_GOODS))
+                 + ('bonus_left_3', 'bonus_left_4', 'bonus_left_5', 'deck', 'camel_token',
+                    'goods_score', 'bonus_score', 'opponent_goods_score', 'opponent_bonus_score', 'to_move'))
+FEATURE_SIZE = len(FEATURE_NAMES)
+
+# Default order of the move kinds produced by iter_legal_moves
+MOVE_STAGES = ('Sell', 'Take', 'Camels', 'Exchange')
+
+# Columns of the move history, the move kind, the change in each card for the mover,
+# the change in both visible scores and whether player 1 moved
+HISTORY_COLUMNS = ('Camels', 'Take', 'Exchange', 'Sell',
+                   'Camel', 'Diamond', 'Gold', 'Silver', 'Cloth', 'Spice', 'Leather',
+                   'p1_delta', 'p2_delta', 'initiating_player')
+
+# Zobrist keys, a random 64 bit number for every value each part of the state can take
+_zobrist_rng = random.Random(0x4A41495055)
+def _zobrist_keys(*shape):
+    if len(shape) == 1:
+        return [_zobrist_rng.getrandbits(64) for _ in range(shape[0])]
+    return [_zobrist_keys(*shape[1:]) for _ in range(shape[0])]
+
+ZOBRIST_HAND = _zobrist_keys(2, NUM_GOODS, 12)
+ZOBRIST_HERD = _zobrist_keys(2, 12)
+ZOBRIST_MARKET = _zobrist_keys(NUM_CARDS, 12)
+ZOBRIST_GOODS_TOP = _zobrist_keys(NUM_GOODS, 10)
+ZOBRIST_BONUS_TOP = _zobrist_keys(3, 8)
+ZOBRIST_GOODS_SCORE = _zobrist_keys(2, 256)
+ZOBRIST_BONUS_SCORE = _zobrist_keys(2, 256)
+ZOBRIST_DECK_TOP = _zobrist_keys(53)
+ZOBRIST_CAMEL_TOKEN = _zobrist_keys(3)
+ZOBRIST_TURN = _zobrist_rng.getrandbits(64)
+ZOBRIST_MASK = (1 << 64) - 1
+
+# Bits of the containers a game still shares with a snapshot, see Jaipur.snapshot
+SHARED_MARKET = 1
+SHARED_DISCARD = 2
+SHARED_GOODS_TOP = 4
+SHARED_BONUS_TOP = 8
+SHARED_PLAYER = (16, 32)
+SHARED_ALL = 63
+
+# Expand a count vector into a list of card names
+def expand_counts(counts):
+    return [GOODS[g] for g in range(len(counts)) for _ in range(counts[g])]
+
+# Count card names into a vector of the given length
+def count_cards(names, size=NUM_CARDS):
+    counts = [0] * size
+    for name in names:
+        counts[GOOD_INDEX[name]] += 1
+    return counts
+
+# Every sub-multiset of a count vector with at most max_size cards, grouped by size
+# Each entry is (bit mask of the goods used, card names in GOODS order)
+def sub_multisets(counts, max_size):
+    by_size = [[] for _ in range(max_size + 1)]
+    partial = [(0, 0, ())]
+    for g in range(len(counts)):
+        if not counts[g]:
+            continue
+        extended = []
+        for size, mask, names in partial:
+            extended.append((size, mask, names))
+            for c in range(1, min(counts[g], max_size - size) + 1):
+                extended.append((size + c, mask | (1 << g), names + (GOODS[g],) * c))
+        partial = extended
+    for size, mask, names in partial:
+        by_size[size].append((mask, names))
+    return by_size
+
+# Cards and tokens held by one player
+class PlayerState:
+    __slots__ = ('hand', 'hand_size', 'herd', 'tokens', 'goods_score', 'bonus_score')
+
+    def __init__(self):
+        # Count of each good in the hand, camels live in the herd
+        self.hand = [0] * NUM_GOODS
+        self.hand_size = 0
+        self.herd = 0
+
+        # Goods tokens and bonus tokens, with their running totals
+        self.tokens = [[],[]]
+        self.goods_score = 0
+        self.bonus_score = 0
+
+    def copy(self):
+        other = PlayerState.__new__(PlayerState)
+        other.hand = self.hand[:]
+        other.hand_size = self.hand_size
+        other.herd = self.herd
+        other.tokens = [self.tokens[0][:], self.tokens[1][:]]
+        other.goods_score = self.goods_score
+        other.bonus_score = self.bonus_score
+        return other
+
+    def set_hand(self, names):
+        self.hand = count_cards(names, NUM_GOODS)
+        self.hand_size = sum(self.hand)
+
+# Hit and miss counts for the legal move cache, shared by a game and its copies
+class MoveCacheStats:
+    __slots__ = ('hits', 'misses')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+# Moves of a played game as one integer array per column of HISTORY_COLUMNS
+# The arrays start with room for a typical game and double when full, pandas is only imported by to_dataframe
+class MoveHistory:
+    __slots__ = ('columns', 'size')
+
+    CAPACITY = 64
+
+    def __init__(self):
+        self.columns = {name: array('i', bytes(array('i').itemsize * self.CAPACITY)) for name in HISTORY_COLUMNS}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    # Add a row for a move, camels is the number in the market before the move
+    def record(self, move, camels, player1_moved, p1_delta, p2_delta):
+        columns = self.columns
+        i = self.size
+        if i == len(columns['Camels']):
+            for column in columns.values():
+                column.extend(array('i', bytes(column.itemsize * len(column))))
+        self.size = i + 1
+
+        kind = move[0]
+        columns[kind][i] = 1
+        if kind == 'Camels':
+            columns['Camel'][i] = camels
+        elif kind == 'Take':
+            columns[move[1]][i] = 1
+        elif kind == 'Sell':
+            columns[move[1]][i] = -move[2]
+        else:
+            for card in move[1]:
+                columns[card][i] -= 1
+            for card in move[2]:
+                columns[card][i] += 1
+
+        columns['p1_delta'][i] = p1_delta
+        columns['p2_delta'][i] = p2_delta
+        columns['initiating_player'][i] = 1 if player1_moved else 0
+
+    # Values of one column, a row per move
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    # Rows as dictionaries keyed by column
+    def rows(self):
+        return [{name: self.columns[name][i] for name in HISTORY_COLUMNS} for i in range(self.size)]
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name).tolist() for name in HISTORY_COLUMNS}, columns=list(HISTORY_COLUMNS))
+
+# Name-keyed view over per-player state, mirroring the old dict attributes
+class _PlayerView:
+    __slots__ = ('_game', '_get', '_set')
+
+    def __init__(self, game, get, set=None):
+        self._game = game
+        self._get = get
+        self._set = set
+
+    def __getitem__(self, name):
+        return self._get(self._game._players[self._game._seat[name]])
+
+    def __setitem__(self, name, value):
+        if self._set is None:
+            raise TypeError("Player view is read only.")
+        seat = self._game._seat[name]
+        if self._game._shared:
+            self._game._own(SHARED_PLAYER[seat])
+        self._set(self._game._players[seat], value)
+        self._game._moves = None
+        self._game._zobrist = self._game.compute_zobrist()
+
+    def __iter__(self):
+        return iter((self._game.name1, self._game.name2))
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
 class Jaipur:
+    __slots__ = ('name1', 'name2', 'agents', '_names', '_seat', '_turn', '_players',
+                 '_deck', '_deck_top', '_market', '_market_size', '_discard',
+                 '_goods_top', '_depleted', '_bonus_piles', '_bonus_top', '_camel_token', '_history',
+                 '_moves', 'move_cache_stats', '_zobrist', '_shared')
+
     def __init__(self, player1, player2):
-        # Board objects
-        self.deck = []
-        self.market = []
-        self.discard_pile = []
-        self.goods_tokens = {
-            'Diamond': [7,7,5,5,5],
-            'Gold': [6,6,5,5,5],
-            'Silver': [5,5,5,5,5],
-            'Cloth': [5,3,3,2,2,1,1],
-            'Spice': [5,3,3,2,2,1,1],
-            'Leather': [4,3,2,1,1,1,1,1,1]
-        }
-        self.bonus_tokens = {
-            3: [1,1,2,2,2,3,3],
-            4: [4,4,5,5,6,6],
-            5: [8,8,9,10,10]
-        }
+        # Board objects, cards are stored as counts per good
+        # The deck is fixed once shuffled, cards are drawn by moving the top index down
+        self._deck = ()
+        self._deck_top = 0
+        self._market = [0] * NUM_CARDS
+        self._market_size = 0
+        self._discard = [0] * NUM_GOODS
+
+        # Token piles are fixed tuples, only the index of the next token changes
+        self._goods_top = [0] * NUM_GOODS
+        self._depleted = 0
+        self._bonus_piles = tuple(tuple(reversed(BONUS_TOKENS[k])) for k in (3, 4, 5))
+        self._bonus_top = [0, 0, 0]
 
         # Player objects
         self.name1 = player1.name
@@ -45,84 +269,305 @@ class Jaipur:
             self.name2: player2
         }
 
-        self.active_player = self.name1
-        self.inactive_player = self.name2
+        # Players are stored by seat, 0 for the first player and 1 for the second
+        self._names = (self.name1, self.name2)
+        self._seat = {self.name1: 0, self.name2: 1}
+        self._turn = 0
+        self._players = (PlayerState(), PlayerState())
 
-        # Store generic cards
-        self.hands = {
-            self.name1: [],
-            self.name2: []
-        }
+        # Seat holding the camel token
+        self._camel_token = None
 
-        # Store camels here
-        self.herds = {
-            self.name1: [],
-            self.name2: []
-        }
+        # Undo records for the moves made with apply_move
+        self._history = []
 
-        # Goods tokens and bonus tokens
-        self.tokens = {
-            self.name1: [[],[]],
-            self.name2: [[],[]]
-        }
+        # Legal moves of the current state as (seat, moves), cleared by every mutator
+        self._moves = None
+        self.move_cache_stats = MoveCacheStats()
+
+        # Zobrist hash of the state, updated by every mutator
+        self._zobrist = self.compute_zobrist()
+
+        # Containers shared with snapshots, copied by the mutators before they change them
+        self._shared = 0
+
+    @property
+    def player1(self):
+        return self.name1
+
+    @property
+    def player2(self):
+        return self.name2
+
+    @property
+    def active_player(self):
+        return self._names[self._turn]
+
+    @active_player.setter
+    def active_player(self, name):
+        self._set_turn(self._seat[name])
+
+    @property
+    def inactive_player(self):
+        return self._names[1 - self._turn]
+
+    @inactive_player.setter
+    def inactive_player(self, name):
+        self._set_turn(1 - self._seat[name])
+
+    def _set_turn(self, turn):
+        if turn != self._turn:
+            self._zobrist ^= ZOBRIST_TURN
+            self._turn = turn
+
+    @property
+    def zobrist_hash(self):
+        return self._zobrist
+
+    @property
+    def camel_token(self):
+        return None if self._camel_token is None else self._names[self._camel_token]
+
+    # Card and token containers as lists of names, for display and tests
+    @property
+    def deck(self):
+        return [GOODS[g] for g in self._deck[:self._deck_top]]
+
+    @property
+    def market(self):
+        return expand_counts(self._market)
+
+    @market.setter
+    def market(self, names):
+        self._moves = None
+        self._market = count_cards(names)
+        self._shared &= ~SHARED_MARKET
+        self._market_size = len(names)
+        self._zobrist = self.compute_zobrist()
+
+    @property
+    def discard_pile(self):
+        return expand_counts(self._discard)
+
+    @property
+    def goods_tokens(self):
+        return {GOODS[g]: list(GOODS_TOKENS[g][self._goods_top[g]:]) for g in range(NUM_GOODS)}
+
+    @property
+    def bonus_tokens(self):
+        return {k: list(reversed(self._bonus_piles[k - 3][self._bonus_top[k - 3]:])) for k in (3, 4, 5)}
+
+    @property
+    def hands(self):
+        return _PlayerView(self, lambda p: expand_counts(p.hand), PlayerState.set_hand)
+
+    @property
+    def herds(self):
+        def set_herd(p, names):
+            p.herd = len(names)
+        return _PlayerView(self, lambda p: ['Camel'] * p.herd, set_herd)
 
-        self.camel_token = None
+    @property
+    def tokens(self):
+        return _PlayerView(self, lambda p: [p.tokens[0][:], p.tokens[1][:]])
 
     # Determine which player has the most camels
     def camel_token_allocate(self):
-        if len(self.herds[self.name1]) > len(self.herds[self.name2]):
-            self.camel_token = self.name1
-        elif len(self.herds[self.name2]) > len(self.herds[self.name1]):
-            self.camel_token = self.name2
+        herd1 = self._players[0].herd
+        herd2 = self._players[1].herd
+        if herd1 > herd2:
+            camel_token = 0
+        elif herd2 > herd1:
+            camel_token = 1
         else:
-            self.camel_token = None
+            camel_token = None
+
+        if camel_token != self._camel_token:
+            self._zobrist ^= ZOBRIST_CAMEL_TOKEN[2 if self._camel_token is None else self._camel_token]
+            self._zobrist ^= ZOBRIST_CAMEL_TOKEN[2 if camel_token is None else camel_token]
+            self._camel_token = camel_token
+
+    # Hash the whole state from scratch, the deck and bonus piles salt it per game
+    def compute_zobrist(self):
+        h = hash((self._deck, self._bonus_piles)) & ZOBRIST_MASK
+        for seat, p in enumerate(self._players):
+            for g in range(NUM_GOODS):
+                h ^= ZOBRIST_HAND[seat][g][p.hand[g]]
+            h ^= ZOBRIST_HERD[seat][p.herd]
+
+            h ^= ZOBRIST_GOODS_SCORE[seat][p.goods_score]
+            h ^= ZOBRIST_BONUS_SCORE[seat][p.bonus_score]
+
+        for g in range(NUM_CARDS):
+            h ^= ZOBRIST_MARKET[g][self._market[g]]
+        for g in range(NUM_GOODS):
+            h ^= ZOBRIST_GOODS_TOP[g][self._goods_top[g]]
+        for b in range(3):
+            h ^= ZOBRIST_BONUS_TOP[b][self._bonus_top[b]]
+
+        h ^= ZOBRIST_DECK_TOP[self._deck_top]
+        h ^= ZOBRIST_CAMEL_TOKEN[2 if self._camel_token is None else self._camel_token]
+        if self._turn:
+            h ^= ZOBRIST_TURN
+        return h
 
     # Initial board set up of players, market
     def initial_setup(self):
-
         # Shuffle the deck
+        deck = []
         for k, v in cards.items():
-            self.deck += [k] * cards[k]
-        random.shuffle(self.deck)
+            deck += [GOOD_INDEX[k]] * v
+        random.shuffle(deck)
+
+        # Shuffle bonus tokens, stored reversed so the next token is at the front
+        piles = []
+        for k in (3, 4, 5):
+            pile = list(BONUS_TOKENS[k])
+            random.shuffle(pile)
+            piles.append(tuple(reversed(pile)))
+
+        self.deal(tuple(deck), tuple(piles))
+
+    # Deal from a deck drawn from its end and bonus piles with the next token first, as deal_order returns them
+    # Everything from an earlier game is reset, so a game can be dealt and played again
+    def deal(self, deck, bonus_piles):
+        self._players = (PlayerState(), PlayerState())
+        self._turn = 0
+        self._discard = [0] * NUM_GOODS
+        self._goods_top = [0] * NUM_GOODS
+        self._depleted = 0
+        self._camel_token = None
+        self._history = []
+        self._moves = None
+        self._shared = 0
+        self._deck = deck
+        self._deck_top = len(deck)
 
         # Get 3 camels and 2 cards into the market
-        self.market = ['Camel' for _ in range(3)]
+        self._market = [0] * NUM_CARDS
+        self._market[CAMEL] = 3
         for _ in range(2):
-            self.market.append(self.draw())
-
-        # Add cards to player hands
-        self.hands[self.name1] = [self.draw() for _ in range(5)]
-        self.hands[self.name2] = [self.draw() for _ in range(5)]
-
-        # Add camels from the player hands to the herds
-        # Check change herds before changing the player hands otherwise camels get deleted
-        self.herds[self.name1] = [card for card in self.hands[self.name1] if card == 'Camel']
-        self.herds[self.name2] = [card for card in self.hands[self.name2] if card == 'Camel']
-        self.hands[self.name1] = [card for card in self.hands[self.name1] if card != 'Camel']
-        self.hands[self.name2] = [card for card in self.hands[self.name2] if card != 'Camel']
-
-        # Shuffle bonus tokens
-        for k in self.bonus_tokens:
-            random.shuffle(self.bonus_tokens[k])
+            self._market[self.draw()] += 1
+        self._market_size = 5
+
+        # Add cards to player hands, camels go straight to the herds
+        for p in self._players:
+            for _ in range(5):
+                card = self.draw()
+                if card == CAMEL:
+                    p.herd += 1
+                else:
+                    p.hand[card] += 1
+                    p.hand_size += 1
+
+        self._bonus_piles = bonus_piles
+        self._bonus_top = [0, 0, 0]
+        self._zobrist = self.compute_zobrist()
+
+    # The deck and bonus piles the game was dealt, deal on a new game starts it the same way
+    def deal_order(self):
+        return self._deck, self._bonus_piles
+
+    # Moves made with apply_move and not undone, oldest first
+    def moves_played(self):
+        return [record[0] for record in self._history]
+
+    # Copy of the game as the player might imagine it, with the cards it can't see dealt again at random
+    # The other player's hand and the deck are redrawn from the unseen cards, camels only go to the deck,
+    # and the bonus tokens left in each pile are shuffled
+    def determinize(self, player=None, rng=random):
+        seat = self._player_seat(player)
+        game = self.board_copy()
+        other = game._players[1 - seat]
+
+        deck = self._deck[:self._deck_top]
+        unseen = [g for g in range(NUM_GOODS) for _ in range(other.hand[g])] + [g for g in deck if g != CAMEL]
+        rng.shuffle(unseen)
+        hand = unseen[:other.hand_size]
+        deck = unseen[other.hand_size:] + [CAMEL] * deck.count(CAMEL)
+        rng.shuffle(deck)
+
+        other.hand = [0] * NUM_GOODS
+        for g in hand:
+            other.hand[g] += 1
+        game._deck = tuple(deck)
+
+        piles = []
+        for pile, top in zip(self._bonus_piles, self._bonus_top):
+            rest = list(pile[top:])
+            rng.shuffle(rest)
+            piles.append(pile[:top] + tuple(rest))
+        game._bonus_piles = tuple(piles)
+
+        game._moves = None
+        game._zobrist = game.compute_zobrist()
+        return game
+
+    # The game with every field shared, for board_copy and snapshot to fill in
+    def _shallow_copy(self):
+        new_board = Jaipur.__new__(Jaipur)
+        new_board.name1 = self.name1
+        new_board.name2 = self.name2
+        new_board.agents = self.agents
+        new_board._names = self._names
+        new_board._seat = self._seat
+        new_board._turn = self._turn
+        new_board._players = self._players
+
+        new_board._deck = self._deck
+        new_board._deck_top = self._deck_top
+        new_board._market = self._market
+        new_board._market_size = self._market_size
+        new_board._discard = self._discard
+
+        # Token piles are immutable and shared between copies
+        new_board._goods_top = self._goods_top
+        new_board._depleted = self._depleted
+        new_board._bonus_piles = self._bonus_piles
+        new_board._bonus_top = self._bonus_top
+        new_board._camel_token = self._camel_token
+        new_board._history = []
+        new_board._moves = self._moves
+        new_board.move_cache_stats = self.move_cache_stats
+        new_board._zobrist = self._zobrist
+        return new_board
 
     # Create copy of game for move forecasting
     def board_copy(self):
-        new_board = Jaipur(self.agents[self.name1], self.agents[self.name2])
-        new_board.deck = self.deck
-        new_board.market = self.market
-        new_board.discard_pile = self.discard_pile
-
-        new_board.active_player = self.active_player
-        new_board.inactive_player = self.inactive_player
-
-        new_board.goods_tokens = self.goods_tokens
-        new_board.bonus_tokens = self.bonus_tokens
-
-        new_board.hands = self.hands
-        new_board.herds = self.herds
-        new_board.tokens = self.tokens
-
-        return copy.deepcopy(new_board)
+        new_board = self._shallow_copy()
+        new_board._players = (self._players[0].copy(), self._players[1].copy())
+        new_board._market = self._market[:]
+        new_board._discard = self._discard[:]
+        new_board._goods_top = self._goods_top[:]
+        new_board._bonus_top = self._bonus_top[:]
+        new_board._shared = 0
+        return new_board
+
+    # Copy-on-write copy of the game, sharing the card and token containers with it
+    # Both games mark them shared and each copies a container before its first change to it,
+    # so a snapshot that is only read costs no copies, and changes to either game never reach the other
+    def snapshot(self):
+        new_board = self._shallow_copy()
+        new_board._shared = self._shared = SHARED_ALL
+        return new_board
+
+    # Take private copies of the shared containers in the mask
+    def _own(self, mask):
+        mask &= self._shared
+        if not mask:
+            return
+        self._shared ^= mask
+        if mask & SHARED_MARKET:
+            self._market = self._market[:]
+        if mask & SHARED_DISCARD:
+            self._discard = self._discard[:]
+        if mask & SHARED_GOODS_TOP:
+            self._goods_top = self._goods_top[:]
+        if mask & SHARED_BONUS_TOP:
+            self._bonus_top = self._bonus_top[:]
+        if mask & (SHARED_PLAYER[0] | SHARED_PLAYER[1]):
+            self._players = tuple(p.copy() if mask & SHARED_PLAYER[seat] else p
+                                  for seat, p in enumerate(self._players))
 
     @property
     # Return the active player
@@ -136,154 +581,392 @@ class Jaipur:
 
     # Draw a card from the deck
     def draw(self):
-        return self.deck.pop()
+        if not self._deck_top:
+            raise IndexError("draw from an empty deck")
+        self._deck_top -= 1
+        return self._deck[self._deck_top]
 
     # Shuffle the deck if required
     def shuffle(self):
-        random.shuffle(self.deck)
+        remaining = list(self._deck[:self._deck_top])
+        random.shuffle(remaining)
+        self._deck = tuple(remaining) + self._deck[self._deck_top:]
+        self._zobrist = self.compute_zobrist()
 
     # Fill any missing cards from the market
-    def replenish_board(self):     
-        try:
-            while len(self.market) < 5:
-                self.market.append(self.draw())
-        except IndexError:
-            # print("No more cards in the deck.")
-            pass
+    def replenish_board(self):
+        self._moves = None
+        draws = min(5 - self._market_size, self._deck_top)
+        if draws > 0:
+            if self._shared:
+                self._own(SHARED_MARKET)
+            market = self._market
+            top = self._deck_top - draws
+            h = self._zobrist ^ ZOBRIST_DECK_TOP[self._deck_top] ^ ZOBRIST_DECK_TOP[top]
+            for g in self._deck[top:self._deck_top]:
+                h ^= ZOBRIST_MARKET[g][market[g]] ^ ZOBRIST_MARKET[g][market[g] + 1]
+                market[g] += 1
+            self._zobrist = h
+            self._deck_top = top
+            self._market_size += draws
+
+    # Count of each card left in the deck
+    def deck_counts(self):
+        counts = [0] * NUM_CARDS
+        for g in self._deck[:self._deck_top]:
+            counts[g] += 1
+        return counts
+
+    # Number of cards the move draws from the deck to refill the market
+    def draws_for(self, move):
+        if move[0] == 'Take':
+            return min(1, self._deck_top)
+        if move[0] == 'Camels':
+            return min(self._market[CAMEL], self._deck_top)
+        return 0
+
+    # Reorder the rest of the deck so the goods given are the next cards drawn, in that order
+    # Returns the old deck for restore_deck, moves drawing the stacked cards must be undone first
+    # The order of the deck isn't part of the Zobrist hash kept up to date, so the hash stays as it was
+    def stack_deck(self, goods):
+        old = self._deck
+        top = self._deck_top
+        deck = list(old[:top])
+        for i, g in enumerate(goods):
+            j = deck.index(g, 0, top - i)
+            deck[j], deck[top - 1 - i] = deck[top - 1 - i], deck[j]
+        self._deck = tuple(deck) + old[top:]
+        return old
+
+    def restore_deck(self, deck):
+        self._deck = deck
+
+    # Number of goods tokens piles that have been emptied, counted as they run out
+    def depleted_piles(self):
+        return self._depleted
+
+    # The game ends once the deck runs out or three goods piles are gone
+    # Both counts are kept by the mutators and undo_move, so this is cheap enough for every search node
+    @property
+    def is_terminal(self):
+        return not self._deck_top or self._depleted >= 3
+
+    def game_over(self):
+        return self.is_terminal
+
+    # Seat of the named player, defaulting to the active player
+    def _player_seat(self, player):
+        return self._turn if not player else self._seat[player]
 
     # Return the score of the players good's tokens
     def visible_score(self, player=None):
-        if not player:
-            player = self.active_player
+        seat = self._player_seat(player)
 
-        bonus_camel = 5 if self.camel_token == player else 0
-        return sum(self.tokens[player][0]) + bonus_camel
+        bonus_camel = 5 if self._camel_token == seat else 0
+        return self._players[seat].goods_score + bonus_camel
 
     # Return the total score of the player including hidden bonus tokens
     def total_score(self, player=None):
-        if not player:
-            player = self.active_player
-
-        bonus_camel = 5 if self.camel_token == player else 0
-        return sum(self.tokens[player][0]) + sum(self.tokens[player][1]) + bonus_camel
+        seat = self._player_seat(player)
+        p = self._players[seat]
+
+        bonus_camel = 5 if self._camel_token == seat else 0
+        return p.goods_score + p.bonus_score + bonus_camel
+
+    # The state from the player's side as FEATURE_SIZE small integers, named by FEATURE_NAMES
+    def features(self, player=None):
+        seat = self._player_seat(player)
+        me, other = self._players[seat], self._players[1 - seat]
+        top = self._goods_top
+        camel = 0 if self._camel_token is None else 1 if self._camel_token == seat else -1
+        return (me.hand + [me.herd] + other.hand + [other.herd] + self._market
+                + [PILE_SIZES[g] - top[g] for g in range(NUM_GOODS)]
+                + [GOODS_TOKENS[g][top[g]] if top[g] < PILE_SIZES[g] else 0 for g in range(NUM_GOODS)]
+                + [len(pile) - t for pile, t in zip(self._bonus_piles, self._bonus_top)]
+                + [self._deck_top, camel, me.goods_score, me.bonus_score, other.goods_score, other.bonus_score,
+                   1 if seat == self._turn else 0])
+
+    # Change in the player's visible score from each legal move of the active player, as (move, delta)
+    # pairs in iter_legal_moves order, worked out from the token piles and herds without making the moves
+    # Bonus tokens are hidden, so a sell gains its goods tokens and any move can shift the camel token
+    def move_score_deltas(self, player=None):
+        seat = self._player_seat(player)
+        turn = self._turn
+        herds = [self._players[0].herd, self._players[1].herd]
+        had_camel = 5 if self._camel_token == seat else 0
+
+        # Camel token change once the mover's herd grows by the given number of camels
+        def camel_delta(change):
+            herd, other = herds[turn] + change, herds[1 - turn]
+            holder = None if herd == other else turn if herd > other else 1 - turn
+            return (5 if holder == seat else 0) - had_camel
+
+        unchanged = camel_delta(0)
+        deltas = []
+        for move in self.iter_legal_moves():
+            kind = move[0]
+            if kind == 'Sell':
+                gain = 0
+                if seat == turn:
+                    g = GOOD_INDEX[move[1]]
+                    top = self._goods_top[g]
+                    gain = sum(GOODS_TOKENS[g][top:top + move[2]])
+                deltas.append((move, gain + unchanged))
+            elif kind == 'Take':
+                deltas.append((move, camel_delta(1) if move[1] == 'Camel' else unchanged))
+            elif kind == 'Camels':
+                deltas.append((move, camel_delta(self._market[CAMEL])))
+            else:
+                deltas.append((move, camel_delta(-move[1].count('Camel'))))
+        return deltas
 
     # Take all the camels from the market into the active player's hand
+    # The mutators return the details undo_move needs to reverse them
     def take_camels(self):
-        self.herds[self.active_player] += [card for card in self.market if card == 'Camel']
-        self.market = [card for card in self.market if card != 'Camel']
+        if self._shared:
+            self._own(SHARED_MARKET | SHARED_PLAYER[self._turn])
+        self._moves = None
+        camels = self._market[CAMEL]
+        p = self._players[self._turn]
+        self._zobrist ^= (ZOBRIST_MARKET[CAMEL][camels] ^ ZOBRIST_MARKET[CAMEL][0]
+                          ^ ZOBRIST_HERD[self._turn][p.herd] ^ ZOBRIST_HERD[self._turn][p.herd + camels])
+        p.herd += camels
+        self._market[CAMEL] = 0
+        self._market_size -= camels
         self.replenish_board()
+        return camels
 
     # Take a single card from the market without exchanging
     def take_card(self, card):
-        if card not in self.market:
+        g = GOOD_INDEX.get(card)
+        if g is None or not self._market[g]:
             raise Exception("Card is not in the market")
         else:
-            self.market.remove(card)
+            if self._shared:
+                self._own(SHARED_MARKET | SHARED_PLAYER[self._turn])
+            self._moves = None
+            seat = self._turn
+            count = self._market[g]
+            h = self._zobrist ^ ZOBRIST_MARKET[g][count] ^ ZOBRIST_MARKET[g][count - 1]
+            self._market[g] = count - 1
+            self._market_size -= 1
 
             # Add camel to herd if it's a camel
-            if card == 'Camel':
-                self.herds[self.active_player].append(card)
+            p = self._players[seat]
+            if g == CAMEL:
+                h ^= ZOBRIST_HERD[seat][p.herd] ^ ZOBRIST_HERD[seat][p.herd + 1]
+                p.herd += 1
             # Add the card into the hand otherwise
             else:
-                self.hands[self.active_player].append(card)
+                h ^= ZOBRIST_HAND[seat][g][p.hand[g]] ^ ZOBRIST_HAND[seat][g][p.hand[g] + 1]
+                p.hand[g] += 1
+                p.hand_size += 1
+            self._zobrist = h
 
             # Replace the missing card
             self.replenish_board()
+            return g
 
     # Exchange 1 or more cards from the market into the player's hand
     def exchange_cards(self, give_cards, take_cards):
         # Check if the cards to give is a subset of the player's hand
         if len(give_cards) != len(take_cards):
             raise Exception("Number of cards to exchange don't match.")
-            
-        give_card_count = Counter(give_cards)
-        hand_count = Counter(self.hands[self.active_player])
-
-        if any(give_card_count[c] > hand_count[c] for c, _ in give_card_count.items()):
-            print(self.active_player)
-            print(give_cards)
-            print(take_cards)
-            print(self.hands)
+
+        if self._shared:
+            self._own(SHARED_MARKET | SHARED_PLAYER[self._turn])
+        p = self._players[self._turn]
+        give_count = count_cards(give_cards)
+        if give_count[CAMEL] > p.herd or any(give_count[g] > p.hand[g] for g in range(NUM_GOODS)):
             raise Exception("Not enough cards to give.")
 
         # Check if there are enough cards to take from the market
-        take_card_count = Counter(take_cards)
-        market_count = Counter(self.market)
-        if any(take_card_count[c] > market_count[c] for c, _ in take_card_count.items()):
+        take_count = count_cards(take_cards)
+        market = self._market
+        if any(take_count[g] > market[g] for g in range(NUM_CARDS)):
             raise Exception("Not enough cards in the market.")
-
-        # Swap cards between the hand and market
-        for card in give_cards:
-            self.hands[self.active_player].remove(card)
-        self.hands[self.active_player] += take_cards
-
-        for card in take_cards:
-            self.market.remove(card)
-        self.market += give_cards
-
-        # Move any camels to the herd
-        combined_hand = self.hands[self.active_player] + self.herds[self.active_player]
-        self.hands[self.active_player] = [card for card in combined_hand if card != 'Camel']
-        self.herds[self.active_player] = [card for card in combined_hand if card == 'Camel']
+        if take_count[CAMEL]:
+            raise Exception("Camels can't be taken in an exchange.")
+
+        # Camels given from the herd are replaced by goods in the hand
+        if p.hand_size + give_count[CAMEL] > 7:
+            raise Exception("Too many cards in hand.")
+
+        # Swap cards between the hand and market, camels move to the herd
+        self._moves = None
+        seat = self._turn
+        hand_keys = ZOBRIST_HAND[seat]
+        h = self._zobrist
+        for g in range(NUM_GOODS):
+            delta = take_count[g] - give_count[g]
+            if delta:
+                h ^= hand_keys[g][p.hand[g]] ^ hand_keys[g][p.hand[g] + delta]
+                h ^= ZOBRIST_MARKET[g][market[g]] ^ ZOBRIST_MARKET[g][market[g] - delta]
+                p.hand[g] += delta
+                market[g] -= delta
+        delta = take_count[CAMEL] - give_count[CAMEL]
+        if delta:
+            h ^= ZOBRIST_HERD[seat][p.herd] ^ ZOBRIST_HERD[seat][p.herd + delta]
+            h ^= ZOBRIST_MARKET[CAMEL][market[CAMEL]] ^ ZOBRIST_MARKET[CAMEL][market[CAMEL] - delta]
+            p.herd += delta
+            market[CAMEL] -= delta
+        self._zobrist = h
+        p.hand_size += (len(take_cards) - take_count[CAMEL]) - (len(give_cards) - give_count[CAMEL])
+        return give_count, take_count
 
     # Sell cards into the discard pile
     def sell_cards(self, card, n):
+        g = GOOD_INDEX[card]
+        if self._shared:
+            self._own(SHARED_PLAYER[self._turn] | SHARED_DISCARD | SHARED_GOODS_TOP | (SHARED_BONUS_TOP if n >= 3 else 0))
+        p = self._players[self._turn]
 
-        hand_count = Counter(self.hands[self.active_player])
-        if n > hand_count[card]:
+        if g == CAMEL or n > p.hand[g]:
             raise Exception("Not enough cards to sell.")
         else:
-            for _ in range(n):
-                self.hands[self.active_player].remove(card)
-                self.discard_pile.append(card)
+            self._moves = None
+            seat = self._turn
+            h = self._zobrist ^ ZOBRIST_HAND[seat][g][p.hand[g]] ^ ZOBRIST_HAND[seat][g][p.hand[g] - n]
+            p.hand[g] -= n
+            p.hand_size -= n
+            self._discard[g] += n
 
             # Give the player goods tokens
-            for _ in range(n):
-                try:
-                    tk = self.goods_tokens[card].pop(0)
-                    self.tokens[self.active_player][0].append(tk)
-                # No more tokens to take from this pile
-                except IndexError:
-                    print("No more %s tokens." % card)
+            pile = GOODS_TOKENS[g]
+            top = self._goods_top[g]
+            taken = min(n, len(pile) - top)
+            if taken:
+                score = p.goods_score
+                p.goods_score += sum(pile[top:top + taken])
+                h ^= ZOBRIST_GOODS_SCORE[seat][score] ^ ZOBRIST_GOODS_SCORE[seat][p.goods_score]
+                h ^= ZOBRIST_GOODS_TOP[g][top] ^ ZOBRIST_GOODS_TOP[g][top + taken]
+                if top + taken == len(pile):
+                    self._depleted += 1
+            p.tokens[0] += pile[top:top + taken]
+            self._goods_top[g] = top + taken
+            # No more tokens to take from this pile
+            if taken < n:
+                print("No more %s tokens." % card)
 
             # If 3 or more sold give them a bonus token
+            bonus = -1
             if n >= 3:
-                try:
-                    # Cap off bonus token sales if the player is trying to sell 6 cards
-                    bt = self.bonus_tokens[min(n,5)].pop()
-                    self.tokens[self.active_player][1].append(bt)
+                # Cap off bonus token sales if the player is trying to sell 6 cards
+                b = min(n, 5) - 3
+                top = self._bonus_top[b]
+                if top < len(self._bonus_piles[b]):
+                    score = p.bonus_score
+                    p.bonus_score += self._bonus_piles[b][top]
+                    h ^= ZOBRIST_BONUS_SCORE[seat][score] ^ ZOBRIST_BONUS_SCORE[seat][p.bonus_score]
+                    h ^= ZOBRIST_BONUS_TOP[b][top] ^ ZOBRIST_BONUS_TOP[b][top + 1]
+                    p.tokens[1].append(self._bonus_piles[b][top])
+                    self._bonus_top[b] = top + 1
+                    bonus = b
                 # No more bonus tokens for this amount
-                except IndexError:
+                else:
                     print("No more %d bonus tokens" % n)
 
-    # Apply move based on arguments                
+            self._zobrist = h
+            return g, n, taken, bonus
+
+    # Apply move based on arguments
     def apply_move(self, args):
+        camel_token = self._camel_token
+        deck_top = self._deck_top
+        moves = self._moves
+        zobrist = self._zobrist
+
         if args[0] == 'Camels':
-            self.take_camels()
+            change = self.take_camels()
         elif args[0] == 'Take':
-            self.take_card(args[1])
+            change = self.take_card(args[1])
         elif args[0] == 'Exchange':
-            self.exchange_cards(args[1], args[2])
+            change = self.exchange_cards(args[1], args[2])
         elif args[0] == 'Sell':
-            self.sell_cards(args[1],int(args[2]))
+            change = self.sell_cards(args[1],int(args[2]))
         else:
             raise Exception("Option is not valid.")
 
+        # Keep enough to undo the move, drawn cards are recovered from the deck
+        self._history.append((args, change, camel_token, deck_top, moves, zobrist))
+
         # Check who has the most camels
         self.camel_token_allocate()
 
         # Swap players around
-        self.active_player, self.inactive_player = self.inactive_player, self.active_player
+        self._turn = 1 - self._turn
+        self._zobrist ^= ZOBRIST_TURN
+
+    # Reverse the last move made with apply_move
+    def undo_move(self):
+        move, change, camel_token, deck_top, moves, zobrist = self._history.pop()
+        kind = move[0]
+
+        self._turn = 1 - self._turn
+        self._camel_token = camel_token
+        self._moves = moves
+        self._zobrist = zobrist
+        if self._shared:
+            self._own(SHARED_MARKET | SHARED_PLAYER[self._turn]
+                      | (SHARED_DISCARD | SHARED_GOODS_TOP | SHARED_BONUS_TOP if kind == 'Sell' else 0))
+        p = self._players[self._turn]
+        market = self._market
+
+        # Put any cards drawn to replenish the market back on the deck
+        for g in self._deck[self._deck_top:deck_top]:
+            market[g] -= 1
+        self._market_size -= deck_top - self._deck_top
+        self._deck_top = deck_top
+
+        if kind == 'Camels':
+            p.herd -= change
+            market[CAMEL] += change
+            self._market_size += change
+        elif kind == 'Take':
+            if change == CAMEL:
+                p.herd -= 1
+            else:
+                p.hand[change] -= 1
+                p.hand_size -= 1
+            market[change] += 1
+            self._market_size += 1
+        elif kind == 'Exchange':
+            give_count, take_count = change
+            for g in range(NUM_GOODS):
+                delta = take_count[g] - give_count[g]
+                p.hand[g] -= delta
+                p.hand_size -= delta
+                market[g] += delta
+            delta = take_count[CAMEL] - give_count[CAMEL]
+            p.herd -= delta
+            market[CAMEL] += delta
+        else:
+            g, n, taken, bonus = change
+            p.hand[g] += n
+            p.hand_size += n
+            self._discard[g] -= n
+            if taken:
+                if self._goods_top[g] == len(GOODS_TOKENS[g]):
+                    self._depleted -= 1
+                self._goods_top[g] -= taken
+                p.goods_score -= sum(p.tokens[0][-taken:])
+                del p.tokens[0][-taken:]
+            if bonus >= 0:
+                self._bonus_top[bonus] -= 1
+                p.bonus_score -= p.tokens[1].pop()
 
     def print_board(self):
-        for good in self.goods_tokens:
-            print(good, '|', ' '.join(map(str,self.goods_tokens[good])))
+        goods_tokens = self.goods_tokens
+        for good in goods_tokens:
+            print(good, '|', ' '.join(map(str,goods_tokens[good])))
             print('-'*20)
 
-        hand_1 = ' ' if not self.hands[self.name1] else ' '.join(self.hands[self.name1])
-        herd_1 = ' ' if not self.herds[self.name1] else ' '.join(self.herds[self.name1])
-        hand_2 = ' ' if not self.hands[self.name2] else ' '.join(self.hands[self.name2])
-        herd_2 = ' ' if not self.herds[self.name2] else ' '.join(self.herds[self.name2])
+        hands = self.hands
+        herds = self.herds
+        hand_1 = ' ' if not hands[self.name1] else ' '.join(hands[self.name1])
+        herd_1 = ' ' if not herds[self.name1] else ' '.join(herds[self.name1])
+        hand_2 = ' ' if not hands[self.name2] else ' '.join(hands[self.name2])
+        herd_2 = ' ' if not herds[self.name2] else ' '.join(herds[self.name2])
 
         print('%s''s hand: %s' % (self.name1, hand_1), end=' ')
         print('%s''s herd: %s' % (self.name1, herd_1))
@@ -291,85 +974,191 @@ class Jaipur:
         print('%s''s herd: %s' % (self.name2, herd_2))
         print('Market: %s' % ' '.join(self.market))
 
+    # Generate each distinct exchange once, with the cards given and taken in GOODS order
+    def iter_exchanges(self, player=None):
+        p = self._players[self._player_seat(player)]
+        if not p.hand_size:
+            return
+
+        # Camels can't be taken, and every camel given adds a card to the hand
+        max_size = min(p.hand_size, 5)
+        give_counts = p.hand + [min(p.herd, 7 - p.hand_size)]
+        take_counts = self._market[:]
+        take_counts[CAMEL] = 0
+
+        gives = sub_multisets(give_counts, max_size)
+        takes = sub_multisets(take_counts, max_size)
+        for i in range(1, max_size + 1):
+            for take_mask, take in takes[i]:
+                # Swapping a good for the same good is redundant, as it can be done using fewer cards
+                for give_mask, give in gives[i]:
+                    if not give_mask & take_mask:
+                        yield ('Exchange', give, take)
+
+    # Generate legal moves lazily one kind at a time, following the order of move kinds given
+    # Sells come biggest first, takes jewels first and exchanges by the number of cards
+    def iter_legal_moves(self, player=None, order=MOVE_STAGES):
+        p = self._players[self._player_seat(player)]
+        market = self._market
+
+        for kind in order:
+            # Selling actions
+            if kind == 'Sell':
+                for g in range(NUM_GOODS):
+                    # Determine the minimum number of cards to sell, 2 if it's a Jewel
+                    # Check that there are enough tokens to sell, if so this is a valid move
+                    min_k = 2 if g in JEWELS else 1
+                    tokens_left = len(GOODS_TOKENS[g]) - self._goods_top[g]
+                    for i in range(min(p.hand[g], tokens_left), min_k - 1, -1):
+                        yield ('Sell', GOODS[g], i)
+
+            # Actions involving taking 1 card from the market
+            elif kind == 'Take':
+                if p.hand_size < 7:
+                    for g in range(NUM_CARDS):
+                        if market[g]:
+                            yield ('Take', GOODS[g], None)
+
+            # Take all camels from the market
+            elif kind == 'Camels':
+                if market[CAMEL]:
+                    yield ('Camels', None, None)
+
+            # All possible actions for exchanging n cards between the hand and market
+            elif kind == 'Exchange':
+                yield from self.iter_exchanges(player)
+
+            else:
+                raise Exception("Move kind is not valid.")
+
+    # A random sell, take or camels move for the active player, picked from the counts without listing the moves
+    # Returns None when only exchanges are legal, for quick playouts
+    def random_move(self, rng=random):
+        p = self._players[self._turn]
+        hand = p.hand
+        top = self._goods_top
+        market = self._market
+
+        # Sell sizes of each good, then the goods that can be taken
+        sells = [min(hand[g], PILE_SIZES[g] - top[g]) - MIN_SELL[g] + 1 for g in range(NUM_GOODS)]
+        takes = [g for g in range(NUM_CARDS) if market[g]] if p.hand_size < 7 else []
+        total = sum(n for n in sells if n > 0)
+        options = total + len(takes) + (1 if market[CAMEL] else 0)
+        if not options:
+            return None
+
+        r = rng.randrange(options)
+        if r >= total:
+            r -= total
+            return ('Take', GOODS[takes[r]], None) if r < len(takes) else ('Camels', None, None)
+        for g in range(NUM_GOODS):
+            if sells[g] > 0:
+                if r < sells[g]:
+                    return ('Sell', GOODS[g], MIN_SELL[g] + r)
+                r -= sells[g]
+
+    # True if the player has any move, without generating them all
+    def has_legal_moves(self, player=None):
+        cached = self._moves
+        if cached is not None and cached[0] == self._player_seat(player):
+            return bool(cached[1])
+        return next(self.iter_legal_moves(player), None) is not None
+
+    # Check a single move without generating the others
+    def is_legal_move(self, move, player=None):
+        seat = self._player_seat(player)
+        cached = self._moves
+        if cached is not None and cached[0] == seat:
+            return move in cached[1]
+
+        p = self._players[seat]
+        market = self._market
+        kind = move[0]
+        if kind == 'Camels':
+            return market[CAMEL] > 0
+        if kind == 'Take':
+            g = GOOD_INDEX.get(move[1])
+            return g is not None and p.hand_size < 7 and market[g] > 0
+        if kind == 'Sell':
+            g = GOOD_INDEX.get(move[1])
+            if g is None or g == CAMEL:
+                return False
+            min_k = 2 if g in JEWELS else 1
+            return min_k <= move[2] <= min(p.hand[g], len(GOODS_TOKENS[g]) - self._goods_top[g])
+        if kind == 'Exchange':
+            give, take = move[1], move[2]
+            if not 0 < len(give) == len(take) <= min(p.hand_size, 5):
+                return False
+            if any(card not in GOOD_INDEX for card in give + take):
+                return False
+            # Moves are compared as tuples, so the cards must be in GOODS order
+            if list(give) != sorted(give, key=GOOD_INDEX.get) or list(take) != sorted(take, key=GOOD_INDEX.get):
+                return False
+            give_count = count_cards(give)
+            take_count = count_cards(take)
+            return (not take_count[CAMEL]
+                    and give_count[CAMEL] <= min(p.herd, 7 - p.hand_size)
+                    and all(give_count[g] <= p.hand[g] for g in range(NUM_GOODS))
+                    and all(take_count[g] <= market[g] for g in range(NUM_GOODS))
+                    and not any(give_count[g] and take_count[g] for g in range(NUM_GOODS)))
+        return False
+
+    # Forget the cached legal moves, mutators do this on their own
+    def clear_move_cache(self):
+        self._moves = None
+
     # A player can either take cards or sell, but not both
+    # The moves are cached until the game changes, so the returned set is frozen
     def get_legal_moves(self, player=None):
-        possible_moves = []
-
-        if not player:
-            player = self.active_player
-
-        # Take all camels from the market
-        if 'Camel' in self.market:
-            possible_moves.append(('Camels', None, None))
-
-        # Actions involving taking 1 card from the market
-        if len(self.hands[player]) < 7:
-            for card in self.market:
-                possible_moves.append(('Take', card, None))
-
-        # All possible actions for exchanging n cards between the hand and market
-        if len(self.hands[player]) > 0:
-            for i in range(1, min(len(self.hands[player]), 5) + 1):
-                give_card_combos = combinations(self.hands[player] + self.herds[player], i)
-                take_card_combos = combinations(self.market, i)
-                # Add all combinations of cards to swap and remove any redundant swaps, as these can be done using fewer cards
-                possible_moves += [('Exchange', gc, tc) for gc in give_card_combos for tc in take_card_combos if not set(gc).intersection(set(tc))]
-
-        # Selling actions
-        card_counter = Counter(self.hands[player])
-        for k in card_counter:
-            
-            # Determine the minimum number of cards to sell, 2 if it's a Jewel
-            min_k = 1 if k not in ['Diamond', 'Gold', 'Silver'] else 2
-
-            # Add all the possible selling combinations to the list of moves
-            for i in range(min_k, card_counter[k]+1):
-                # Check that there are enough tokens to sell, if so this is a valid move
-                if len(self.goods_tokens[k]) >= i:
-                    possible_moves.append(('Sell', k, i))
-
-        # De-duplicate moves for repeated card
-        possible_moves = set(possible_moves)
+        seat = self._player_seat(player)
+        cached = self._moves
+        if cached is not None and cached[0] == seat:
+            self.move_cache_stats.hits += 1
+            return cached[1]
+        self.move_cache_stats.misses += 1
+
+        possible_moves = frozenset(self.iter_legal_moves(player))
+        self._moves = (seat, possible_moves)
         return possible_moves
 
     # Check if the game has finished and determine who is the winner. Ties do not count. 
     def is_winner(self, player):
-        if self.deck == [] or len([good for good in self.goods_tokens if self.goods_tokens[good] == []]) < 3:
-            player_scores = {self.name1: self.total_score(player=self.name1),
-                             self.name2: self.total_score(player=self.name2)
-                             }
-
-            if player == self.name1:
-                return player_scores[player] > player_scores[self.name1]
-            else:
-                return player_scores[player] > player_scores[self.name2]
+        if self.is_terminal:
+            other = self.name2 if player == self.name1 else self.name1
+            return self.total_score(player) > self.total_score(other)
 
         return False
 
     def is_loser(self, player):
-        if self.deck == [] or len([good for good in self.goods_tokens if self.goods_tokens[good] == []]) < 3:
-            player_scores = {self.name1: self.total_score(player=self.name1),
-                             self.name2: self.total_score(player=self.name2)
-                             }
-
-            if player == self.name1:
-                return player_scores[player] < player_scores[self.name2]
-            else:
-                return player_scores[player] < player_scores[self.name1]
+        if self.is_terminal:
+            other = self.name2 if player == self.name1 else self.name1
+            return self.total_score(player) < self.total_score(other)
 
         return False
 
     # Play one iteration of the game
-    def play(self, time_limit = 50):
+    # Returns the winner, the MoveHistory of the game, or None without record, and how the game ended
+    # Agents with observe_move and observe_end methods are told of every move and of the end of the game
+    def play(self, time_limit = 50, record=True):
+        observers = [agent for agent in self.agents.values() if hasattr(agent, 'observe_move')]
+        try:
+            return self._play(time_limit, observers, record)
+        finally:
+            for agent in observers:
+                if hasattr(agent, 'observe_end'):
+                    agent.observe_end(self)
+
+    def _play(self, time_limit, observers, record):
         self.initial_setup()
 
-        move_history = []
+        move_history = MoveHistory() if record else None
         time_millis = lambda: 1000 * timeit.default_timer()
 
         # While the deck isn't empty or 3 good piles haven't been depleted yet
-        while self.deck != [] and len([good for good in self.goods_tokens if self.goods_tokens[good] == []]) < 3:
+        while not self.game_over():
+            # Agents get a snapshot, cheap to make and copied only as far as they change it
             legal_moves = self.get_legal_moves()
-            game_copy = self.board_copy()
+            game_copy = self.snapshot()
 
             # Check player makes a move before the time limit
             move_start = time_millis()
@@ -386,61 +1175,30 @@ class Jaipur:
                     return self._inactive_player, move_history, "forfeit"
                 return self._inactive_player, move_history, "illegal move"
 
-        
-            columns=['Camels', 'Take', 'Exchange', 'Sell', 
-                'Camel', 'Diamond', 'Gold', 'Silver', 'Cloth', 'Spice', 'Leather', 
-                'p1_delta', 'p2_delta', 'initiating_player']
-
-            # Record move history and point changes
             # Scores before the move
             p1_before = self.visible_score(self.name1)
             p2_before = self.visible_score(self.name2)
-
-
-            # Record the details of each move by pivoting the arguments into a dictionary.
-            move = {c : 0 for c in columns}
-
-            if curr_move[0] == 'Camels':
-                camel_count = len([x for x in self.market if x == 'Camel'])
-                move['Camels'] = 1
-                move['Camel'] = camel_count
-            elif curr_move[0] == 'Take':
-                move['Take'] = 0
-                move[curr_move[1]] = 1
-                
-            elif curr_move[0] == 'Sell':
-                move['Sell'] = 1
-                move[curr_move[1]] = -curr_move[2]
-            else:
-                move['Exchange'] = 1
-                for card in curr_move[1]:
-                    move[card] -= 1
-                for card in curr_move[2]:
-                    move[card] += 1
-
-            move['initiating_player'] = 1 if self.active_player == self.name1 else 0
+            camels = self._market[CAMEL]
 
             # Apply the move
+            mover = self.active_player
             self.apply_move(curr_move)
+            for agent in observers:
+                agent.observe_move(self.snapshot(), curr_move, mover)
 
-            # Calculate the point differences
-            p1_after = self.visible_score(self.name1)
-            p2_after = self.visible_score(self.name2)
-            move['p1_delta'] = p1_after - p1_before
-            move['p2_delta'] = p2_after - p2_before
-
-            # Add the data to the move history
-            move_history.append(move)
-
-        df_move_history = pd.DataFrame(move_history, columns = columns)
+            # Record the move and the point differences
+            if move_history is not None:
+                move_history.record(curr_move, camels, mover == self.name1,
+                                    self.visible_score(self.name1) - p1_before,
+                                    self.visible_score(self.name2) - p2_before)
 
         # Final results of the game
         if self.total_score(self.name1) > self.total_score(self.name2):
-            return self.name1, df_move_history, "Player 1 wins"
+            return self.name1, move_history, "Player 1 wins"
         elif self.total_score(self.name1) < self.total_score(self.name2):
-            return self.name2, df_move_history, "Player 2 wins"
+            return self.name2, move_history, "Player 2 wins"
         else:
-            return self.name1, df_move_history, "Draw"
+            return self.name1, move_history, "Draw"
 
 if __name__ == "__main__":
     my_deck = Jaipur(RandomPlayer("Albert"),RandomPlayer("Rohit"))
@@ -0,0 +1,347 @@
+from jaipur import Jaipur, GOODS, CAMEL, NUM_GOODS, NUM_CARDS, GOODS_TOKENS, PILE_SIZES, MIN_SELL, JEWELS
+from jaipur import expand_counts
+from types import SimpleNamespace
+import random
+import numpy as np
+
+# Many games played in lockstep, stored as count arrays with one row per game
+# Games are dealt by Jaipur.initial_setup under their seeds, so a game here starts from the same deal
+# as Jaipur.play after random.seed(seed), and the moves recorded can be replayed on a Jaipur
+
+# Move kinds, indexing MOVE_STAGES
+SELL, TAKE, CAMELS, EXCHANGE = 0, 1, 2, 3
+NO_MOVE = -1
+
+# Prefix sums of the goods token piles, padded with the pile total
+TOKEN_SUMS = np.zeros((NUM_GOODS, max(PILE_SIZES) + 1), dtype=np.int16)
+for _g, _pile in enumerate(GOODS_TOKENS):
+    TOKEN_SUMS[_g, 1:len(_pile) + 1] = np.cumsum(_pile)
+    TOKEN_SUMS[_g, len(_pile) + 1:] = sum(_pile)
+
+PILES = np.array(PILE_SIZES)
+SELL_MIN = np.array(MIN_SELL)
+IS_JEWEL = np.array([g in JEWELS for g in range(NUM_GOODS)])
+
+# Ways a game can end, as in Jaipur.play
+PLAYING, FINISHED, NO_MOVES = 0, 1, 2
+
+# A batch of moves, one per row of the games they are for
+class BatchMoves:
+    __slots__ = ('kind', 'good', 'count', 'give', 'take')
+
+    def __init__(self, n):
+        self.kind = np.full(n, NO_MOVE, dtype=np.int8)
+        self.good = np.zeros(n, dtype=np.int8)
+        self.count = np.zeros(n, dtype=np.int8)
+        self.give = np.zeros((n, NUM_CARDS), dtype=np.int8)
+        self.take = np.zeros((n, NUM_CARDS), dtype=np.int8)
+
+    # The move of one row as a Jaipur move tuple
+    def move(self, i):
+        kind, good = self.kind[i], self.good[i]
+        if kind == SELL:
+            return ('Sell', GOODS[good], int(self.count[i]))
+        if kind == TAKE:
+            return ('Take', GOODS[good], None)
+        if kind == CAMELS:
+            return ('Camels', None, None)
+        if kind == EXCHANGE:
+            return ('Exchange', tuple(expand_counts(self.give[i])), tuple(expand_counts(self.take[i])))
+        return None
+
+class BatchJaipur:
+    def __init__(self, seeds, name1='Player1', name2='Player2'):
+        self.name1 = name1
+        self.name2 = name2
+        n = self.n = len(seeds)
+
+        # Per player state is indexed [game, seat]
+        self.hands = np.zeros((n, 2, NUM_GOODS), dtype=np.int8)
+        self.hand_size = np.zeros((n, 2), dtype=np.int8)
+        self.herds = np.zeros((n, 2), dtype=np.int8)
+        self.goods_score = np.zeros((n, 2), dtype=np.int16)
+        self.bonus_score = np.zeros((n, 2), dtype=np.int16)
+
+        # The deck is drawn from the top index down, as in Jaipur
+        self.market = np.zeros((n, NUM_CARDS), dtype=np.int8)
+        self.market_size = np.zeros(n, dtype=np.int8)
+        self.deck = np.zeros((n, 55), dtype=np.int8)
+        self.deck_top = np.zeros(n, dtype=np.int16)
+        self.goods_top = np.zeros((n, NUM_GOODS), dtype=np.int8)
+        self.bonus_piles = np.zeros((n, 3, 7), dtype=np.int8)
+        self.bonus_top = np.zeros((n, 3), dtype=np.int8)
+        self.bonus_size = np.array([7, 6, 5])
+
+        self.turn = np.zeros(n, dtype=np.int8)
+        self.camel_token = np.full(n, -1, dtype=np.int8)
+        self.status = np.zeros(n, dtype=np.int8)
+        self.history = []
+
+        seats = (SimpleNamespace(name=name1), SimpleNamespace(name=name2))
+        for i, seed in enumerate(seeds):
+            random.seed(seed)
+            game = Jaipur(*seats)
+            game.initial_setup()
+            self.deal(i, game)
+
+    # Copy the deal of a freshly set up game into row i
+    def deal(self, i, game):
+        for seat, p in enumerate(game._players):
+            self.hands[i, seat] = p.hand
+            self.hand_size[i, seat] = p.hand_size
+            self.herds[i, seat] = p.herd
+        self.market[i] = game._market
+        self.market_size[i] = game._market_size
+        self.deck[i, :game._deck_top] = game._deck[:game._deck_top]
+        self.deck_top[i] = game._deck_top
+        for b, pile in enumerate(game._bonus_piles):
+            self.bonus_piles[i, b, :len(pile)] = pile
+
+    # Rows of the games still being played
+    def playing(self):
+        return np.flatnonzero(self.status == PLAYING)
+
+    def game_over(self, rows):
+        depleted = (self.goods_top[rows] == PILES).sum(axis=1)
+        return (self.deck_top[rows] == 0) | (depleted >= 3)
+
+    def total_scores(self):
+        scores = self.goods_score + self.bonus_score
+        for seat in (0, 1):
+            scores[:, seat] += 5 * (self.camel_token == seat)
+        return scores
+
+    # Sell sizes available for each good, sizes run from SELL_MIN up
+    def sell_sizes(self, rows, seat):
+        hand = self.hands[rows, seat]
+        sizes = np.minimum(hand, PILES - self.goods_top[rows]) - SELL_MIN + 1
+        return np.maximum(sizes, 0)
+
+    # Goods and camels that can be taken one at a time
+    def takes(self, rows, seat):
+        return (self.market[rows] > 0) & (self.hand_size[rows, seat] < 7)[:, None]
+
+    # Draw cards from the deck until the market holds 5
+    def replenish(self, rows):
+        draws = np.minimum(5 - self.market_size[rows], self.deck_top[rows])
+        for k in range(5):
+            drawing = rows[draws > k]
+            if not len(drawing):
+                break
+            cards = self.deck[drawing, self.deck_top[drawing] - 1 - k]
+            self.market[drawing, cards] += 1
+        self.deck_top[rows] -= draws
+        self.market_size[rows] += draws
+
+    # Apply one move to each of the rows, the rows must be distinct games still being played
+    def apply_moves(self, rows, moves):
+        seat = self.turn[rows]
+        kind = moves.kind
+
+        # Games with no legal move are lost by the player to move, as in Jaipur.play
+        stuck = kind == NO_MOVE
+        self.status[rows[stuck]] = NO_MOVES
+
+        sell = kind == SELL
+        if sell.any():
+            r, s, g, n = rows[sell], seat[sell], moves.good[sell], moves.count[sell]
+            self.hands[r, s, g] -= n
+            self.hand_size[r, s] -= n
+            top = self.goods_top[r, g]
+            taken = np.minimum(n, PILES[g] - top)
+            self.goods_score[r, s] += TOKEN_SUMS[g, top + taken] - TOKEN_SUMS[g, top]
+            self.goods_top[r, g] += taken
+
+            b = np.clip(n, 3, 5) - 3
+            bonus_top = self.bonus_top[r, b]
+            bonus = (n >= 3) & (bonus_top < self.bonus_size[b])
+            r, s, b, bonus_top = r[bonus], s[bonus], b[bonus], bonus_top[bonus]
+            self.bonus_score[r, s] += self.bonus_piles[r, b, bonus_top]
+            self.bonus_top[r, b] += 1
+
+        take = kind == TAKE
+        if take.any():
+            r, s, g = rows[take], seat[take], moves.good[take]
+            self.market[r, g] -= 1
+            self.market_size[r] -= 1
+            camel = g == CAMEL
+            self.herds[r[camel], s[camel]] += 1
+            good = ~camel
+            self.hands[r[good], s[good], g[good]] += 1
+            self.hand_size[r[good], s[good]] += 1
+            self.replenish(r)
+
+        camels = kind == CAMELS
+        if camels.any():
+            r, s = rows[camels], seat[camels]
+            count = self.market[r, CAMEL]
+            self.herds[r, s] += count
+            self.market[r, CAMEL] = 0
+            self.market_size[r] -= count
+            self.replenish(r)
+
+        exchange = kind == EXCHANGE
+        if exchange.any():
+            r, s = rows[exchange], seat[exchange]
+            give, take = moves.give[exchange], moves.take[exchange]
+            self.hands[r, s] += take[:, :NUM_GOODS] - give[:, :NUM_GOODS]
+            self.hand_size[r, s] += (take[:, :NUM_GOODS] - give[:, :NUM_GOODS]).sum(axis=1, dtype=np.int8)
+            self.herds[r, s] -= give[:, CAMEL]
+            self.market[r] += give - take
+
+        # The camel token goes to the bigger herd and nobody holds it on a tie
+        moved = rows[~stuck]
+        herds = self.herds[moved]
+        self.camel_token[moved] = np.where(herds[:, 0] > herds[:, 1], 0, np.where(herds[:, 1] > herds[:, 0], 1, -1))
+        self.turn[moved] = 1 - seat[~stuck]
+        self.status[moved[self.game_over(moved)]] = FINISHED
+
+    # Play every game to the end with a policy for each seat, a policy is called as policy(batch, rows, seat, rng)
+    # With record the moves of every step are kept for moves_of
+    def play(self, policy1, policy2, rng=None, record=True):
+        rng = rng if rng is not None else np.random.default_rng()
+        self.status[self.game_over(np.arange(self.n))] = FINISHED
+        while True:
+            rows = self.playing()
+            if not len(rows):
+                break
+            step = []
+            for seat, policy in enumerate((policy1, policy2)):
+                seated = rows[self.turn[rows] == seat]
+                if len(seated):
+                    moves = policy(self, seated, seat, rng)
+                    self.apply_moves(seated, moves)
+                    step.append((seated, moves))
+            if record:
+                self.history.append(step)
+        return self.results()
+
+    # The moves played in one game, in order
+    def moves_of(self, i):
+        moves = []
+        for step in self.history:
+            for rows, batch in step:
+                at = np.searchsorted(rows, i)
+                if at < len(rows) and rows[at] == i:
+                    move = batch.move(at)
+                    if move is not None:
+                        moves.append(move)
+        return moves
+
+    # Winner and termination of every game, as returned by Jaipur.play
+    def results(self):
+        names = (self.name1, self.name2)
+        scores = self.total_scores()
+        results = []
+        for i in range(self.n):
+            if self.status[i] == NO_MOVES:
+                results.append((names[1 - self.turn[i]], "illegal move"))
+            elif scores[i, 0] > scores[i, 1]:
+                results.append((self.name1, "Player 1 wins"))
+            elif scores[i, 0] < scores[i, 1]:
+                results.append((self.name2, "Player 2 wins"))
+            else:
+                results.append((self.name1, "Draw"))
+        return results
+
+# Pick one option per row uniformly, options are counts per column and the first column with one wins ties
+def _pick(counts, rng):
+    total = counts.sum(axis=1)
+    r = np.floor(rng.random(len(counts)) * total).astype(np.int64)
+    cum = counts.cumsum(axis=1)
+    col = (cum <= r[:, None]).sum(axis=1)
+    col = np.minimum(col, counts.shape[1] - 1)
+    offset = r - (cum[np.arange(len(counts)), col] - counts[np.arange(len(counts)), col])
+    return col, offset, total > 0
+
+# Fill the moves for the chosen columns of [sell sizes per good, takes per card, camels]
+def _set_moves(moves, where, col, offset):
+    sell = col < NUM_GOODS
+    camels = col == NUM_GOODS + NUM_CARDS
+    take = ~sell & ~camels
+    kinds = np.where(sell, SELL, np.where(take, TAKE, CAMELS))
+    goods = np.where(sell, col, np.where(take, col - NUM_GOODS, CAMEL))
+    moves.kind[where] = kinds
+    moves.good[where] = goods
+    moves.count[where] = np.where(sell, SELL_MIN[np.minimum(col, NUM_GOODS - 1)] + offset, 0)
+
+# Swap one good in the hand for a different good in the market, for games where nothing else is legal
+def _fallback_exchange(batch, rows, seat, moves, where):
+    hand = batch.hands[rows, seat] > 0
+    market = batch.market[rows, :NUM_GOODS] > 0
+    pairs = hand[:, :, None] & market[:, None, :] & ~np.eye(NUM_GOODS, dtype=bool)
+    pairs = pairs.reshape(len(rows), -1)
+    found = pairs.any(axis=1)
+    first = pairs.argmax(axis=1)
+    at = np.flatnonzero(where)[found]
+    give, take = first[found] // NUM_GOODS, first[found] % NUM_GOODS
+    moves.kind[at] = EXCHANGE
+    moves.give[at, give] = 1
+    moves.take[at, take] = 1
+
+# Rollout policies, cheap stand-ins for the simple players rather than the players themselves
+# None of them lists exchanges, which make up most legal moves, so their games differ from RandomPlayer's,
+# GreedyPlayer's and JewelPlayer's even when the deal is the same
+
+# A uniform choice among the sells, takes and camels, the vector form of Jaipur.random_move
+# Exchanges are only played when nothing else is legal, where RandomPlayer picks from every legal move
+def rollout_policy(batch, rows, seat, rng):
+    moves = BatchMoves(len(rows))
+    counts = np.concatenate([batch.sell_sizes(rows, seat), batch.takes(rows, seat),
+                             (batch.market[rows, CAMEL] > 0)[:, None]], axis=1).astype(np.int64)
+    col, offset, legal = _pick(counts, rng)
+    _set_moves(moves, legal, col[legal], offset[legal])
+    if not legal.all():
+        _fallback_exchange(batch, rows[~legal], seat, moves, ~legal)
+    return moves
+
+# The move GreedyPlayer makes whenever one raises the visible score, rollout_policy moves otherwise
+# Candidates are scored in the order of iter_legal_moves, so the first best one wins as in GreedyPlayer
+# The camel token is handed out after every move, any move can win it when the herds changed since
+def greedy_rollout_policy(batch, rows, seat, rng):
+    moves = rollout_policy(batch, rows, seat, rng)
+    n = len(rows)
+
+    herds = batch.herds[rows]
+    mine, theirs = herds[:, seat], herds[:, 1 - seat]
+    held = 5 * (batch.camel_token[rows] == seat)
+    market_camels = batch.market[rows, CAMEL]
+    def token_gain(camels):
+        return 5 * (mine + camels > theirs) - held
+
+    # Columns are the biggest sell of each good, a take of each card and all the camels
+    sizes = batch.sell_sizes(rows, seat)
+    top = batch.goods_top[rows]
+    biggest = np.where(sizes > 0, SELL_MIN + sizes - 1, 0)
+    goods = np.arange(NUM_GOODS)
+    gains = np.full((n, NUM_GOODS + NUM_CARDS + 1), -1, dtype=np.int64)
+    gains[:, :NUM_GOODS] = np.where(sizes > 0, TOKEN_SUMS[goods, top + biggest] - TOKEN_SUMS[goods, top]
+                                    + token_gain(0)[:, None], -1)
+    takes = batch.takes(rows, seat)
+    gains[:, NUM_GOODS:NUM_GOODS + CAMEL] = np.where(takes[:, :CAMEL], token_gain(0)[:, None], -1)
+    gains[:, NUM_GOODS + CAMEL] = np.where(takes[:, CAMEL], token_gain(1), -1)
+    gains[:, -1] = np.where(market_camels > 0, token_gain(market_camels), -1)
+
+    col = gains.argmax(axis=1)
+    scoring = gains[np.arange(n), col] > 0
+    moves.give[scoring] = 0
+    moves.take[scoring] = 0
+    col = col[scoring]
+    offset = biggest[np.flatnonzero(scoring), np.minimum(col, NUM_GOODS - 1)] - SELL_MIN[np.minimum(col, NUM_GOODS - 1)]
+    _set_moves(moves, scoring, col, offset)
+    return moves
+
+# A uniform choice among the jewel sells and takes, rollout_policy moves otherwise
+# JewelPlayer also takes jewels by exchange, those are left out here
+def jewel_rollout_policy(batch, rows, seat, rng):
+    moves = rollout_policy(batch, rows, seat, rng)
+    counts = np.concatenate([batch.sell_sizes(rows, seat) * IS_JEWEL,
+                             batch.takes(rows, seat) & np.append(IS_JEWEL, False),
+                             np.zeros((len(rows), 1), dtype=bool)], axis=1).astype(np.int64)
+    col, offset, jewels = _pick(counts, rng)
+    moves.give[jewels] = 0
+    moves.take[jewels] = 0
+    _set_moves(moves, jewels, col[jewels], offset[jewels])
+    return moves
+
+POLICIES = {'rollout': rollout_policy, 'greedy': greedy_rollout_policy, 'jewel': jewel_rollout_policy}
@@ -0,0 +1,109 @@
+from jaipur import FEATURE_SIZE
+from array import array
+import hashlib
+import numpy as np
+
+# Leaf evaluation learned from self-play positions, see selfplay.py
+# A linear model or a small MLP over Jaipur.features, predicting the final score margin of the player
+# the features are from, while a finished game scores its actual margin
+# Weights are kept in an .npz file, mean and scale normalise the features and w0, b0, w1, b1, ... are the layers
+# with a ReLU between them, the last layer has a single output
+
+# Final score margin of the named player
+def score_margin(game, name):
+    other = game.player2 if name == game.player1 else game.player1
+    return game.total_score(name) - game.total_score(other)
+
+class LearnedEvaluator:
+    # The name ends in the letter AlphaBetaPlayer puts after its own, as with custom_score_1 to 3
+    def __init__(self, layers, mean=None, scale=None, name='learned_score_L'):
+        self.layers = [(np.asarray(w, dtype=np.float64), np.asarray(b, dtype=np.float64)) for w, b in layers]
+        self.mean = np.zeros(FEATURE_SIZE) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.scale = np.ones(FEATURE_SIZE) if scale is None else np.asarray(scale, dtype=np.float64)
+        self.__name__ = name
+
+        # The normalisation folded into the first layer, so raw integer features go straight in
+        w, b = self.layers[0]
+        self.folded = [(w / self.scale[:, None], b - (self.mean / self.scale) @ w)] + self.layers[1:]
+
+        # Digest of the name and weights, so copies sent to worker processes find the players kept for them
+        digest = hashlib.sha1(name.encode('utf-8'))
+        for values in [self.mean, self.scale] + [x for layer in self.layers for x in layer]:
+            digest.update(np.ascontiguousarray(values).tobytes())
+        self.digest = digest.hexdigest()
+
+    def __eq__(self, other):
+        return isinstance(other, LearnedEvaluator) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    @classmethod
+    def load(cls, path, name='learned_score_L'):
+        with np.load(path) as data:
+            layers = []
+            while 'w{}'.format(len(layers)) in data:
+                i = len(layers)
+                layers.append((data['w{}'.format(i)], data['b{}'.format(i)]))
+            return cls(layers, data['mean'], data['scale'], name)
+
+    def save(self, path):
+        weights = {}
+        for i, (w, b) in enumerate(self.layers):
+            weights['w{}'.format(i)] = w
+            weights['b{}'.format(i)] = b
+        np.savez(path, mean=self.mean, scale=self.scale, **weights)
+
+    # Predicted margins for rows of features
+    def evaluate(self, features):
+        return self.evaluate_flat(np.asarray(features, dtype=np.int64).ravel())
+
+    # Predicted margins for feature rows laid end to end in one array
+    def evaluate_flat(self, features):
+        x = features.reshape(-1, FEATURE_SIZE)
+        last = len(self.folded) - 1
+        for i, (w, b) in enumerate(self.folded):
+            x = x @ w + b
+            if i < last:
+                np.maximum(x, 0., out=x)
+        return x[:, 0]
+
+    # Score function for the search players
+    def __call__(self, game, player):
+        if game.is_terminal:
+            return float(score_margin(game, player.name))
+        return float(self.evaluate_flat(np.array(game.features(player.name)))[0])
+
+    # Values of the states after each of the moves, the same as calling this on each of them
+    # The features of every unfinished state go through the model in one matrix product
+    # Jaipur.features reads the running scores and pile counts, so a row costs a few list copies
+    def score_batch(self, game, player, moves, apply_move, undo_move):
+        name = player.name
+        values = [0.] * len(moves)
+        rows, unfinished = [], []
+        for i, move in enumerate(moves):
+            apply_move(game, move)
+            if game.is_terminal:
+                values[i] = float(score_margin(game, name))
+            else:
+                rows += game.features(name)
+                unfinished.append(i)
+            undo_move(game)
+
+        if rows:
+            batch = np.frombuffer(array('q', rows), dtype=np.int64)
+            for i, value in zip(unfinished, self.evaluate_flat(batch).tolist()):
+                values[i] = value
+        return values
+
+# Linear evaluator fitted to the labels by ridge regression on the normalised features
+def fit_linear(features, labels, ridge=1., name='learned_score_L'):
+    x = np.asarray(features, dtype=np.float64)
+    y = np.asarray(labels, dtype=np.float64)
+    mean = x.mean(axis=0)
+    scale = x.std(axis=0)
+    scale[scale == 0] = 1.
+    x = (x - mean) / scale
+
+    w = np.linalg.solve(x.T @ x + ridge * np.eye(x.shape[1]), x.T @ (y - y.mean()))
+    return LearnedEvaluator([(w[:, None], [y.mean()])], mean, scale, name)
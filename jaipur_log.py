@@ -0,0 +1,178 @@
+from jaipur import Jaipur, GOODS, GOOD_INDEX, NUM_CARDS, BONUS_TOKENS, cards
+from collections import namedtuple
+from types import SimpleNamespace
+import mmap
+import os
+import struct
+
+# Append-only binary log of played games
+# The file starts with MAGIC, then each game is a fixed size header followed by one 4 byte record per move
+# The header holds the seed, the players, the deck and bonus piles as dealt, and the result,
+# so a game can be scanned without decoding its moves and replayed from its deal
+MAGIC = b'JAIPURLOG\x00\x01\x00'
+
+DECK_SIZE = sum(cards.values())
+BONUS_SIZE = sum(len(pile) for pile in BONUS_TOKENS.values())
+NAME_BYTES = 16
+
+# seed (-1 when unseeded), move count, player names, deck, bonus piles, winner seat, termination, final scores
+# 118 bytes, 8 + 2 + 2 * 16 + 52 + 18 + 1 + 1 + 2 * 2, with no padding as the format is little-endian and packed
+HEADER = struct.Struct('<qH{0}s{0}s{1}s{2}sBBhh'.format(NAME_BYTES, DECK_SIZE, BONUS_SIZE))
+MOVE = struct.Struct('<I')
+
+# How a game ended, as Jaipur.play reports it
+TERMINATIONS = ('Player 1 wins', 'Player 2 wins', 'Draw', 'timeout', 'forfeit', 'illegal move')
+TERMINATION_CODE = {termination: i for i, termination in enumerate(TERMINATIONS)}
+
+# Move kinds in the low 2 bits of a move record
+MOVE_KINDS = ('Sell', 'Take', 'Camels', 'Exchange')
+MOVE_KIND_CODE = {kind: i for i, kind in enumerate(MOVE_KINDS)}
+
+GameHeader = namedtuple('GameHeader', ['seed', 'name1', 'name2', 'deck', 'bonus_piles', 'winner', 'termination',
+                                       'score1', 'score2', 'moves'])
+
+# A move packs its kind with the change in each card of the mover's hand and herd, 4 bits a card
+# Exchanges never give and take the same card, so the changes are enough to recover every move
+# A camels move leaves the changes at 0, the market decides how many camels it takes
+def encode_move(move):
+    kind = move[0]
+    change = [0] * NUM_CARDS
+    if kind == 'Sell':
+        change[GOOD_INDEX[move[1]]] = -move[2]
+    elif kind == 'Take':
+        change[GOOD_INDEX[move[1]]] = 1
+    elif kind == 'Exchange':
+        for card in move[1]:
+            change[GOOD_INDEX[card]] -= 1
+        for card in move[2]:
+            change[GOOD_INDEX[card]] += 1
+
+    code = MOVE_KIND_CODE[kind]
+    for g in range(NUM_CARDS):
+        code |= (change[g] & 0xF) << (2 + 4 * g)
+    return code
+
+def decode_move(code):
+    kind = MOVE_KINDS[code & 3]
+    if kind == 'Camels':
+        return ('Camels', None, None)
+
+    change = [(code >> (2 + 4 * g)) & 0xF for g in range(NUM_CARDS)]
+    change = [c - 16 if c >= 8 else c for c in change]
+    if kind == 'Exchange':
+        give = tuple(GOODS[g] for g in range(NUM_CARDS) for _ in range(-change[g]))
+        take = tuple(GOODS[g] for g in range(NUM_CARDS) for _ in range(change[g]))
+        return ('Exchange', give, take)
+
+    g = next(g for g in range(NUM_CARDS) if change[g])
+    if kind == 'Sell':
+        return ('Sell', GOODS[g], -change[g])
+    return ('Take', GOODS[g], None)
+
+# Bytes of one game, as played to the end or to an early termination by Jaipur.play
+def encode_game(game, seed, winner, termination):
+    deck, bonus_piles = game.deal_order()
+    moves = game.moves_played()
+
+    names = []
+    for name in (game.name1, game.name2):
+        encoded = name.encode('utf-8')
+        if len(encoded) > NAME_BYTES:
+            raise ValueError("Player name {!r} is longer than {} bytes.".format(name, NAME_BYTES))
+        names.append(encoded)
+
+    header = HEADER.pack(-1 if seed is None else seed, len(moves), names[0], names[1],
+                         bytes(deck), bytes(token for pile in bonus_piles for token in pile),
+                         0 if winner == game.name1 else 1, TERMINATION_CODE[termination],
+                         game.total_score(game.name1), game.total_score(game.name2))
+    return header + struct.pack('<{}I'.format(len(moves)), *map(encode_move, moves))
+
+# Appends games to a log as they finish, the file and its magic are created on first use
+class GameLogWriter:
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write_game(self, game, seed, winner, termination):
+        self.write(encode_game(game, seed, winner, termination))
+
+    # Add a game encoded by encode_game, in a worker process for instance
+    def write(self, record):
+        self.file.write(record)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Memory-mapped view of a log, indexed by game
+# Opening it walks the headers to find where each game starts, a game cut short by a crash at the end is left out
+class GameLog:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("{} is not a game log.".format(path))
+
+        self.offsets = []
+        offset = len(MAGIC)
+        while offset + HEADER.size <= size:
+            end = offset + HEADER.size + MOVE.size * struct.unpack_from('<H', self.data, offset + 8)[0]
+            if end > size:
+                break
+            self.offsets.append(offset)
+            offset = end
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def header(self, i):
+        (seed, n, name1, name2, deck, bonus, winner, termination,
+         score1, score2) = HEADER.unpack_from(self.data, self.offsets[i])
+        name1, name2 = name1.rstrip(b'\0').decode('utf-8'), name2.rstrip(b'\0').decode('utf-8')
+
+        piles, start = [], 0
+        for k in (3, 4, 5):
+            piles.append(tuple(bonus[start:start + len(BONUS_TOKENS[k])]))
+            start += len(BONUS_TOKENS[k])
+
+        return GameHeader(None if seed < 0 else seed, name1, name2, tuple(deck), tuple(piles),
+                          (name1, name2)[winner], TERMINATIONS[termination], score1, score2, n)
+
+    def headers(self):
+        return (self.header(i) for i in range(len(self)))
+
+    # Move records of a game, straight from the map
+    def move_codes(self, i):
+        n = struct.unpack_from('<H', self.data, self.offsets[i] + 8)[0]
+        return struct.unpack_from('<{}I'.format(n), self.data, self.offsets[i] + HEADER.size)
+
+    def moves(self, i):
+        return [decode_move(code) for code in self.move_codes(i)]
+
+    # The game as it stood after its first k moves, or at its end, with placeholder agents of the same names
+    def replay(self, i, k=None):
+        header = self.header(i)
+        game = Jaipur(SimpleNamespace(name=header.name1), SimpleNamespace(name=header.name2))
+        game.deal(header.deck, header.bonus_piles)
+        for code in self.move_codes(i)[:k]:
+            game.apply_move(decode_move(code))
+        return game
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,50 +1,53 @@
-from jaipur import Jaipur
+from jaipur import Jaipur, GOOD_INDEX, sub_multisets
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+import math
+import multiprocessing
+import os
 import random
-import numpy as np
+import time
+import timeit
+from itertools import groupby
 
 # Pick best move based off a value function   
 class GreedyPlayer():
-    def __init__(self, score=None):
-        self.name = 'Greedy'
+    def __init__(self, name='Greedy'):
+        self.name = name
 
     def get_move(self, game, time_left):
-        previous_score = game.visible_score()
         # Evaluate the moves and the scores 
-        options = []
-        for move in game.get_legal_moves():
-            forecast = forecast_move(game, move)
-            point_change =  forecast.visible_score(forecast._inactive_player) - previous_score
-            if point_change > 0:
-                options.append((move,point_change))
+        options = [(move, point_change) for move, point_change in game.move_score_deltas() if point_change > 0]
 
         if options:
             return max(options, key=lambda x:x[1] )[0]
         else:
-            return random.sample(game.get_legal_moves(),1)[0]
+            return random.choice(list(game.iter_legal_moves()))
 
 # Random moves
 class RandomPlayer():
-    def __init__(self, score=None):
-        self.name = 'Random'
+    def __init__(self, name='Random'):
+        self.name = name
 
     def get_move(self, game, time_left=0):
-        return random.sample(game.get_legal_moves(),1)[0]
+        return random.choice(list(game.iter_legal_moves()))
 
 # Prioritises moves that involve the taking and selling of Jewel goods, as these have the most value in the game
 class JewelPlayer():
-    def __init__(self, score=None):
-        self.name = 'Jewel'
+    def __init__(self, name='Jewel'):
+        self.name = name
 
     def get_move(self, game, time_left=0):
-        legal_moves =  [move for move in game.get_legal_moves()
+        legal_moves =  [move for move in game.iter_legal_moves()
                             if move[0] in ('Take', 'Sell') and move[1] in ('Diamond', 'Silver', 'Gold') 
                             or move[0] == 'Exchange' and set(move[2]).intersection(set(['Diamond', 'Silver', 'Gold']))]
         if legal_moves:
-            return random.sample(legal_moves,1)[0]
+            return random.choice(legal_moves)
         else:
-            return random.sample(game.get_legal_moves(),1)[0] 
+            return random.choice(list(game.iter_legal_moves())) 
         
-# Forecast the move, to be used by the players for inference
+# Forecast the move on a copy of the game
+# The search players apply and undo moves in place instead
 def forecast_move(game, move):
     game_copy = game.board_copy()
     game_copy.apply_move(move)
@@ -54,64 +57,330 @@ def forecast_move(game, move):
 class SearchTimeout(Exception):
     pass
 
+# Bound types of the values kept in the transposition table
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# Fixed size transposition table indexed by the game's Zobrist hash
+# A slot is replaced when the new entry is searched at least as deep, or the old one is left over from an earlier move
+class TranspositionTable:
+    # Rough size of a slot with its entry tuple, used to turn the memory cap into a slot count
+    ENTRY_BYTES = 200
+
+    def __init__(self, max_mb=16):
+        self.size = max(1, int(max_mb * 2**20) // self.ENTRY_BYTES)
+        self.table = [None] * self.size
+        self.generation = 0
+        self.hits = 0
+        self.stores = 0
+
+    # Start a new search, entries from older searches can still be read but are replaced first
+    def new_search(self):
+        self.generation += 1
+
+    # Return (key, depth, value, bound, best move, generation) or None
+    def probe(self, key):
+        entry = self.table[key % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def store(self, key, depth, value, bound, move):
+        i = key % self.size
+        old = self.table[i]
+        if old is None or old[5] != self.generation or depth >= old[1]:
+            self.table[i] = (key, depth, value, bound, move, self.generation)
+            self.stores += 1
+
+    def clear(self):
+        self.table = [None] * self.size
+        self.hits = 0
+        self.stores = 0
+
+# Cheap static move score, big sells and jewels first, then takes, camels and exchanges
+JEWEL_GOODS = ('Diamond', 'Gold', 'Silver')
+
+def static_move_score(move):
+    if move[0] == 'Sell':
+        return 40 + 4 * move[2] + (2 if move[1] in JEWEL_GOODS else 0)
+    if move[0] == 'Take':
+        return 30 if move[1] in JEWEL_GOODS else 20
+    if move[0] == 'Camels':
+        return 10
+    return sum(1 for card in move[2] if card in JEWEL_GOODS)
+
+# Batches of iter_legal_moves that are ordered together, exchanges are split by size
+def move_stage(move):
+    return (move[0], len(move[1])) if move[0] == 'Exchange' else (move[0], 0)
+
+# What a search did while choosing one move, or summed over several moves
+# Times are in seconds, copying covers applying and undoing moves
+class SearchStats:
+    __slots__ = ('moves', 'nodes', 'leaves', 'evaluations', 'cutoffs', 'tt_cutoffs', 'depth_completed',
+                 'depth_times', 'time_movegen', 'time_eval', 'time_copy', 'time_total')
+
+    def __init__(self):
+        self.moves = 0
+        self.nodes = 0
+        self.leaves = 0
+        self.evaluations = 0
+        self.cutoffs = 0
+        self.tt_cutoffs = 0
+        self.depth_completed = 0
+        self.depth_times = []
+        self.time_movegen = 0.
+        self.time_eval = 0.
+        self.time_copy = 0.
+        self.time_total = 0.
+
+    # Average children searched per interior node
+    def branching_factor(self):
+        interior = self.nodes - self.leaves
+        return (self.nodes - self.moves) / interior if interior > 0 else 0.
+
+    def cutoff_rate(self):
+        interior = self.nodes - self.leaves
+        return (self.cutoffs + self.tt_cutoffs) / interior if interior > 0 else 0.
+
+    def nodes_per_second(self):
+        return self.nodes / self.time_total if self.time_total else 0.
+
+    # Add another move's stats, depth_completed becomes the sum so it can be averaged over moves
+    def merge(self, other):
+        for name in self.__slots__:
+            if name != 'depth_times':
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def as_dict(self):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values['branching_factor'] = self.branching_factor()
+        values['cutoff_rate'] = self.cutoff_rate()
+        return values
+
+# Deadline checks for a search, time_left is read once every interval nodes instead of at every node
+# The interval adapts so the clock is read about every poll_ms milliseconds, and shrinks near the deadline
+# Besides the margin the longest gap between reads is kept in reserve, a single slow node
+# (an evaluation over hundreds of exchanges) can't be interrupted
+class SearchClock:
+    __slots__ = ('time_left', 'margin', 'poll_ms', 'interval', 'countdown', 'nodes', 'last_left', 'slowest')
+
+    def __init__(self, time_left, margin, poll_ms=1., slowest=0.):
+        self.time_left = time_left
+        self.margin = margin
+        self.poll_ms = poll_ms
+        self.interval = 1
+        self.countdown = 1
+        self.nodes = 0
+        self.last_left = time_left()
+        self.slowest = slowest
+
+    # Milliseconds that must be left to keep searching
+    def reserve(self):
+        return self.margin + self.slowest
+
+    # Searches call this when countdown runs out
+    def poll(self):
+        left = self.time_left()
+        elapsed = self.last_left - left
+        self.last_left = left
+        if elapsed > self.slowest:
+            self.slowest = elapsed
+        if left < self.margin + self.slowest:
+            raise SearchTimeout
+        self.nodes += self.interval
+
+        # The interval at most doubles, a gap too short to time can't make it jump past the deadline
+        if elapsed > 0:
+            nodes_per_ms = self.interval / elapsed
+            interval = min(nodes_per_ms * min(self.poll_ms, (left - self.reserve()) / 2), 2 * self.interval)
+        else:
+            interval = 2 * self.interval
+        self.interval = self.countdown = max(1, min(int(interval), 4096))
+
+    # Nodes counted so far
+    def count(self):
+        return self.nodes + self.interval - self.countdown
+
 class JaipurPlayer:
-    def __init__(self, search_depth=3, score_fn=None, timeout=10.):
+    def __init__(self, search_depth=3, score_fn=None, timeout=10., collect_stats=False):
         self.search_depth = search_depth
         self.score = score_fn
         self.time_left = None
+        self.clock = None
+
+        # Milliseconds kept in reserve, the search stops once less than this is left
         self.TIMER_THRESHOLD = timeout
 
+        # Stats of the last move, only collected when asked for so the search stays lean otherwise
+        self.collect_stats = collect_stats
+        self.stats = None
+        self.stats_hooks = []
+
+    # Clock for the current time_left, a fresh one whenever time_left changes
+    # The slowest gap of the last move carries over at half weight
+    def search_clock(self):
+        clock = self.clock
+        if clock is None or clock.time_left is not self.time_left:
+            slowest = clock.slowest / 2 if clock is not None else 0.
+            clock = self.clock = SearchClock(self.time_left, self.TIMER_THRESHOLD, slowest=slowest)
+        return clock
+
+    # Told about every move played in a game, with the game after the move
+    def observe_move(self, game, move, player):
+        pass
+
+    # Told when the game is over, however it ended
+    def observe_end(self, game):
+        pass
+
+    # Call hook(player, stats) after every move, collecting stats from then on
+    def add_stats_hook(self, hook):
+        self.collect_stats = True
+        self.stats_hooks.append(hook)
+
+    def begin_stats(self):
+        self.stats = SearchStats() if self.collect_stats else None
+        if self.stats is not None:
+            self.stats.moves = 1
+            self.stats.time_total = timeit.default_timer()
+
+    def end_stats(self):
+        stats = self.stats
+        if stats is not None:
+            stats.time_total = timeit.default_timer() - stats.time_total
+            for hook in self.stats_hooks:
+                hook(self, stats)
+
+    # Functions the search calls on the game, timed versions when stats are being collected
+    def search_ops(self):
+        if self.stats is None:
+            return self.score, Jaipur.apply_move, Jaipur.undo_move
+        return self._timed_score, self._timed_apply, self._timed_undo
+
+    def _timed_score(self, state, player):
+        start = timeit.default_timer()
+        value = self.score(state, player)
+        self.stats.time_eval += timeit.default_timer() - start
+        self.stats.evaluations += 1
+        return value
+
+    def _timed_apply(self, state, move):
+        start = timeit.default_timer()
+        state.apply_move(move)
+        self.stats.time_copy += timeit.default_timer() - start
+
+    def _timed_undo(self, state):
+        start = timeit.default_timer()
+        state.undo_move()
+        self.stats.time_copy += timeit.default_timer() - start
+
+    # Time spent producing moves, for generators the time of every step is added
+    def _timed_moves(self, moves):
+        stats = self.stats
+        moves = iter(moves)
+        while True:
+            start = timeit.default_timer()
+            move = next(moves, None)
+            stats.time_movegen += timeit.default_timer() - start
+            if move is None:
+                return
+            yield move
+
+    def _timed_call(self, fn, *args):
+        start = timeit.default_timer()
+        value = fn(*args)
+        self.stats.time_movegen += timeit.default_timer() - start
+        return value
+
 class MinimaxPlayer(JaipurPlayer):
 
-    def __init__(self, search_depth=3, score_fn=None, timeout=10.):
-        JaipurPlayer.__init__(self, search_depth, score_fn, timeout)
+    def __init__(self, search_depth=3, score_fn=None, timeout=10., collect_stats=False):
+        JaipurPlayer.__init__(self, search_depth, score_fn, timeout, collect_stats)
         self.name = 'Minimax{}'.format(score_fn.__name__[-1])
 
     # Get the best move from the minimax algorithm
     def get_move(self, game, time_left):
         self.time_left = time_left
+        self.begin_stats()
 
-        best_move = random.sample(game.get_legal_moves(),1)[0]
+        best_move = random.choice(list(game.iter_legal_moves()))
 
         try:
-            return self.minimax(game, self.search_depth)
+            best_move = self.minimax(game, self.search_depth)
+            if self.stats is not None:
+                self.stats.depth_completed = self.search_depth
+            return best_move
 
         except SearchTimeout:
             return best_move
 
+        finally:
+            self.end_stats()
+
     # Minimax algorithm
     def minimax(self, game, depth):
+        stats = self.stats
+        clock = self.search_clock()
+        score, apply_move, undo_move = self.search_ops()
+        legal_moves = Jaipur.get_legal_moves if stats is None else lambda state: self._timed_call(state.get_legal_moves)
 
         # Best move on the current player's choice
         def max_value(state, current_depth):
-            if self.time_left() < self.TIMER_THRESHOLD:
-                raise SearchTimeout
-            if not state.get_legal_moves() or current_depth >= depth:
-                return self.score(state, self)
+            clock.countdown -= 1
+            if clock.countdown <= 0:
+                clock.poll()
+            if stats is not None:
+                stats.nodes += 1
+            if not legal_moves(state) or current_depth >= depth:
+                if stats is not None:
+                    stats.leaves += 1
+                return score(state, self)
 
             v = float("-inf")
 
-            for a in state.get_legal_moves():
-                v = max(v, min_value(forecast_move(state, a), current_depth + 1))
+            for a in legal_moves(state):
+                apply_move(state, a)
+                try:
+                    v = max(v, min_value(state, current_depth + 1))
+                finally:
+                    undo_move(state)
 
             return v
 
         # Worst move on the opponent player's choice
         def min_value(state, current_depth):
-            if self.time_left() < self.TIMER_THRESHOLD:
-                raise SearchTimeout
-            if not state.get_legal_moves() or current_depth >= depth:
-                return self.score(state, self)
+            clock.countdown -= 1
+            if clock.countdown <= 0:
+                clock.poll()
+            if stats is not None:
+                stats.nodes += 1
+            if not legal_moves(state) or current_depth >= depth:
+                if stats is not None:
+                    stats.leaves += 1
+                return score(state, self)
 
             v = float("inf")
 
-            for a in state.get_legal_moves():
-                v = min(v, max_value(forecast_move(state, a), current_depth + 1))
+            for a in legal_moves(state):
+                apply_move(state, a)
+                try:
+                    v = min(v, max_value(state, current_depth + 1))
+                finally:
+                    undo_move(state)
 
             return v
 
         # Return best move from root
-        argmax_fn = lambda x: min_value(forecast_move(game, x), 1)
+        def argmax_fn(move):
+            apply_move(game, move)
+            try:
+                return min_value(game, 1)
+            finally:
+                undo_move(game)
+
+        if stats is not None:
+            stats.nodes += 1
 
         best_action = None
         best_value = float("-inf")
@@ -119,57 +388,390 @@ class MinimaxPlayer(JaipurPlayer):
         if not game.get_legal_moves():
             return best_action
 
-        return max(game.get_legal_moves(), key = argmax_fn)
+        return max(game.iter_legal_moves(), key = argmax_fn)
 
 class AlphaBetaPlayer(JaipurPlayer):
+    # Endgame memo entries kept before it is cleared
+    ENDGAME_MEMO_ENTRIES = 1 << 20
+
+    # Cores needed to ponder, one for the game and one for the ponder worker
+    PONDER_CORES = 2
 
-    def __init__(self, search_depth=3, score_fn=None, timeout=10.):
-        JaipurPlayer.__init__(self, search_depth, score_fn, timeout)
+    # Table entries the ponder worker hands back on a ponder hit, the deepest first
+    PONDER_TT_ENTRIES = 4096
+
+    # tt_mb caps the memory of the transposition table, None turns it off
+    # With ponder the player keeps searching in another process on the opponent's time, see start_pondering
+    # With more than one worker the root moves are searched in a process pool, see search_in_pool
+    # Once the deck is down to endgame_cards the rest of the game is solved instead, see solve_endgame
+    def __init__(self, search_depth=3, score_fn=None, timeout=10., tt_mb=16, collect_stats=False, ponder=False,
+                 workers=1, endgame_cards=2):
+        JaipurPlayer.__init__(self, search_depth, score_fn, timeout, collect_stats)
         self.name = 'AlphaBeta{}'.format(score_fn.__name__[-1])
+        self.tt_mb = tt_mb
+        self.tt = TranspositionTable(tt_mb) if tt_mb else None
+        self.root_value = None
+
+        # Move ordering state carried between iterations of a search
+        self.pv = []
+        self.killers = []
+        self.history = {kind: {} for kind in ('Sell', 'Exchange', 'Take', 'Camels')}
+
+        # The predicted reply being pondered and whether it was played, with the ponder worker and its search
+        self.ponder = ponder
+        self.ponder_move = None
+        self.ponder_hit = False
+        self._ponder_pool = None
+        self._ponder_shared = None
+        self._ponder_future = None
+
+        # Root search pool, started by the first parallel search and kept until close
+        self.workers = workers
+        self._pool = None
+        self._pool_shared = None
+
+        # Endgame values keyed by Zobrist hash, kept for the rest of the game
+        self.endgame_cards = endgame_cards
+        self.endgame_memo = {}
+
+    # The pool and the clock of the last move stay behind when sent to another process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = state['_pool_shared'] = None
+        state['_ponder_pool'] = state['_ponder_shared'] = state['_ponder_future'] = None
+        state['time_left'] = state['clock'] = None
+        state['endgame_memo'] = {}
+        return state
+
+    def close(self):
+        self.stop_pondering()
+        self.close_ponder_pool()
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = self._pool_shared = None
+
+    # Reset the move ordering state for a search of a new position
+    def new_search(self):
+        if self.tt is not None:
+            self.tt.new_search()
+
+        # Keep the history from earlier moves at half weight
+        self.pv = []
+        self.killers = []
+        for table in self.history.values():
+            for move in table:
+                table[move] //= 2
 
     def get_move(self, game, time_left):
 
-        best_move = random.sample(game.get_legal_moves(),1)[0]
+        # A finished or cancelled ponder on the reply that was played gives the first depths for free,
+        # and its deepest table entries
+        result = self.stop_pondering()
+
+        best_move = random.choice(list(game.iter_legal_moves()))
         self.time_left = time_left
+        self.begin_stats()
+        stats = self.stats
+        clock = self.search_clock()
+
+        first_depth = 1
+        endgame = self.in_endgame(game)
+        self.new_search()
+        if result is not None and not endgame and game.is_legal_move(result[1]):
+            first_depth, best_move, self.pv = result[0] + 1, result[1], result[2]
+            if self.tt is not None:
+                for entry in result[3]:
+                    self.tt.store(*entry)
+        if stats is not None:
+            stats.depth_completed = first_depth - 1
 
+        # Deepen while the next iteration is expected to finish, an iteration costs about
+        # the previous one times the branching factor seen between the last two
         depth = 20
-        for d in range(1, depth):
-            try:
-                best_move = self.alphabeta(game, d)
-            except SearchTimeout:
-                return best_move
+        prev_nodes = None
+        try:
+            for d in range(first_depth, depth):
+                start, start_left, start_nodes = timeit.default_timer(), time_left(), clock.count()
+                if endgame:
+                    best_move, _, solved = self.solve_endgame(game, d)
+                else:
+                    best_move = self.alphabeta(game, d)
+                spent, nodes = start_left - time_left(), clock.count() - start_nodes
+                if stats is not None:
+                    stats.depth_completed = d
+                    stats.depth_times.append(timeit.default_timer() - start)
+
+                if endgame and solved:
+                    break
+                if prev_nodes is not None and spent * max(nodes / prev_nodes, 1) > time_left() - clock.reserve():
+                    break
+                prev_nodes = max(nodes, 1)
+        except SearchTimeout:
+            pass
+        finally:
+            self.end_stats()
+
+        return best_move
+
+    def observe_move(self, game, move, player):
+        if player == self.name:
+            if self.ponder:
+                self.start_pondering(game)
+        else:
+            self.ponder_hit = self._ponder_future is not None and move == self.ponder_move
+
+    def observe_end(self, game):
+        self.stop_pondering()
+        self.close_ponder_pool()
+        self.endgame_memo.clear()
+
+    # Search the position after the predicted reply in a worker process, with its own table kept between moves
+    # On a ponder hit the worker's deepest entries are copied into this player's table, see _ponder_search
+    # The reply is the second move of the principal variation, or the table's move after our own
+    # A thread would hold the GIL and take its time from an opponent searching in the same process,
+    # a process only takes a spare core, so there's no pondering without PONDER_CORES
+    def start_pondering(self, game):
+        self.stop_pondering()
+        if (os.cpu_count() or 1) < self.PONDER_CORES:
+            return
+        reply = self.pv[1] if len(self.pv) > 1 else None
+        if reply is None and self.tt is not None:
+            entry = self.tt.probe(game.zobrist_hash)
+            reply = entry[4] if entry is not None else None
+        if reply is None or not game.is_legal_move(reply):
+            return
+
+        game.apply_move(reply)
+        if not game.has_legal_moves():
+            return
+
+        pool, shared = self.ponder_pool()
+        with shared.get_lock():
+            shared[0] += 1
+            shared[1] = 0
+            ponder_id = shared[0]
 
-    def alphabeta(self, game, depth, alpha=float("-inf"), beta=float("inf")):
+        # The agents aren't needed to search, and hold this player with its pool
+        game.agents = {}
+        spec = (self.score, self.name, self.TIMER_THRESHOLD, self.tt_mb)
+        self.ponder_move = reply
+        self._ponder_future = pool.submit(_ponder_search, spec, game, ponder_id)
 
-        def max_value(state, alpha=float("-inf"), beta=float("inf"), current_depth=1):
-            if self.time_left() <  self.TIMER_THRESHOLD:
-                raise SearchTimeout
-            if not state.get_legal_moves() or current_depth >= depth:
-                return self.score(state, self)
+    # Start the ponder worker with a shared (ponder id, depth completed, id of the ponder hit) triple,
+    # a new id stops the search
+    # The worker inherits this process's cores, so a game pinned to a core by a tournament stays on it
+    def ponder_pool(self):
+        if self._ponder_pool is None:
+            self._ponder_shared = multiprocessing.Array('d', 3)
+            self._ponder_pool = ProcessPoolExecutor(max_workers=1, initializer=_init_ponder_worker,
+                                                    initargs=(self._ponder_shared,))
+        return self._ponder_pool, self._ponder_shared
 
+    def close_ponder_pool(self):
+        if self._ponder_pool is not None:
+            self._ponder_pool.shutdown(cancel_futures=True)
+            self._ponder_pool = self._ponder_shared = None
+
+    # Cancel pondering, returning the deepest result if the predicted reply was played
+    def stop_pondering(self):
+        if self._ponder_future is None:
+            return None
+        shared = self._ponder_shared
+        with shared.get_lock():
+            if self.ponder_hit:
+                shared[2] = shared[0]
+            shared[0] += 1
+        result = self._ponder_future.result()
+
+        result = result if self.ponder_hit else None
+        self._ponder_future = None
+        self.ponder_move = None
+        self.ponder_hit = False
+        return result
+
+    # Principal variation, table and killer moves first, the rest by history and static score
+    def order_moves(self, moves, ply, pv_move, tt_move):
+        first = []
+        for move in (pv_move, tt_move, self.killers[ply][0], self.killers[ply][1]):
+            if move is not None and move in moves and move not in first:
+                first.append(move)
+
+        history = self.history
+        rest = sorted((move for move in moves if move not in first),
+                      key=lambda move: history[move[0]].get(move, 0) + static_move_score(move), reverse=True)
+        return first + rest
+
+    # Lazy version of order_moves for inner nodes, so a cutoff skips generating the later stages
+    # Each stage of iter_legal_moves is sorted on its own, exchanges one size at a time
+    def staged_moves(self, state, ply, pv_move, tt_move):
+        first = []
+        for move in (pv_move, tt_move, self.killers[ply][0], self.killers[ply][1]):
+            if move is not None and move not in first and state.is_legal_move(move):
+                first.append(move)
+                yield move
+
+        history = self.history
+        score = lambda move: history[move[0]].get(move, 0) + static_move_score(move)
+        for _, batch in groupby(state.iter_legal_moves(), key=move_stage):
+            for move in sorted(batch, key=score, reverse=True):
+                if move not in first:
+                    yield move
+
+    # Remember a move that caused a cutoff at this ply
+    def record_cutoff(self, move, ply, remaining):
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        table = self.history[move[0]]
+        table[move] = table.get(move, 0) + remaining * remaining
+        if self.stats is not None:
+            self.stats.cutoffs += 1
+
+    # root_moves limits the root to the moves given, searched in that order
+    # A score function with a score_batch method, see jaipur_eval, scores all the leaves below a node at once
+    def alphabeta(self, game, depth, alpha=float("-inf"), beta=float("inf"), root_moves=None):
+        tt = self.tt
+        pv = self.pv
+        stats = self.stats
+        clock = self.search_clock()
+        score, apply_move, undo_move = self.search_ops()
+        score_batch = getattr(self.score, 'score_batch', None)
+        if stats is None:
+            has_legal_moves, staged_moves = Jaipur.has_legal_moves, self.staged_moves
+        else:
+            has_legal_moves = lambda state: self._timed_call(state.has_legal_moves)
+            staged_moves = lambda *args: self._timed_moves(self.staged_moves(*args))
+        pv_table = [[] for _ in range(depth + 1)]
+        while len(self.killers) <= depth:
+            self.killers.append([None, None])
+
+        # Look up the state, returning a usable value or None and the stored best move
+        def probe(state, alpha, beta, remaining):
+            entry = tt.probe(state.zobrist_hash)
+            if entry is None:
+                return None, None
+            if entry[1] >= remaining:
+                value, bound = entry[2], entry[3]
+                if bound == EXACT or (bound == LOWER and value >= beta) or (bound == UPPER and value <= alpha):
+                    if stats is not None:
+                        stats.tt_cutoffs += 1
+                    return value, entry[4]
+            return None, entry[4]
+
+        # Value and best move of a node whose children are all leaves, scored in one batch
+        # Every child is scored so there are no cutoffs, the value is exact rather than a bound
+        def frontier(state, current_depth, pv_move, tt_move, maximizing):
+            moves = list(staged_moves(state, current_depth, pv_move, tt_move))
+            values = score_batch(state, self, moves, apply_move, undo_move)
+            clock.countdown -= len(moves)
+            if stats is not None:
+                stats.nodes += len(moves)
+                stats.leaves += len(moves)
+                stats.evaluations += len(moves)
+
+            best = max if maximizing else min
+            i = values.index(best(values))
+            pv_table[current_depth] = [moves[i]]
+            return values[i], moves[i]
+
+        def max_value(state, alpha=float("-inf"), beta=float("inf"), current_depth=1, on_pv=False):
+            clock.countdown -= 1
+            if clock.countdown <= 0:
+                clock.poll()
+            pv_table[current_depth] = []
+            if stats is not None:
+                stats.nodes += 1
+            if current_depth >= depth or not has_legal_moves(state):
+                if stats is not None:
+                    stats.leaves += 1
+                return score(state, self)
+
+            tt_move = None
+            if tt is not None and not on_pv:
+                value, tt_move = probe(state, alpha, beta, depth - current_depth)
+                if value is not None:
+                    return value
+
+            pv_move = pv[current_depth] if on_pv and current_depth < len(pv) else None
+            alpha_start = alpha
             v = float("-inf")
+            best_move = None
+            if score_batch is not None and current_depth + 1 >= depth:
+                v, best_move = frontier(state, current_depth, pv_move, tt_move, True)
+                if v >= beta:
+                    self.record_cutoff(best_move, current_depth, depth - current_depth)
+                moves = ()
+            else:
+                moves = staged_moves(state, current_depth, pv_move, tt_move)
 
-            for move in state.get_legal_moves():
-                v = max(v, min_value(forecast_move(state, move), alpha, beta, current_depth + 1))
+            for move in moves:
+                apply_move(state, move)
+                try:
+                    v_move = min_value(state, alpha, beta, current_depth + 1, move == pv_move)
+                finally:
+                    undo_move(state)
+                if v_move > v or best_move is None:
+                    v, best_move = v_move, move
+                    pv_table[current_depth] = [move] + pv_table[current_depth + 1]
                 if v >= beta:
-                    return v
+                    self.record_cutoff(move, current_depth, depth - current_depth)
+                    break
                 alpha = max(alpha, v)
+
+            if tt is not None:
+                bound = LOWER if v >= beta else UPPER if v <= alpha_start else EXACT
+                tt.store(state.zobrist_hash, depth - current_depth, v, bound, best_move)
             return v
 
-        def min_value(state, alpha=float("-inf"), beta=float("inf"), current_depth=1):
-            if self.time_left() < self.TIMER_THRESHOLD:
-                raise SearchTimeout
-            if not state.get_legal_moves() or current_depth >= depth:
-                return self.score(state, self)
+        def min_value(state, alpha=float("-inf"), beta=float("inf"), current_depth=1, on_pv=False):
+            clock.countdown -= 1
+            if clock.countdown <= 0:
+                clock.poll()
+            pv_table[current_depth] = []
+            if stats is not None:
+                stats.nodes += 1
+            if current_depth >= depth or not has_legal_moves(state):
+                if stats is not None:
+                    stats.leaves += 1
+                return score(state, self)
+
+            tt_move = None
+            if tt is not None and not on_pv:
+                value, tt_move = probe(state, alpha, beta, depth - current_depth)
+                if value is not None:
+                    return value
 
+            pv_move = pv[current_depth] if on_pv and current_depth < len(pv) else None
+            beta_start = beta
             v = float("inf")
+            best_move = None
+            if score_batch is not None and current_depth + 1 >= depth:
+                v, best_move = frontier(state, current_depth, pv_move, tt_move, False)
+                if v <= alpha:
+                    self.record_cutoff(best_move, current_depth, depth - current_depth)
+                moves = ()
+            else:
+                moves = staged_moves(state, current_depth, pv_move, tt_move)
 
-            for move in state.get_legal_moves():
-                v = min(v, max_value(forecast_move(state, move), alpha, beta, current_depth + 1))
+            for move in moves:
+                apply_move(state, move)
+                try:
+                    v_move = max_value(state, alpha, beta, current_depth + 1, move == pv_move)
+                finally:
+                    undo_move(state)
+                if v_move < v or best_move is None:
+                    v, best_move = v_move, move
+                    pv_table[current_depth] = [move] + pv_table[current_depth + 1]
 
                 if v <= alpha:
-                    return v
+                    self.record_cutoff(move, current_depth, depth - current_depth)
+                    break
                 beta = min(beta, v)
+
+            if tt is not None:
+                bound = UPPER if v <= alpha else LOWER if v >= beta_start else EXACT
+                tt.store(state.zobrist_hash, depth - current_depth, v, bound, best_move)
             return v
 
         root_legal_moves = game.get_legal_moves()
@@ -177,17 +779,628 @@ class AlphaBetaPlayer(JaipurPlayer):
         if not root_legal_moves:
             return None
 
-        best_action = list(root_legal_moves)[0]
+        # Search the principal variation of the previous iteration first
+        tt_move = None
+        if tt is not None:
+            entry = tt.probe(game.zobrist_hash)
+            tt_move = entry[4] if entry is not None else None
+        pv_move = pv[0] if pv else None
+
+        best_action = None
         best_v = alpha
+        if stats is not None:
+            stats.nodes += 1
 
-        for move in root_legal_moves:
-            v_test = min_value(forecast_move(game, move), alpha, beta, 1)
-            if v_test > best_v:
+        # With workers only the eldest move is searched here, the rest go to the pool with its value as alpha
+        moves = root_moves or self.order_moves(list(game.iter_legal_moves()), 0, pv_move, tt_move)
+        parallel = self.workers > 1 and root_moves is None and depth > 1 and len(moves) > 1
+        for move in moves[:1] if parallel else moves:
+            apply_move(game, move)
+            try:
+                v_test = min_value(game, alpha, beta, 1, move == pv_move)
+            finally:
+                undo_move(game)
+            if v_test > best_v or best_action is None:
                 best_action = move
                 best_v = float(v_test)
+                alpha = max(alpha, best_v)
+                pv_table[0] = [move] + pv_table[1]
+
+        if parallel:
+            # A move that failed low against a worker's alpha is no better than the move that set it
+            for move, v_test, move_pv, move_alpha in self.search_in_pool(game, moves[1:], depth, alpha, beta):
+                if v_test > best_v and v_test > move_alpha:
+                    best_action, best_v, pv_table[0] = move, float(v_test), move_pv
+
+        if tt is not None and root_moves is None:
+            tt.store(game.zobrist_hash, depth, best_v, EXACT, best_action)
 
+        self.pv = pv_table[0]
+        self.root_value = best_v
         return best_action
 
+    # The deck is nearly gone, or two goods piles are empty and a third is nearly sold out
+    def in_endgame(self, game):
+        cards = self.endgame_cards
+        if not cards:
+            return False
+        if len(game.deck) <= cards:
+            return True
+        return game.depleted_piles() >= 2 and min(len(pile) for pile in game.goods_tokens.values() if pile) <= cards
+
+    # Alpha-beta to the end of the game scored by the final score difference, camel and bonus tokens included
+    # Exchanges can put the end off for ever, so the search stops at max_plies and scores the state as it stands
+    # Returns the best move, its value and whether the value is exact, no line having reached the cap
+    # Values of subtrees where every line ended are kept in the memo for any cap, the others for caps as low
+    def solve_endgame(self, game, max_plies):
+        memo = self.endgame_memo
+        if len(memo) > self.ENDGAME_MEMO_ENTRIES:
+            memo.clear()
+        stats = self.stats
+        clock = self.search_clock()
+        me = self.name
+        opponent = game.player2 if game.player1 == me else game.player1
+
+        # Memo move first, then by static score
+        def ordered_moves(state, memo_move):
+            moves = sorted(state.iter_legal_moves(), key=static_move_score, reverse=True)
+            if memo_move is not None and memo_move in moves:
+                moves.remove(memo_move)
+                moves.insert(0, memo_move)
+            return moves
+
+        # Value of the state and whether it is exact
+        def value(state, alpha, beta, remaining):
+            clock.countdown -= 1
+            if clock.countdown <= 0:
+                clock.poll()
+            if stats is not None:
+                stats.nodes += 1
+            over = state.is_terminal or not state.has_legal_moves()
+            if over or not remaining:
+                if stats is not None:
+                    stats.leaves += 1
+                return state.total_score(me) - state.total_score(opponent), over
+
+            key = state.zobrist_hash
+            entry = memo.get(key)
+            memo_move = None
+            if entry is not None:
+                depth, v, bound, memo_move = entry
+                if depth >= remaining and (bound == EXACT or (bound == LOWER and v >= beta)
+                                           or (bound == UPPER and v <= alpha)):
+                    if stats is not None:
+                        stats.tt_cutoffs += 1
+                    return v, depth == math.inf
+
+            maximizing = state.active_player == me
+            alpha_start, beta_start = alpha, beta
+            best_v, best_move, solved = None, None, True
+            for move in ordered_moves(state, memo_move):
+                Jaipur.apply_move(state, move)
+                try:
+                    v, exact = value(state, alpha, beta, remaining - 1)
+                finally:
+                    Jaipur.undo_move(state)
+                solved = solved and exact
+                if best_move is None or (v > best_v if maximizing else v < best_v):
+                    best_v, best_move = v, move
+                if maximizing:
+                    alpha = max(alpha, v)
+                else:
+                    beta = min(beta, v)
+                if alpha >= beta:
+                    if stats is not None:
+                        stats.cutoffs += 1
+                    break
+
+            bound = LOWER if best_v >= beta_start else UPPER if best_v <= alpha_start else EXACT
+            memo[key] = (math.inf if solved else remaining, best_v, bound, best_move)
+            return best_v, solved
+
+        entry = memo.get(game.zobrist_hash)
+        best_move, best_v, solved = None, float("-inf"), True
+        if stats is not None:
+            stats.nodes += 1
+        for move in ordered_moves(game, entry[3] if entry is not None else None):
+            Jaipur.apply_move(game, move)
+            try:
+                v, exact = value(game, best_v, float("inf"), max_plies - 1)
+            finally:
+                Jaipur.undo_move(game)
+            solved = solved and exact
+            if best_move is None or v > best_v:
+                best_move, best_v = move, v
+
+        memo[game.zobrist_hash] = (math.inf if solved else max_plies, best_v, EXACT, best_move)
+        self.pv = [best_move]
+        self.root_value = best_v
+        return best_move, best_v, solved
+
+    # Start the pool with a shared (search id, alpha) pair the workers read and raise
+    def root_pool(self):
+        if self._pool is None:
+            self._pool_shared = multiprocessing.Array('d', 2)
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_root_worker,
+                                             initargs=(self._pool_shared,))
+        return self._pool, self._pool_shared
+
+    # Search each root move in a worker, a move starts with the best alpha any worker has found so far
+    # Workers stop at the same deadline as this search, a missing result means the depth wasn't finished
+    # Returns (move, value, principal variation, alpha it was searched with) for every move
+    def search_in_pool(self, game, moves, depth, alpha, beta):
+        pool, shared = self.root_pool()
+        clock = self.search_clock()
+        with shared.get_lock():
+            shared[0] += 1
+            shared[1] = alpha
+            search_id = shared[0]
+
+        # The agents aren't needed to search, and hold this player with its table
+        game = game.board_copy()
+        game.agents = {}
+        deadline = time.time() + (self.time_left() - clock.reserve()) / 1000
+        spec = (self.score, self.name, self.TIMER_THRESHOLD, self.tt_mb)
+        pending = {pool.submit(_search_root_move, spec, game, move, depth, beta, search_id, deadline, self.pv)
+                   for move in moves}
+
+        results = []
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=clock.poll_ms / 1000, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result is None:
+                        raise SearchTimeout
+                    results.append(result[:4])
+                    if self.stats is not None:
+                        self.stats.nodes += result[4]
+                if pending and self.time_left() < clock.reserve():
+                    raise SearchTimeout
+        finally:
+            # A new search id stops any worker still searching for this one
+            with shared.get_lock():
+                if shared[0] == search_id:
+                    shared[0] += 1
+            for future in pending:
+                future.cancel()
+        return results
+
+# Root search workers keep a player per searching agent, so their tables last from one move to the next
+_root_players = {}
+_root_shared = None
+
+def _init_root_worker(shared):
+    global _root_shared
+    _root_shared = shared
+
+# Search one root move in a worker, None if the search was stopped or ran out of time
+def _search_root_move(spec, game, move, depth, beta, search_id, deadline, pv):
+    shared = _root_shared
+    score_fn, name, timeout, tt_mb = spec
+    player, key = _root_players.get(spec, (None, None))
+    if player is None:
+        player = AlphaBetaPlayer(score_fn=score_fn, timeout=timeout, tt_mb=tt_mb)
+        player.name = name
+    if key != game.zobrist_hash:
+        player.new_search()
+    _root_players[spec] = (player, game.zobrist_hash)
+
+    player.time_left = lambda: -1. if shared[0] != search_id else 1000 * (deadline - time.time())
+    player.pv = pv if pv and pv[0] == move else []
+    alpha = shared[1]
+    if shared[0] != search_id:
+        return None
+
+    clock = player.search_clock()
+    start = clock.count()
+    try:
+        player.alphabeta(game, depth, alpha, beta, root_moves=[move])
+    except SearchTimeout:
+        return None
+
+    with shared.get_lock():
+        if shared[0] == search_id and player.root_value > shared[1]:
+            shared[1] = player.root_value
+    return move, player.root_value, player.pv, alpha, clock.count() - start
+
+# The ponder worker keeps a player per pondering agent, and the (ponder id, depth completed, hit id) triple
+_ponder_players = {}
+_ponder_shared = None
+
+def _init_ponder_worker(shared):
+    global _ponder_shared
+    _ponder_shared = shared
+
+# Deepen until a new ponder id stops the search, returning the deepest (depth, move, principal variation, entries)
+# On a ponder hit the entries are the deepest ones this search stored, as store arguments, so the timed search
+# starts with the ordering and bounds near the root, otherwise there are none as they would be thrown away
+# The clock counts down from an hour so polling adapts as in a timed search
+def _ponder_search(spec, game, ponder_id):
+    shared = _ponder_shared
+    score_fn, name, timeout, tt_mb = spec
+    player = _ponder_players.get(spec)
+    if player is None:
+        player = _ponder_players[spec] = AlphaBetaPlayer(score_fn=score_fn, timeout=timeout, tt_mb=tt_mb)
+        player.name = name
+
+    start = timeit.default_timer()
+    player.time_left = lambda: -1. if shared[0] != ponder_id else 3.6e6 - 1000 * (timeit.default_timer() - start)
+    player.clock = None
+    player.new_search()
+    result = None
+    try:
+        for d in range(1, 20):
+            best_move = player.alphabeta(game, d)
+            result = (d, best_move, player.pv)
+            shared[1] = d
+    except SearchTimeout:
+        pass
+
+    entries = []
+    tt = player.tt
+    if result is not None and shared[2] == ponder_id and tt is not None:
+        stored = [entry for entry in tt.table if entry is not None and entry[5] == tt.generation]
+        stored.sort(key=lambda entry: entry[1], reverse=True)
+        entries = [entry[:5] for entry in stored[:AlphaBetaPlayer.PONDER_TT_ENTRIES]]
+    return result + (entries,) if result is not None else None
+
+# Rollout policies for MCTSPlayer, each picks a move for the active player of a game played out in place
+# Exchanges outnumber the other moves by far and are slow to list, so they're only played when nothing else is legal
+def random_rollout(game):
+    move = game.random_move()
+    if move is None:
+        moves = list(game.iter_legal_moves(order=('Exchange',)))
+        move = random.choice(moves) if moves else None
+    return move
+
+# Sell the most cards possible like GreedyPlayer, random moves otherwise
+def greedy_rollout(game):
+    sells = list(game.iter_legal_moves(order=('Sell',)))
+    if sells:
+        return max(sells, key=lambda move: move[2])
+    return random_rollout(game)
+
+# A move in the search tree, with the wins of the player who made it
+# avails counts the playouts in which the move was legal, the sampled hands decide which moves are
+class MCTSNode:
+    __slots__ = ('player', 'children', 'visits', 'wins', 'avails')
+
+    def __init__(self, player=None):
+        self.player = player
+        self.children = {}
+        self.visits = 0
+        self.wins = 0.
+        self.avails = 1
+
+# Information set Monte Carlo tree search
+# Every playout deals the deck and the opponent's hand again from the unseen cards, so the search doesn't
+# see hidden cards the way the minimax players do. The tree for the position after the moves
+# observed since the last turn is kept and searched further
+class MCTSPlayer(JaipurPlayer):
+
+    def __init__(self, name='MCTS', rollout=random_rollout, exploration=0.7, timeout=10., max_playouts=None,
+                 collect_stats=False):
+        JaipurPlayer.__init__(self, timeout=timeout, collect_stats=collect_stats)
+        self.name = name
+        self.rollout = rollout
+        self.exploration = exploration
+        self.max_playouts = max_playouts
+
+        # Root of the tree and the moves played from it since
+        self.root = None
+        self.played = []
+
+    def observe_move(self, game, move, player):
+        self.played.append(move)
+
+    def observe_end(self, game):
+        self.root = None
+        self.played = []
+
+    # Root for the current position, the subtree of the moves played since the last search if there is one
+    def reuse_tree(self):
+        root = self.root
+        for move in self.played:
+            if root is None:
+                break
+            root = root.children.get(move)
+        self.played = []
+        return root if root is not None else MCTSNode()
+
+    def get_move(self, game, time_left):
+        self.time_left = time_left
+        self.begin_stats()
+        clock = self.search_clock()
+        root = self.reuse_tree()
+
+        playouts = 0
+        try:
+            # The clock is read after a playout, so the first read times one
+            while self.max_playouts is None or playouts < self.max_playouts:
+                self.playout(root, game.determinize())
+                playouts += 1
+                clock.countdown -= 1
+                if clock.countdown <= 0:
+                    clock.poll()
+        except SearchTimeout:
+            pass
+        finally:
+            if self.stats is not None:
+                self.stats.nodes += playouts
+                self.stats.leaves += playouts
+            self.end_stats()
+
+        # The most visited move that is legal in the real game
+        self.root = root
+        visited = [(child.visits, move) for move, child in root.children.items() if game.is_legal_move(move)]
+        if visited:
+            return max(visited, key=lambda visit: visit[0])[1]
+        return random.choice(list(game.iter_legal_moves()))
+
+    # Select and expand one path of the tree on a determinized game, play the rest out and back up the result
+    def playout(self, root, game):
+        node = root
+        path = [root]
+        exploration = self.exploration
+
+        while not game.game_over():
+            legal = game.get_legal_moves()
+            if not legal:
+                break
+
+            children = node.children
+            for move, child in children.items():
+                if move in legal:
+                    child.avails += 1
+
+            # Untried moves are listed in generation order so seeded searches repeat
+            if any(move not in children for move in legal):
+                untried = [move for move in game.iter_legal_moves() if move not in children]
+                move = random.choice(untried)
+                node = children[move] = MCTSNode(game.active_player)
+                path.append(node)
+                game.apply_move(move)
+                break
+
+            # UCB over the moves legal in this deal
+            best, best_ucb = None, float('-inf')
+            for move, child in children.items():
+                if move in legal:
+                    ucb = child.wins / child.visits + exploration * math.sqrt(math.log(child.avails) / child.visits)
+                    if ucb > best_ucb:
+                        best, best_ucb = move, ucb
+            node = children[best]
+            path.append(node)
+            game.apply_move(best)
+
+        # Play the game out in place
+        rollout = self.rollout
+        while not game.game_over():
+            move = rollout(game)
+            if move is None:
+                break
+            game.apply_move(move)
+
+        score1, score2 = game.total_score(game.name1), game.total_score(game.name2)
+        rewards = {game.name1: 1. if score1 > score2 else .5 if score1 == score2 else 0.}
+        rewards[game.name2] = 1. - rewards[game.name1]
+
+        root.visits += 1
+        for node in path[1:]:
+            node.visits += 1
+            node.wins += rewards[node.player]
+
+# Every multiset of k cards that can be drawn from a deck with the counts given, with its probability
+# Draws of the same goods in another order are the same outcome, so they're counted once by multiplicity
+@lru_cache(maxsize=4096)
+def draw_outcomes(counts, k):
+    total = math.comb(sum(counts), k)
+    outcomes = []
+    for _, names in sub_multisets(counts, k)[k]:
+        goods = tuple(GOOD_INDEX[name] for name in names)
+        ways = 1
+        for g, n in Counter(goods).items():
+            ways *= math.comb(counts[g], n)
+        outcomes.append((ways / total, goods))
+    outcomes.sort(reverse=True)
+    return outcomes
+
+# Expectiminimax over the cards drawn from the deck, the other players take the draws as known
+# A move that draws is a chance node over the goods it could reveal, weighted by the counts left in the deck
+# Chance nodes are cut with Star1 bounds and Star2 probing, which need the evaluation clipped to bounds
+# Chance and player nodes share the transposition table, the deck order isn't in the hash
+class ExpectimaxPlayer(JaipurPlayer):
+
+    def __init__(self, search_depth=3, score_fn=None, timeout=10., tt_mb=16, bounds=(-1000., 1000.),
+                 collect_stats=False):
+        JaipurPlayer.__init__(self, search_depth, score_fn, timeout, collect_stats)
+        self.name = 'Expectimax{}'.format(score_fn.__name__[-1])
+        self.tt = TranspositionTable(tt_mb)
+        self.bounds = bounds
+        self.best_move = None
+
+    def get_move(self, game, time_left):
+        best_move = random.choice(list(game.iter_legal_moves()))
+        self.time_left = time_left
+        self.begin_stats()
+        stats = self.stats
+        clock = self.search_clock()
+        self.tt.new_search()
+        self.best_move = None
+
+        # Deepen while the next iteration is expected to finish, as AlphaBetaPlayer does
+        prev_nodes = None
+        try:
+            for d in range(1, 20):
+                start, start_left, start_nodes = timeit.default_timer(), time_left(), clock.count()
+                best_move = self.expectimax(game, d)
+                spent, nodes = start_left - time_left(), clock.count() - start_nodes
+                if stats is not None:
+                    stats.depth_completed = d
+                    stats.depth_times.append(timeit.default_timer() - start)
+
+                if prev_nodes is not None and spent * max(nodes / prev_nodes, 1) > time_left() - clock.reserve():
+                    break
+                prev_nodes = max(nodes, 1)
+        except SearchTimeout:
+            pass
+        finally:
+            self.end_stats()
+
+        return best_move
+
+    def expectimax(self, game, depth):
+        tt = self.tt
+        stats = self.stats
+        lo, hi = self.bounds
+        clock = self.search_clock()
+        score, apply_move, undo_move = self.search_ops()
+
+        # Value of the player to move, the search player maximizes and the opponent minimizes
+        # With probe only the first move is searched, a bound on the value from below or above
+        def value(state, remaining, alpha, beta, probe=False):
+            clock.countdown -= 1
+            if clock.countdown <= 0:
+                clock.poll()
+            if stats is not None:
+                stats.nodes += 1
+            if remaining <= 0 or state.is_terminal or not state.has_legal_moves():
+                if stats is not None:
+                    stats.leaves += 1
+                return min(max(score(state, self), lo), hi)
+
+            key = state.zobrist_hash
+            entry = tt.probe(key)
+            tt_move = None
+            if entry is not None:
+                tt_move = entry[4]
+                if entry[1] >= remaining:
+                    v, bound = entry[2], entry[3]
+                    if bound == EXACT or (bound == LOWER and v >= beta) or (bound == UPPER and v <= alpha):
+                        if stats is not None:
+                            stats.tt_cutoffs += 1
+                        return v
+
+            moves = sorted(state.iter_legal_moves(), key=static_move_score, reverse=True)
+            if tt_move in moves:
+                moves.remove(tt_move)
+                moves.insert(0, tt_move)
+            if probe:
+                moves = moves[:1]
+
+            maximizing = state.active_player == self.name
+            alpha_start, beta_start = alpha, beta
+            best, best_move = None, None
+            for move in moves:
+                v = chance(state, move, remaining - 1, alpha, beta)
+                if best is None or (v > best if maximizing else v < best):
+                    best, best_move = v, move
+                if maximizing:
+                    alpha = max(alpha, v)
+                else:
+                    beta = min(beta, v)
+                if alpha >= beta:
+                    if stats is not None:
+                        stats.cutoffs += 1
+                    break
+
+            if not probe:
+                bound = LOWER if best >= beta_start else UPPER if best <= alpha_start else EXACT
+                tt.store(key, remaining, best, bound, best_move)
+            return best
+
+        # Value of one outcome of a chance node
+        def outcome(state, move, goods, remaining, alpha, beta, probe=False):
+            deck = state.stack_deck(goods)
+            apply_move(state, move)
+            try:
+                return value(state, remaining, alpha, beta, probe)
+            finally:
+                undo_move(state)
+                state.restore_deck(deck)
+
+        # Expected value of a move over the cards it draws
+        def chance(state, move, remaining, alpha, beta):
+            draws = state.draws_for(move)
+            if not draws:
+                apply_move(state, move)
+                try:
+                    return value(state, remaining, alpha, beta)
+                finally:
+                    undo_move(state)
+
+            key = hash((state.zobrist_hash, move))
+            entry = tt.probe(key)
+            if entry is not None and entry[1] >= remaining:
+                v, bound = entry[2], entry[3]
+                if bound == EXACT or (bound == LOWER and v >= beta) or (bound == UPPER and v <= alpha):
+                    return v
+
+            outcomes = draw_outcomes(tuple(state.deck_counts()), draws)
+            v, bound = star2(state, move, outcomes, remaining, alpha, beta)
+            if v is None:
+                v, bound = star1(state, move, outcomes, remaining, alpha, beta)
+            tt.store(key, remaining, v, bound, None)
+            return v
+
+        # Probe the first move of every outcome, the player after the move is the one the probes bound
+        # The search player's probes bound from below and can prove a fail high, the opponent's from above
+        def star2(state, move, outcomes, remaining, alpha, beta):
+            next_max = state.active_player != self.name
+            total, left = 0., 1.
+            for p, goods in outcomes:
+                left -= p
+                if next_max:
+                    target = (beta - total - left * lo) / p
+                    v = outcome(state, move, goods, remaining, lo, min(target, hi), probe=True)
+                    total += p * v
+                    if v >= target:
+                        return total + left * lo, LOWER
+                else:
+                    target = (alpha - total - left * hi) / p
+                    v = outcome(state, move, goods, remaining, max(target, lo), hi, probe=True)
+                    total += p * v
+                    if v <= target:
+                        return total + left * hi, UPPER
+            return None, None
+
+        # Search the outcomes in turn, stopping once the outcomes left can't bring the value inside the window
+        def star1(state, move, outcomes, remaining, alpha, beta):
+            total, left = 0., 1.
+            for p, goods in outcomes:
+                left -= p
+                child_alpha = (alpha - total - left * hi) / p
+                child_beta = (beta - total - left * lo) / p
+                if child_alpha >= hi:
+                    return total + (p + left) * hi, UPPER
+                if child_beta <= lo:
+                    return total + (p + left) * lo, LOWER
+                v = outcome(state, move, goods, remaining, max(child_alpha, lo), min(child_beta, hi))
+                total += p * v
+                if v <= child_alpha:
+                    return total + left * hi, UPPER
+                if v >= child_beta:
+                    return total + left * lo, LOWER
+            return total, EXACT
+
+        if stats is not None:
+            stats.nodes += 1
+
+        # The best move of the previous depth first
+        moves = sorted(game.iter_legal_moves(), key=static_move_score, reverse=True)
+        if self.best_move in moves:
+            moves.remove(self.best_move)
+            moves.insert(0, self.best_move)
+
+        best_move, alpha = None, lo - 1
+        for move in moves:
+            v = chance(game, move, depth - 1, alpha, hi + 1)
+            if best_move is None or v > alpha:
+                best_move, alpha = move, v
+        self.best_move = best_move
+        return best_move
+
 # Return the score of the move that gives the most benefit to the player
 def custom_score_1(game, player):
 
@@ -196,10 +1409,7 @@ def custom_score_1(game, player):
     elif game.is_loser(player.name):
         return float("-inf")
 
-    moves = game.get_legal_moves()
-    current_points = game.visible_score(player.name)
-    point_differential = [forecast_move(game, move).visible_score(player.name) - current_points for move in moves]
-    return max(point_differential)
+    return max(delta for _, delta in game.move_score_deltas(player.name))
 
 # Return the number of sell actions the player has
 def custom_score_2(game, player):
@@ -0,0 +1,177 @@
+from jaipur import Jaipur, FEATURE_SIZE
+from jaipur_players import RandomPlayer, JewelPlayer, GreedyPlayer, AlphaBetaPlayer, MCTSPlayer, ExpectimaxPlayer
+from jaipur_players import custom_score_1, custom_score_2, custom_score_3
+from tournament import game_pool, TIME_LIMIT
+from concurrent.futures import wait, FIRST_COMPLETED
+import argparse
+import copy
+import os
+import random
+import numpy as np
+
+# Training data from games between two agents
+# Every position of a game becomes a row of Jaipur.features from the side of the player to move,
+# labelled with that player's final score margin, and the rows are streamed into compressed .npz shards
+
+# Agents that can be picked by name on the command line
+AGENTS = {
+    'random': RandomPlayer,
+    'greedy': GreedyPlayer,
+    'jewel': JewelPlayer,
+    'alphabeta1': lambda: AlphaBetaPlayer(score_fn=custom_score_1),
+    'alphabeta2': lambda: AlphaBetaPlayer(score_fn=custom_score_2),
+    'alphabeta3': lambda: AlphaBetaPlayer(score_fn=custom_score_3),
+    'mcts': MCTSPlayer,
+    'expectimax2': lambda: ExpectimaxPlayer(score_fn=custom_score_2),
+}
+
+# Rows in a full shard, a shard of 43 int16 features and the labels takes about 2.5MB before compression
+SHARD_ROWS = 25000
+
+# Play a seeded game and return the features of every position before a move, their labels and how it ended
+# Games cut short by a timeout or a bad move have no final margin, their rows are left out
+def play_selfplay_game(player1, player2, seed, time_limit=TIME_LIMIT):
+    random.seed(seed)
+    game = Jaipur(player1, player2)
+    _, _, termination = game.play(time_limit=time_limit, record=False)
+    if termination not in ('Player 1 wins', 'Player 2 wins', 'Draw'):
+        return np.zeros((0, FEATURE_SIZE), dtype=np.int16), np.zeros(0, dtype=np.int16), termination
+
+    # Walk back through the game, the margins are final so they can be read at the end
+    margin = game.total_score(game.name1) - game.total_score(game.name2)
+    n = len(game.moves_played())
+    features = np.zeros((n, FEATURE_SIZE), dtype=np.int16)
+    labels = np.zeros(n, dtype=np.int16)
+    for i in range(n - 1, -1, -1):
+        game.undo_move()
+        features[i] = game.features()
+        labels[i] = margin if game.active_player == game.name1 else -margin
+    return features, labels, termination
+
+# Collects rows into fixed size arrays and writes them out as numbered shards whenever they fill up,
+# so memory stays at one shard however many games are played
+# Shards already in the directory are kept, numbering carries on after them
+class ShardWriter:
+    def __init__(self, directory, prefix='selfplay', shard_rows=SHARD_ROWS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.shard_rows = shard_rows
+        self.features = np.zeros((shard_rows, FEATURE_SIZE), dtype=np.int16)
+        self.labels = np.zeros(shard_rows, dtype=np.int16)
+        self.seeds = np.zeros(shard_rows, dtype=np.int64)
+        self.rows = 0
+        self.index = 0
+        self.paths = []
+
+    # Add the rows of one game, seed is kept with every row so games can be split between training and testing
+    def add(self, features, labels, seed):
+        i = 0
+        while i < len(labels):
+            n = min(len(labels) - i, self.shard_rows - self.rows)
+            self.features[self.rows:self.rows + n] = features[i:i + n]
+            self.labels[self.rows:self.rows + n] = labels[i:i + n]
+            self.seeds[self.rows:self.rows + n] = seed
+            self.rows += n
+            i += n
+            if self.rows == self.shard_rows:
+                self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        path = self.next_path()
+        np.savez_compressed(path, features=self.features[:self.rows], labels=self.labels[:self.rows],
+                            seeds=self.seeds[:self.rows])
+        self.paths.append(path)
+        self.rows = 0
+
+    def next_path(self):
+        while True:
+            path = os.path.join(self.directory, '{}-{:05d}.npz'.format(self.prefix, self.index))
+            self.index += 1
+            if not os.path.exists(path):
+                return path
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# The two agents for the seats, an agent playing itself is copied under a second name as seats go by name
+# The copy is deep so the two sides keep their own search state, tables and trees aren't shared
+def seat_players(player1, player2):
+    if player1.name == player2.name:
+        player2 = copy.deepcopy(player2)
+        player2.name = player2.name + "'"
+    return player1, player2
+
+# Play games between the two agents and write their positions to shards in the directory
+# The agents swap seats every game, see seat_players
+# With more than one worker games are played in a process pool, a few games ahead of the writer
+# Returns the paths of the shards written and counts of the games, positions and games left out
+def generate(player1, player2, games, directory, workers=1, seed=None, shard_rows=SHARD_ROWS,
+             time_limit=TIME_LIMIT, prefix='selfplay'):
+    player1, player2 = seat_players(player1, player2)
+    rng = random.Random(seed)
+    schedule = (((player1, player2) if i % 2 == 0 else (player2, player1), rng.getrandbits(32))
+                for i in range(games))
+    counts = {'games': 0, 'positions': 0, 'skipped': 0}
+
+    with ShardWriter(directory, prefix, shard_rows) as shards:
+        def add(result, game_seed):
+            features, labels, termination = result
+            counts['games'] += 1
+            counts['positions'] += len(labels)
+            counts['skipped'] += 0 if len(labels) else 1
+            shards.add(features, labels, game_seed)
+
+        if workers > 1:
+            with game_pool(workers) as pool:
+                pending = {}
+                for players, game_seed in schedule:
+                    pending[pool.submit(play_selfplay_game, *players, game_seed, time_limit)] = game_seed
+                    if len(pending) >= 2 * workers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            add(future.result(), pending.pop(future))
+                for future in list(pending):
+                    add(future.result(), pending.pop(future))
+        else:
+            for players, game_seed in schedule:
+                add(play_selfplay_game(*players, game_seed, time_limit), game_seed)
+
+    return shards.paths, counts
+
+# Features, labels and seeds of all the shards given, concatenated
+def load_shards(paths):
+    data = [np.load(path) for path in paths]
+    return tuple(np.concatenate([d[name] for d in data]) for name in ('features', 'labels', 'seeds'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write self-play positions labelled with final score margins.")
+    parser.add_argument('players', nargs=2, choices=sorted(AGENTS), help="the two agents to play")
+    parser.add_argument('--games', type=int, default=100, help="games to play")
+    parser.add_argument('--out', default='selfplay', help="directory the shards are written to")
+    parser.add_argument('--workers', type=int, default=1, help="processes to play games in, one per core")
+    parser.add_argument('--seed', type=int, default=None, help="seed for the per-game seeds")
+    parser.add_argument('--shard-rows', type=int, default=SHARD_ROWS, help="positions per shard")
+    parser.add_argument('--time-limit', type=float, default=TIME_LIMIT, help="milliseconds per move")
+    parser.add_argument('--fit', default=None, help="fit a linear evaluator to the shards and save its weights here")
+    args = parser.parse_args()
+
+    paths, counts = generate(AGENTS[args.players[0]](), AGENTS[args.players[1]](), args.games, args.out,
+                             workers=args.workers, seed=args.seed, shard_rows=args.shard_rows,
+                             time_limit=args.time_limit)
+    print("{games} games, {positions} positions, {skipped} games left out".format(**counts))
+    print("\n".join(paths))
+
+    if args.fit:
+        from jaipur_eval import fit_linear
+        features, labels, _ = load_shards(paths)
+        fit_linear(features, labels).save(args.fit)
+        print("Weights saved to {}".format(args.fit))
@@ -1,6 +1,19 @@
 import unittest
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+import numpy as np
 import jaipur
-import jaipur_players
+import jaipur_players as players
+import jaipur_batch
+import jaipur_eval
+import jaipur_log
+import selfplay
+import tournament
+import benchmark
 
 class jaipurTest(unittest.TestCase):
     def test_check_hands(self):
@@ -37,7 +50,7 @@ class jaipurTest(unittest.TestCase):
             self.assertTrue(card in j.hands[j.player1])
 
         # Create arbitrary hand to test the hand limit
-        j.hands[j.player1] = [1,1,1,1,1,1,1]
+        j.hands[j.player1] = ['Leather'] * 7
         card = j.market[0]
         self.assertRaises(Exception, j.take_card(card))
 
@@ -77,7 +90,7 @@ class jaipurTest(unittest.TestCase):
         j.sell_cards('Cloth', 3)
         self.assertTrue('Cloth' in j.discard_pile)
         self.assertTrue('Cloth' not in j.hands[j.player1])
-        self.assertEqual(len(j.tokens[j.player1]), 4) # 3 goods tokens and 1 bonus token for p1
+        self.assertEqual(sum(map(len, j.tokens[j.player1])), 4) # 3 goods tokens and 1 bonus token for p1
         self.assertEqual(len(j.goods_tokens['Cloth']), start_cloth_tokens - 3) # 3 less cloth tokens
         self.assertEqual(len(j.bonus_tokens[3]), start_triple_tokens - 1) # 1 less triple token
 
@@ -99,20 +112,689 @@ class jaipurTest(unittest.TestCase):
         card2 = j.market[0]
         j.take_card(card2)
         if card2 == 'Camel':
-            self.assertTrue(card in j.herds[j.player2])
+            self.assertTrue(card2 in j.herds[j.player2])
         else:
-            self.assertTrue(card in j.hands[j.player2])
+            self.assertTrue(card2 in j.hands[j.player2])
 
         self.assertEqual(len(j.market), 5) 
 
     # Test if the copy returns a new instance
     def test_copy(self):
         j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
-        j_copy = j.copy()
+        j_copy = j.board_copy()
         j.take_camels()
 
         self.assertTrue(not j == j_copy)
 
+    # Test the copy does not share cards or tokens with the original
+    def test_copy_independent(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        j.hands[j.player1] = ['Cloth', 'Cloth', 'Cloth']
+        j_copy = j.board_copy()
+        camels = j.market.count('Camel')
+
+        j_copy.sell_cards('Cloth', 3)
+        j_copy.take_camels()
+
+        self.assertEqual(j.hands[j.player1], ['Cloth', 'Cloth', 'Cloth'])
+        self.assertEqual(j.tokens[j.player1], [[], []])
+        self.assertEqual(len(j.goods_tokens['Cloth']), 7)
+        self.assertEqual(len(j.market), 5)
+        self.assertEqual(len(j.deck), len(j_copy.deck) + camels)
+
+    # Test the count vectors stay consistent with the cards moved
+    def test_card_counts(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        j.market = ['Camel', 'Camel', 'Diamond', 'Gold', 'Gold']
+        j.hands[j.player1] = ['Cloth', 'Spice']
+        j.herds[j.player1] = ['Camel']
+
+        # Camels given from the herd go into the market
+        j.exchange_cards(['Camel', 'Cloth'], ['Gold', 'Gold'])
+        self.assertEqual(sorted(j.hands[j.player1]), ['Gold', 'Gold', 'Spice'])
+        self.assertEqual(j.herds[j.player1], [])
+        self.assertEqual(sorted(j.market), ['Camel', 'Camel', 'Camel', 'Cloth', 'Diamond'])
+
+        # Jewels need at least two cards to sell
+        moves = j.get_legal_moves()
+        self.assertIn(('Sell', 'Gold', 2), moves)
+        self.assertNotIn(('Sell', 'Gold', 1), moves)
+        self.assertIn(('Sell', 'Spice', 1), moves)
+
+    # Test each exchange is generated once and follows the rules
+    def test_exchange_moves(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        j.market = ['Camel', 'Gold', 'Gold', 'Silver', 'Cloth']
+        j.hands[j.player1] = ['Cloth', 'Cloth', 'Spice', 'Spice', 'Leather', 'Leather']
+        j.herds[j.player1] = ['Camel'] * 4
+
+        exchanges = list(j.iter_exchanges())
+        self.assertEqual(len(exchanges), len(set(exchanges)))
+        self.assertIn(('Exchange', ('Spice', 'Spice'), ('Gold', 'Gold')), exchanges)
+        self.assertIn(('Exchange', ('Camel',), ('Silver',)), exchanges)
+        # Goods given must not be taken back and camels can't be taken
+        self.assertNotIn(('Exchange', ('Cloth',), ('Cloth',)), exchanges)
+        self.assertFalse(any('Camel' in take for _, _, take in exchanges))
+        # Only one camel can be given before the hand holds 7 cards
+        self.assertNotIn(('Exchange', ('Camel', 'Camel'), ('Gold', 'Gold')), exchanges)
+        self.assertRaises(Exception, j.exchange_cards, ['Camel', 'Camel'], ['Gold', 'Gold'])
+
+    # Test the legal moves are cached until the game changes
+    def test_legal_move_cache(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        stats = j.move_cache_stats
+
+        moves = j.get_legal_moves()
+        self.assertIs(j.get_legal_moves(), moves)
+        self.assertEqual((stats.hits, stats.misses), (1, 1))
+
+        # Mutating the game clears the cache, undoing restores it
+        j.apply_move(('Camels', None, None) if 'Camel' in j.market else sorted(moves)[0])
+        self.assertIsNot(j.get_legal_moves(), moves)
+        j.undo_move()
+        self.assertIs(j.get_legal_moves(), moves)
+
+        j.market = ['Leather', 'Gold', 'Gold', 'Silver', 'Cloth']
+        self.assertIn(('Take', 'Leather', None), j.get_legal_moves())
+        j.hands[j.player1] = ['Leather'] * 7
+        self.assertNotIn(('Take', 'Leather', None), j.get_legal_moves())
+        self.assertEqual(stats.hit_rate(), 2 / 6)
+
+    # Test the Zobrist hash is kept up to date and restored on undo
+    def test_zobrist_hash(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        start = j.zobrist_hash
+
+        for _ in range(20):
+            j.apply_move(random.choice(sorted(j.get_legal_moves())))
+            self.assertEqual(j.zobrist_hash, j.compute_zobrist())
+        for _ in range(20):
+            j.undo_move()
+        self.assertEqual(j.zobrist_hash, start)
+
+        # Taking the same cards in either order reaches the same state
+        j.market = ['Gold', 'Silver', 'Cloth', 'Spice', 'Leather']
+        first = j.board_copy()
+        first.take_card('Gold')
+        first.take_card('Silver')
+        second = j.board_copy()
+        second.take_card('Silver')
+        second.take_card('Gold')
+        self.assertEqual(first.zobrist_hash, second.zobrist_hash)
+
+    # Test the transposition table keeps the deeper entry for a slot
+    def test_transposition_table(self):
+        tt = players.TranspositionTable(max_mb=0.001)
+        tt.store(5, 3, 1.0, players.EXACT, ('Camels', None, None))
+        tt.store(5, 2, 2.0, players.EXACT, None)
+        self.assertEqual(tt.probe(5)[2], 1.0)
+        self.assertIsNone(tt.probe(5 + tt.size))
+
+        # Entries from an earlier search are replaced
+        tt.new_search()
+        tt.store(5 + tt.size, 1, 3.0, players.LOWER, None)
+        self.assertIsNone(tt.probe(5))
+        self.assertEqual(tt.probe(5 + tt.size)[3], players.LOWER)
+
+    # Test moves are ordered principal variation first, then killers, then big sells and jewels
+    def test_move_ordering(self):
+        agent = players.AlphaBetaPlayer(score_fn=players.custom_score_2)
+        agent.killers = [[('Take', 'Leather', None), None]]
+        moves = {('Take', 'Leather', None), ('Take', 'Diamond', None), ('Camels', None, None),
+                 ('Sell', 'Cloth', 1), ('Sell', 'Cloth', 3), ('Exchange', ('Spice',), ('Gold',))}
+
+        ordered = agent.order_moves(moves, 0, ('Camels', None, None), None)
+        self.assertEqual(ordered[:5], [('Camels', None, None), ('Take', 'Leather', None),
+                                       ('Sell', 'Cloth', 3), ('Sell', 'Cloth', 1), ('Take', 'Diamond', None)])
+
+        # Moves that cause cutoffs become killers and climb the history table
+        agent.killers = [[None, None], [None, None]]
+        agent.record_cutoff(('Exchange', ('Spice',), ('Gold',)), 0, 8)
+        self.assertEqual(agent.order_moves(moves, 0, None, None)[0], ('Exchange', ('Spice',), ('Gold',)))
+        self.assertEqual(agent.order_moves(moves, 1, None, None)[0], ('Exchange', ('Spice',), ('Gold',)))
+        self.assertEqual(agent.history['Exchange'], {('Exchange', ('Spice',), ('Gold',)): 64})
+
+    # Test the clock is read every few nodes and keeps the slowest gap in reserve
+    def test_search_clock(self):
+        now = [100.]
+        clock = players.SearchClock(lambda: now[0], margin=10, poll_ms=1.)
+        # A quick gap suggests 10 nodes a poll, the interval only doubles towards it
+        now[0] -= 0.1
+        clock.poll()
+        self.assertEqual((clock.interval, clock.count()), (2, 1))
+
+        now[0] -= 5.
+        clock.countdown = 0
+        clock.poll()
+        self.assertEqual(clock.reserve(), 15)
+        now[0] = 20.
+        self.assertRaises(players.SearchTimeout, clock.poll)
+
+    # Test pondering searches the predicted reply and hands its result over when the reply is played
+    def test_pondering(self):
+        agent = players.AlphaBetaPlayer(score_fn=players.custom_score_2, ponder=True, collect_stats=True)
+        j = jaipur.Jaipur(agent, players.GreedyPlayer('Bob'))
+        j.initial_setup()
+
+        # A single core has no time to spare, the worker is made to run anyway below
+        agent.pv = [None, sorted(j.get_legal_moves())[0]]
+        agent.start_pondering(j.board_copy())
+        self.assertEqual(agent._ponder_future is not None, (os.cpu_count() or 1) >= agent.PONDER_CORES)
+        agent.stop_pondering()
+        agent.PONDER_CORES = 1
+
+        def deadline(ms):
+            end = time.monotonic() + ms / 1000.
+            return lambda: 1000 * (end - time.monotonic())
+
+        while True:
+            move = agent.get_move(j.board_copy(), deadline(200))
+            j.apply_move(move)
+            agent.observe_move(j.board_copy(), move, agent.name)
+            if agent.ponder_move is not None:
+                break
+            j.apply_move(sorted(j.get_legal_moves())[0])
+
+        give_up = time.monotonic() + 30
+        while agent._ponder_shared[1] < 1:
+            self.assertLess(time.monotonic(), give_up, "the ponder worker never finished a depth")
+            time.sleep(0.001)
+        reply = agent.ponder_move
+        j.apply_move(reply)
+        agent.observe_move(j.board_copy(), reply, 'Bob')
+        self.assertTrue(agent.ponder_hit)
+
+        # The hit brings the worker's deepest table entries back into the player's table
+        results = []
+        stop = agent.stop_pondering
+        agent.stop_pondering = lambda: results.append(stop()) or results[-1]
+        agent.get_move(j.board_copy(), deadline(200))
+        del agent.stop_pondering
+        entries = results[0][3]
+        self.assertTrue(entries)
+        self.assertEqual([entry[1] for entry in entries], sorted((entry[1] for entry in entries), reverse=True))
+        self.assertIsNotNone(agent.tt.probe(entries[0][0]))
+        self.assertIsNone(agent._ponder_future)
+        self.assertGreaterEqual(agent.stats.depth_completed, 1)
+        agent.close()
+
+        # The game stops the worker however it ends, and the ponder search leaves the opponent's process alone
+        pondering = players.AlphaBetaPlayer(score_fn=players.custom_score_3, ponder=True)
+        pondering.PONDER_CORES = 1
+        winner, _, _ = jaipur.Jaipur(pondering, players.RandomPlayer('Bob')).play(time_limit=20)
+        self.assertIsNotNone(winner)
+        self.assertIsNone(pondering._ponder_pool)
+        self.assertEqual(threading.active_count(), 1)
+
+    # Test the root parallel search finds the same value as the serial one
+    def test_parallel_search(self):
+        serial = players.AlphaBetaPlayer(score_fn=players.custom_score_3, tt_mb=None)
+        parallel = players.AlphaBetaPlayer(score_fn=players.custom_score_3, tt_mb=None, workers=2)
+        j = jaipur.Jaipur(serial, players.RandomPlayer('Bob'))
+        j.initial_setup()
+        serial.time_left = parallel.time_left = lambda: float('inf')
+        try:
+            serial.alphabeta(j, 3)
+            self.assertIsNotNone(parallel.alphabeta(j, 3))
+            self.assertEqual(parallel.root_value, serial.root_value)
+            self.assertEqual(len(parallel.pv), 3)
+
+            # Copies for other processes leave the pool behind
+            self.assertIsNone(pickle.loads(pickle.dumps(parallel))._pool)
+        finally:
+            parallel.close()
+
+    # Test determinizing redeals only the cards the player can't see
+    def test_determinize(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        for _ in range(6):
+            j.apply_move(sorted(j.get_legal_moves())[0])
+
+        d = j.determinize(rng=random.Random(1))
+        self.assertEqual(d.hands['Alice'], j.hands['Alice'])
+        self.assertEqual((d.market, d.herds.items()), (j.market, j.herds.items()))
+        self.assertEqual(len(d.hands['Bob']), len(j.hands['Bob']))
+        self.assertNotIn('Camel', d.hands['Bob'])
+        self.assertEqual(sorted(d.deck + d.hands['Bob']), sorted(j.deck + j.hands['Bob']))
+        self.assertEqual(d.zobrist_hash, d.compute_zobrist())
+        self.assertIn(d.random_move(), d.get_legal_moves())
+
+    # Test MCTS picks a legal move and keeps the subtree of the moves played since
+    def test_mcts(self):
+        agent = players.MCTSPlayer(rollout=players.greedy_rollout, max_playouts=200)
+        j = jaipur.Jaipur(agent, players.GreedyPlayer('Bob'))
+        j.initial_setup()
+
+        move = agent.get_move(j.board_copy(), lambda: 1000.)
+        self.assertIn(move, j.get_legal_moves())
+        j.apply_move(move)
+        replies = agent.root.children[move].children
+        reply = max((r for r in replies if j.is_legal_move(r)), key=lambda r: replies[r].visits)
+        j.apply_move(reply)
+        agent.observe_move(j, move, agent.name)
+        agent.observe_move(j, reply, 'Bob')
+
+        self.assertIs(agent.reuse_tree(), replies[reply])
+        self.assertEqual(agent.played, [])
+
+        # With a real clock every move comes back inside the time limit, the first poll times a playout
+        agent = players.MCTSPlayer()
+        j = jaipur.Jaipur(agent, players.GreedyPlayer('Bob'))
+        j.initial_setup()
+        for _ in range(4):
+            end = time.monotonic() + 0.1
+            time_left = lambda: 1000 * (end - time.monotonic())
+            j.apply_move(agent.get_move(j.board_copy(), time_left))
+            self.assertGreater(time_left(), 0)
+            j.apply_move(j.agents['Bob'].get_move(j, time_left))
+
+    # Test the batch simulator applies the rules as Jaipur does from the same seed, and greedy scores as GreedyPlayer
+    def test_batch_games(self):
+        seeds = list(range(40))
+        batch = jaipur_batch.BatchJaipur(seeds)
+        results = batch.play(jaipur_batch.greedy_rollout_policy, jaipur_batch.rollout_policy,
+                             np.random.default_rng(0))
+        scores = batch.total_scores()
+
+        for i, seed in enumerate(seeds):
+            random.seed(seed)
+            j = jaipur.Jaipur(players.RandomPlayer('Player1'), players.RandomPlayer('Player2'))
+            j.initial_setup()
+            for move in batch.moves_of(i):
+                self.assertIn(move, j.get_legal_moves())
+                if j.active_player == 'Player1':
+                    greedy = players.GreedyPlayer().get_move(j.board_copy(), None)
+                    before = j.visible_score()
+                    j.apply_move(greedy)
+                    if j.visible_score(j.inactive_player) > before:
+                        self.assertEqual(move, greedy)
+                    j.undo_move()
+                j.apply_move(move)
+
+            self.assertTrue(j.game_over())
+            self.assertEqual([j.total_score('Player1'), j.total_score('Player2')], list(scores[i]))
+            self.assertEqual(results[i][0], 'Player2' if scores[i][1] > scores[i][0] else 'Player1')
+
+    # Test draws are merged by goods and the pruned expectimax picks a move as good as a plain expectimax
+    def test_expectimax(self):
+        outcomes = players.draw_outcomes((2, 0, 0, 0, 0, 1, 1), 2)
+        self.assertAlmostEqual(sum(p for p, _ in outcomes), 1.)
+        self.assertEqual(dict((goods, p) for p, goods in outcomes)[(0, 5)], 2 / 6)
+
+        agent = players.ExpectimaxPlayer(score_fn=players.custom_score_2)
+        j = jaipur.Jaipur(agent, players.RandomPlayer('Bob'))
+        j.initial_setup()
+        deck = j.deck
+
+        # Expected value of a move over its draws, and of a position by plain expectiminimax
+        def move_value(state, move, depth):
+            draws = state.draws_for(move)
+            outcomes = players.draw_outcomes(tuple(state.deck_counts()), draws) if draws else [(1., ())]
+            v = 0.
+            for p, goods in outcomes:
+                old = state.stack_deck(goods)
+                state.apply_move(move)
+                v += p * value(state, depth - 1)
+                state.undo_move()
+                state.restore_deck(old)
+            return v
+
+        def value(state, depth):
+            if depth == 0 or state.game_over():
+                return min(max(players.custom_score_2(state, agent), -1000.), 1000.)
+            values = [move_value(state, move, depth) for move in state.iter_legal_moves()]
+            return max(values) if state.active_player == agent.name else min(values)
+
+        agent.time_left = lambda: float('inf')
+        best = agent.expectimax(j, 2)
+        self.assertEqual(j.deck, deck)
+        self.assertAlmostEqual(move_value(j, best, 2), value(j, 2))
+
+    # Test the endgame solver matches a plain minimax of the final score difference and takes over near the end
+    def test_endgame_solver(self):
+        rng = random.Random(2)
+        agent = players.AlphaBetaPlayer(score_fn=players.custom_score_2)
+        j = jaipur.Jaipur(agent, players.GreedyPlayer('Bob'))
+        j.initial_setup()
+        while len(j.deck) > 1 or j.active_player != agent.name or j.game_over():
+            if j.game_over():
+                j.initial_setup()
+            moves = list(j.iter_legal_moves())
+            takes = [move for move in moves if move[0] in ('Take', 'Camels')]
+            j.apply_move(rng.choice(takes if takes and rng.random() < 0.7 else moves))
+
+        def value(state, plies):
+            if state.game_over() or not plies:
+                return state.total_score(agent.name) - state.total_score('Bob')
+            values = []
+            for move in list(state.iter_legal_moves()):
+                state.apply_move(move)
+                values.append(value(state, plies - 1))
+                state.undo_move()
+            return max(values) if state.active_player == agent.name else min(values)
+
+        agent.time_left = lambda: float('inf')
+        self.assertEqual(agent.solve_endgame(j, 2)[1], value(j, 2))
+        self.assertTrue(agent.in_endgame(j))
+        end = time.monotonic() + 0.5
+        self.assertIn(agent.get_move(j, lambda: 1000 * (end - time.monotonic())), j.get_legal_moves())
+
+    # Test the search stats count the tree and reach the hooks, and cost nothing when off
+    def test_search_stats(self):
+        agent = players.MinimaxPlayer(search_depth=2, score_fn=players.custom_score_3)
+        alphabeta = players.AlphaBetaPlayer(score_fn=players.custom_score_2, collect_stats=True)
+        j = jaipur.Jaipur(agent, alphabeta)
+        j.initial_setup()
+        agent.get_move(j, lambda: 1000.)
+        self.assertIsNone(agent.stats)
+
+        collected = []
+        agent.add_stats_hook(lambda player, stats: collected.append(stats))
+        agent.get_move(j, lambda: 1000.)
+        stats = collected[0]
+        moves = len(j.get_legal_moves())
+        self.assertEqual(stats.nodes, 1 + moves + stats.leaves)
+        self.assertEqual(stats.evaluations, stats.leaves)
+        self.assertEqual(stats.depth_completed, 2)
+        self.assertEqual(stats.branching_factor(), (moves + stats.leaves) / (1 + moves))
+
+        calls = iter(range(1000, 0, -1))
+        alphabeta.get_move(j, lambda: next(calls))
+        self.assertEqual(alphabeta.stats.depth_completed, len(alphabeta.stats.depth_times))
+        self.assertGreater(alphabeta.stats.cutoffs, 0)
+
+    # Test the lazy generator yields the legal moves in stages
+    def test_iter_legal_moves(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        j.market = ['Camel', 'Gold', 'Gold', 'Silver', 'Cloth']
+        j.hands[j.player1] = ['Cloth', 'Cloth', 'Spice', 'Diamond', 'Diamond']
+
+        moves = list(j.iter_legal_moves())
+        self.assertEqual(set(moves), j.get_legal_moves())
+        self.assertEqual(moves[:4], [('Sell', 'Diamond', 2), ('Sell', 'Cloth', 2), ('Sell', 'Cloth', 1), ('Sell', 'Spice', 1)])
+        self.assertEqual(moves[4:8], [('Take', 'Gold', None), ('Take', 'Silver', None), ('Take', 'Cloth', None), ('Take', 'Camel', None)])
+        self.assertEqual(moves[8], ('Camels', None, None))
+        sizes = [len(move[1]) for move in moves[9:]]
+        self.assertEqual(sizes, sorted(sizes))
+
+        self.assertEqual(list(j.iter_legal_moves(order=('Camels',))), [('Camels', None, None)])
+        self.assertTrue(j.is_legal_move(('Exchange', ('Spice',), ('Gold',))))
+        self.assertFalse(j.is_legal_move(('Exchange', ('Cloth',), ('Cloth',))))
+        self.assertFalse(j.is_legal_move(('Sell', 'Diamond', 1)))
+
+    # Test undo restores the game exactly after a sequence of moves
+    def test_undo_move(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+
+        def snapshot(game):
+            return (game.deck, sorted(game.market), game.discard_pile, game.goods_tokens, game.bonus_tokens,
+                    game.hands.items(), game.herds.items(), [(name, [t[:] for t in tokens]) for name, tokens in game.tokens.items()],
+                    game.camel_token, game.active_player)
+
+        history = []
+        for _ in range(30):
+            history.append(snapshot(j))
+            j.apply_move(random.choice(sorted(j.get_legal_moves())))
+
+        while history:
+            j.undo_move()
+            self.assertEqual(snapshot(j), history.pop())
+
+    # Test the running scores and depleted pile count match the tokens through a game and its undo
+    def test_score_tracking(self):
+        j = jaipur.Jaipur(players.GreedyPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+
+        def recount(game):
+            camel = {name: 5 if game.camel_token == name else 0 for name in game.tokens}
+            return ([sum(tokens[0]) + camel[name] for name, tokens in game.tokens.items()],
+                    [sum(map(sum, tokens)) + camel[name] for name, tokens in game.tokens.items()],
+                    sum(1 for pile in game.goods_tokens.values() if not pile))
+
+        def tracked(game):
+            return ([game.visible_score(name) for name in game.tokens],
+                    [game.total_score(name) for name in game.tokens], game.depleted_piles())
+
+        moves = 0
+        while not j.is_terminal:
+            j.apply_move(j.agents[j.active_player].get_move(j, lambda: 100.))
+            moves += 1
+            self.assertEqual(tracked(j), recount(j))
+            self.assertEqual(tracked(j.board_copy()), recount(j))
+            if not j.is_terminal:
+                self.assertFalse(any(j.is_winner(name) or j.is_loser(name) for name in ('Alice', 'Bob')))
+        self.assertTrue(j.game_over())
+
+        # Once over the winner is the one ahead, compared with the other player
+        alice, bob = j.total_score('Alice'), j.total_score('Bob')
+        self.assertEqual((j.is_winner('Alice'), j.is_loser('Alice')), (alice > bob, alice < bob))
+        self.assertEqual((j.is_winner('Bob'), j.is_loser('Bob')), (bob > alice, bob < alice))
+
+        for _ in range(moves):
+            j.undo_move()
+            self.assertEqual(tracked(j), recount(j))
+        self.assertEqual(tracked(j), ([0, 0], [0, 0], 0))
+        self.assertFalse(j.is_terminal)
+
+    # Test the worked out score deltas match making each move, for both players
+    def test_move_score_deltas(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+
+        while not j.is_terminal:
+            for name in (j.active_player, j.inactive_player):
+                before = j.visible_score(name)
+                expected = []
+                for move in j.iter_legal_moves():
+                    j.apply_move(move)
+                    expected.append((move, j.visible_score(name) - before))
+                    j.undo_move()
+                self.assertEqual(j.move_score_deltas(name), expected)
+            j.apply_move(random.choice(sorted(j.get_legal_moves())))
+
+    # Test seeded games replay the same, in this process or in a worker pool
+    def test_seeded_games(self):
+        alice, bob = players.RandomPlayer('Alice'), players.GreedyPlayer('Bob')
+        results = [tournament.play_game(alice, bob, seed) for seed in (1, 2)]
+        self.assertEqual(results, [tournament.play_game(alice, bob, seed) for seed in (1, 2)])
+
+        with tournament.game_pool(2) as pool:
+            self.assertEqual(results, list(pool.map(tournament.play_game, [alice, alice], [bob, bob], [1, 2])))
+
+        wins = {'Alice': 0, 'Bob': 0}
+        self.assertEqual(tournament.tally(results, wins), (0, 0, 0))
+        self.assertEqual(sum(wins.values()), 2)
+
+    # Test logged games read back with their moves and results, and replay to any move
+    def test_game_log(self):
+        # The on-disk header size is part of the format
+        self.assertEqual(jaipur_log.HEADER.size, 118)
+        alice, bob = players.GreedyPlayer('Alice'), players.RandomPlayer('Bob')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'games.log')
+            wins = {'Alice': 0, 'Bob': 0}
+            with jaipur_log.GameLogWriter(path) as log:
+                tournament.play_round(alice, [bob], wins, 1, seeds=[1, 2], log=log)
+
+            # A game cut off halfway through its moves is left out
+            with open(path, 'ab') as f:
+                f.write(tournament.play_game(alice, bob, 3, log=True)[5][:-8])
+
+            with jaipur_log.GameLog(path) as log:
+                self.assertEqual(len(log), 2)
+                for i, (player1, player2) in enumerate([(alice, bob), (bob, alice)]):
+                    random.seed(i + 1)
+                    game = jaipur.Jaipur(player1, player2)
+                    winner, _, termination = game.play(time_limit=tournament.TIME_LIMIT)
+
+                    header = log.header(i)
+                    self.assertEqual((header.seed, header.name1, header.winner, header.termination, header.score1),
+                                     (i + 1, player1.name, winner, termination, game.total_score(player1.name)))
+                    self.assertEqual(log.moves(i), game.moves_played())
+
+                    # Replaying matches the game at the end and after undoing back to a move
+                    self.assertEqual(log.replay(i).zobrist_hash, game.zobrist_hash)
+                    k = header.moves // 2
+                    for _ in range(header.moves - k):
+                        game.undo_move()
+                    self.assertEqual(log.replay(i, k).zobrist_hash, game.zobrist_hash)
+                    self.assertEqual(log.replay(i, k).hands.items(), game.hands.items())
+
+        # Every kind of move survives encoding
+        j = jaipur.Jaipur(alice, bob)
+        j.initial_setup()
+        j.hands[j.player1] = ['Diamond', 'Gold', 'Silver', 'Cloth', 'Spice']
+        j.herds[j.player1] = ['Camel'] * 3
+        for move in j.iter_legal_moves():
+            self.assertEqual(jaipur_log.decode_move(jaipur_log.encode_move(move)), move)
+
+    # Test self-play rows match the positions of the game, split across shards, in this process or a pool
+    def test_selfplay(self):
+        greedy = players.GreedyPlayer()
+        with tempfile.TemporaryDirectory() as tmp:
+            paths, counts = selfplay.generate(greedy, players.GreedyPlayer(), 4, tmp, seed=5, shard_rows=50)
+            features, labels, seeds = selfplay.load_shards(paths)
+            self.assertEqual(len(paths), -(-counts['positions'] // 50))
+            self.assertEqual(features.shape, (counts['positions'], jaipur.FEATURE_SIZE))
+            self.assertEqual(counts['games'], 4)
+
+            # The first game's rows replay its positions, labelled from the mover's side
+            seed = int(seeds[0])
+            random.seed(seed)
+            game = jaipur.Jaipur(greedy, players.GreedyPlayer("Greedy'"))
+            game.play(time_limit=tournament.TIME_LIMIT)
+            margin = game.total_score(game.name1) - game.total_score(game.name2)
+            rows = seeds == seed
+            for _ in game.moves_played():
+                game.undo_move()
+            first = features[rows][0]
+            self.assertEqual(first.tolist(), game.features())
+            self.assertEqual(labels[rows][0], margin)
+            self.assertEqual(labels[rows][1], -margin)
+
+            paths, pooled = selfplay.generate(greedy, players.GreedyPlayer(), 4, tmp, workers=2, seed=5,
+                                              shard_rows=50, prefix='pooled')
+            self.assertEqual(pooled, counts)
+            self.assertEqual(sorted(selfplay.load_shards(paths)[2].tolist()), sorted(seeds.tolist()))
+
+    # Test a fitted evaluator survives saving, scores batches as it scores states, and batches the search leaves
+    def test_learned_evaluator(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths, _ = selfplay.generate(players.GreedyPlayer(), players.JewelPlayer(), 6, tmp, seed=3)
+            evaluator = jaipur_eval.fit_linear(*selfplay.load_shards(paths)[:2])
+            evaluator.save(os.path.join(tmp, 'weights.npz'))
+            loaded = jaipur_eval.LearnedEvaluator.load(os.path.join(tmp, 'weights.npz'))
+        self.assertEqual(len(loaded.layers), 1)
+        np.testing.assert_allclose(loaded.layers[0][0], evaluator.layers[0][0])
+
+        # Copies sent to worker processes key the same search players
+        copied = pickle.loads(pickle.dumps(loaded))
+        self.assertEqual(copied, loaded)
+        self.assertEqual(len({copied: 1, loaded: 2}), 1)
+        self.assertNotEqual(jaipur_eval.LearnedEvaluator(loaded.layers, name='other_L'), loaded)
+
+        agent = players.AlphaBetaPlayer(score_fn=loaded, tt_mb=None)
+        self.assertEqual(agent.name, 'AlphaBetaL')
+        j = jaipur.Jaipur(agent, players.RandomPlayer('Bob'))
+        j.initial_setup()
+        moves = list(j.iter_legal_moves())
+        batch = loaded.score_batch(j, agent, moves, jaipur.Jaipur.apply_move, jaipur.Jaipur.undo_move)
+        single = []
+        for move in moves:
+            j.apply_move(move)
+            single.append(loaded(j, agent))
+            j.undo_move()
+        np.testing.assert_allclose(batch, single)
+
+        # The same search scoring one leaf at a time finds the same value and line
+        plain = players.AlphaBetaPlayer(score_fn=lambda game, player: loaded(game, player), tt_mb=None)
+        plain.name = agent.name
+        agent.time_left = plain.time_left = lambda: float('inf')
+        for depth in (1, 2, 3):
+            agent.alphabeta(j, depth)
+            plain.alphabeta(j, depth)
+            self.assertAlmostEqual(agent.root_value, plain.root_value)
+
+    # Test a search agent playing itself gets a second seat with its own search state
+    def test_selfplay_same_agent(self):
+        agent = players.AlphaBetaPlayer(score_fn=players.custom_score_2)
+        first, second = selfplay.seat_players(agent, agent)
+        self.assertIs(first, agent)
+        self.assertEqual(second.name, agent.name + "'")
+        self.assertIsNot(second.tt, agent.tt)
+        self.assertIsNot(second.history, agent.history)
+        mcts = players.MCTSPlayer()
+        self.assertIsNot(selfplay.seat_players(mcts, mcts)[1].played, mcts.played)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            _, counts = selfplay.generate(agent, agent, 2, tmp, seed=1, time_limit=20)
+        self.assertEqual(counts['games'], 2)
+        self.assertEqual(counts['skipped'], 0)
+
+    # Test the sequential test decides clear pairings and leaves even ones open
+    def test_sprt(self):
+        sprt = tournament.SPRT(elo0=0, elo1=50, min_games=10, max_games=400)
+        strong = tournament.Pairing(players.GreedyPlayer('Greedy'), players.RandomPlayer('Random'))
+        for _ in range(12):
+            strong.record('Greedy', 'Player 1 wins')
+        self.assertEqual(sprt.decision(strong), 'H1')
+        self.assertGreater(strong.elo()[1], 0)
+
+        even = tournament.Pairing(players.GreedyPlayer('Greedy'), players.RandomPlayer('Random'))
+        for i in range(20):
+            even.record('Greedy' if i % 2 else 'Random', 'Player 1 wins')
+        self.assertIsNone(sprt.decision(even))
+        self.assertLess(sprt.closeness(even), sprt.closeness(strong))
+        self.assertEqual([even.next_game()[0].name for _ in range(2)], ['Greedy', 'Random'])
+
+    # Test the benchmark corpus is reproducible and regressions are flagged against the baseline
+    def test_benchmark(self):
+        first = benchmark.corpus_position(3, 'midgame')
+        second = benchmark.corpus_position(3, 'midgame')
+        self.assertEqual(first.zobrist_hash, second.zobrist_hash)
+        self.assertLessEqual(len(benchmark.corpus_position(3, 'endgame').deck), 5)
+
+        baseline = {'apply_move': {'per_second': 100.}, 'board_copy': {'per_second': 100.}}
+        results = {'apply_move': {'per_second': 95.}, 'board_copy': {'per_second': 80.}, 'new': {'per_second': 1.}}
+        self.assertEqual(list(benchmark.compare(results, baseline, threshold=0.1)), ['board_copy'])
+
+    # Test snapshots share the game's containers until one side changes them, and never see each other's moves
+    def test_snapshot(self):
+        j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        j.initial_setup()
+        before = j.board_copy()
+        snap = j.snapshot()
+        self.assertIs(snap._market, j._market)
+        self.assertEqual(snap.get_legal_moves(), j.get_legal_moves())
+
+        # The agent's moves and edits stay in the snapshot
+        snap.apply_move(random.choice(list(snap.iter_legal_moves())))
+        snap.hands['Bob'] = ['Leather']
+        snap.tokens['Alice'][0].append(5)
+        self.assertEqual(j.features(), before.features())
+        self.assertEqual(j.zobrist_hash, before.zobrist_hash)
+        self.assertEqual(j.tokens['Alice'], [[], []])
+
+        # The game's moves stay out of earlier snapshots, and undo puts it back
+        snap = j.snapshot()
+        nested = snap.snapshot()
+        for _ in range(6):
+            j.apply_move(random.choice(list(j.iter_legal_moves())))
+        self.assertEqual(snap.features(), before.features())
+        self.assertEqual(nested.features(), before.features())
+        for _ in range(6):
+            j.undo_move()
+        self.assertEqual(j.features(), before.features())
+        self.assertEqual(j.zobrist_hash, j.compute_zobrist())
+
     # Test playing
     def test_play(self):
         j = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
@@ -120,6 +802,50 @@ class jaipurTest(unittest.TestCase):
 
         self.assertTrue(winner in ('Alice', 'Bob'))
 
+        # Agents may watch the moves without wanting to hear of the end
+        watcher = players.RandomPlayer('Carol')
+        watcher.observe_move = lambda game, move, player: None
+        self.assertIsNotNone(jaipur.Jaipur(watcher, players.RandomPlayer('Bob')).play()[0])
+
+        # Dealing again starts from scratch, the same game plays a second time as a new one would
+        random.seed(3)
+        j.play()
+        deal, moves = j.deal_order(), j.moves_played()
+        fresh = jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob'))
+        fresh.deal(*deal)
+        first = (fresh.features(), fresh.zobrist_hash)
+        for move in moves:
+            fresh.apply_move(move)
+        self.assertEqual((fresh.features(), fresh.zobrist_hash), (j.features(), j.zobrist_hash))
+
+        j.deal(*deal)
+        self.assertEqual((j.features(), j.zobrist_hash), first)
+        self.assertEqual((j.moves_played(), j.tokens['Alice'], j.camel_token), ([], [[], []], None))
+
+    # Test the history has a row per move adding up to the final scores, and can be left out
+    def test_move_history(self):
+        j = jaipur.Jaipur(players.GreedyPlayer('Alice'), players.RandomPlayer('Bob'))
+        _, history, _ = j.play()
+
+        rows = history.rows()
+        self.assertEqual(len(rows), len(history))
+        self.assertEqual(sum(history.column('p1_delta')), j.visible_score('Alice'))
+        self.assertEqual(sum(history.column('p2_delta')), j.visible_score('Bob'))
+        self.assertTrue(all(row['Camels'] + row['Take'] + row['Exchange'] + row['Sell'] == 1 for row in rows))
+        self.assertEqual([row['initiating_player'] for row in rows[:2]], [1, 0])
+
+        frame = history.to_dataframe()
+        self.assertEqual(list(frame.columns), list(jaipur.HISTORY_COLUMNS))
+        self.assertEqual(frame['p1_delta'].tolist(), history.column('p1_delta').tolist())
+
+        self.assertIsNone(jaipur.Jaipur(players.RandomPlayer('Alice'), players.RandomPlayer('Bob')).play(record=False)[1])
+
+        # The arrays grow past their first capacity
+        history = jaipur.MoveHistory()
+        for _ in range(jaipur.MoveHistory.CAPACITY + 1):
+            history.record(('Camels', None, None), 3, True, 0, 0)
+        self.assertEqual(history.column('Camel').tolist(), [3] * (jaipur.MoveHistory.CAPACITY + 1))
+
 if __name__=="__main__":
     unittest.main()
 
@@ -1,41 +1,130 @@
 from jaipur import Jaipur
-from jaipur_players import RandomPlayer, JewelPlayer, GreedyPlayer, MinimaxPlayer, AlphaBetaPlayer
-from jaipur_players import custom_score_1, custom_score_2, custom_score_3
+from jaipur_players import RandomPlayer, JewelPlayer, GreedyPlayer, MinimaxPlayer, AlphaBetaPlayer, MCTSPlayer
+from jaipur_players import custom_score_1, custom_score_2, custom_score_3, SearchStats
+from jaipur_log import GameLogWriter, encode_game
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import math
+import multiprocessing
+import os
+import random
 
 Agent = namedtuple("Agent", ["player", "name"])
 
 TIME_LIMIT = 100
 
-# for each player agent play matches against all the CPU agents and record scores
-def play_round(player_agent, cpu_agents, win_counts, num_matches):
+# Play a single game and return the winner, how it ended, both final scores, the search stats
+# and with log the game encoded for a game log, None without
+# Seeding the game makes it reproducible wherever it is played
+# With stats the search agents' stats are summed over their moves, keyed by agent name
+def play_game(player1, player2, seed=None, time_limit=TIME_LIMIT, stats=False, log=False):
+    if seed is not None:
+        random.seed(seed)
+
+    game_stats = {}
+    def record(player, move_stats):
+        game_stats.setdefault(player.name, SearchStats()).merge(move_stats)
+
+    searchers = [player for player in (player1, player2) if stats and hasattr(player, 'add_stats_hook')]
+    collecting = [player.collect_stats for player in searchers]
+    for player in searchers:
+        player.add_stats_hook(record)
+
+    try:
+        game = Jaipur(player1, player2)
+        winner, _, termination = game.play(time_limit=time_limit, record=False)
+    finally:
+        for player, collect in zip(searchers, collecting):
+            player.stats_hooks.remove(record)
+            player.collect_stats = collect
+
+    record = encode_game(game, seed, winner, termination) if log else None
+    return winner, termination, game.total_score(game.name1), game.total_score(game.name2), game_stats, record
+
+# Append the encoded games of the results to a game log writer
+def log_games(log, results):
+    if log is not None:
+        for result in results:
+            log.write(result[5])
+
+# Add the stats of each game to the totals per agent
+def merge_stats(total_stats, results):
+    for result in results:
+        for name, stats in result[4].items():
+            total_stats.setdefault(name, SearchStats()).merge(stats)
+    return total_stats
+
+# Print how hard each search agent searched per move and where the time went
+def print_stats(total_stats):
+    print('\n{:^13}{:^8}{:^12}{:^11}{:^8}{:^8}{:^8}{:^20}'.format(
+        'Agent', 'Moves', 'Nodes/move', 'NPS', 'Depth', 'EBF', 'Cutoff', 'Gen/Eval/Copy %'))
+    for name, stats in sorted(total_stats.items()):
+        moves = max(stats.moves, 1)
+        total = stats.time_total or 1.
+        split = '{:.0f}/{:.0f}/{:.0f}'.format(*(100 * t / total for t in
+                                                (stats.time_movegen, stats.time_eval, stats.time_copy)))
+        print('{:^13}{:^8}{:^12.0f}{:^11.0f}{:^8.1f}{:^8.2f}{:^8.1%}{:^20}'.format(
+            name, stats.moves, stats.nodes / moves, stats.nodes_per_second(), stats.depth_completed / moves,
+            stats.branching_factor(), stats.cutoff_rate(), split))
+
+# Games played by one agent in a round, both agents get the chance to play first
+def round_games(player_agent, cpu_agents, num_matches):
+    return sum([[(player_agent, agent), (agent, player_agent)]
+                for _ in range(num_matches)
+                for agent in cpu_agents], [])
+
+# Add the results of a round to the win counts and return the early terminations
+def tally(results, win_counts):
     timeout_count = 0
     forfeit_count = 0
     illegal_count = 0
-    
-    # Number of matches per cpu
-    for _ in range(num_matches):
-
-        # Give both players the chance to play first
-        games = sum([[Jaipur(player_agent, agent),
-                    Jaipur(agent, player_agent)] 
-                    for agent in cpu_agents], [])
-
-        # play a single game
-        for game in games:
-            winner, _, termination = game.play(time_limit=TIME_LIMIT)
-            win_counts[winner] += 1
-
-            # add to early termination
-            if termination == 'forfeit':
-                forfeit_count += 1
-            elif termination == 'timeout':
-                timeout_count += 1
-            elif termination == 'illegal move':
-                illegal_count += 1
+
+    for winner, termination, *_ in results:
+        win_counts[winner] += 1
+
+        # add to early termination
+        if termination == 'forfeit':
+            forfeit_count += 1
+        elif termination == 'timeout':
+            timeout_count += 1
+        elif termination == 'illegal move':
+            illegal_count += 1
 
     return timeout_count, forfeit_count, illegal_count
 
+# for each player agent play matches against all the CPU agents and record scores
+# log is a GameLogWriter the games are added to
+def play_round(player_agent, cpu_agents, win_counts, num_matches, seeds=None, total_stats=None, log=None):
+    games = round_games(player_agent, cpu_agents, num_matches)
+    seeds = seeds or [None] * len(games)
+
+    # play a single game at a time
+    results = [play_game(player1, player2, seed, stats=total_stats is not None, log=log is not None)
+               for (player1, player2), seed in zip(games, seeds)]
+    if total_stats is not None:
+        merge_stats(total_stats, results)
+    log_games(log, results)
+    return tally(results, win_counts)
+
+# Pin each worker process to its own core so games don't compete for CPU time under the move time limit
+def _pin_worker(cores):
+    core = cores.get()
+    if core is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+
+# Pool running one game per worker, workers are pinned to distinct cores where the platform allows it
+def game_pool(workers, pin=True):
+    if not pin or not hasattr(os, 'sched_getaffinity'):
+        return ProcessPoolExecutor(max_workers=workers)
+
+    available = sorted(os.sched_getaffinity(0))
+    cores = multiprocessing.Queue()
+    for i in range(workers):
+        # More workers than cores can't be fair, leave the extra ones unpinned
+        cores.put(available[i] if i < len(available) else None)
+    return ProcessPoolExecutor(max_workers=workers, initializer=_pin_worker, initargs=(cores,))
+
 def update(total_wins, wins):
     for player in total_wins:
         total_wins[player] += wins[player]
@@ -44,14 +133,30 @@ def update(total_wins, wins):
 
 
 # test all player agents versus the CPUs and output the results
-def play_matches(n_matches, player_agents, cpu_agents):
+# With more than one worker the games are spread across a process pool, each with its own seed
+# With stats a report of the search agents' search statistics follows the results
+# With log every game is appended to the game log at that path
+def play_matches(n_matches, player_agents, cpu_agents, workers=1, seed=None, stats=False, log=None):
     total_wins = {agent.name : 0 for agent in cpu_agents}
     total_timeouts = 0
     total_forfeits = 0
     total_illegals = 0
+    total_stats = {} if stats else None
 
     total_matches = 2 * n_matches * len(player_agents)
 
+    # Seeds are drawn up front so every game can be replayed on its own
+    rng = random.Random(seed)
+    rounds = [round_games(agent, cpu_agents, n_matches) for agent in player_agents]
+    seeds = [[rng.getrandbits(32) for _ in games] for games in rounds]
+
+    log = GameLogWriter(log) if log else None
+    pool = game_pool(workers) if workers > 1 else None
+    if pool is not None:
+        futures = [[pool.submit(play_game, player1, player2, game_seed, stats=stats, log=log is not None)
+                    for (player1, player2), game_seed in zip(games, game_seeds)]
+                   for games, game_seeds in zip(rounds, seeds)]
+
     print('\n{:^9}{:^13}'.format('Match #', "Opponent") + ''.join(['{:^13}'.format(x.name) for x in cpu_agents]))
     print('{:^9}{:^13} '.format('', '') + ''.join('{:^5}| {:^5}'.format('Won', 'Lost') for agent in cpu_agents))
 
@@ -61,7 +166,14 @@ def play_matches(n_matches, player_agents, cpu_agents):
 
         print("{!s:^9}{:^13}".format(idx + 1, agent.name), end="", flush=True)
 
-        counts = play_round(agent, cpu_agents, wins, n_matches)
+        if pool is not None:
+            results = [future.result() for future in futures[idx]]
+            if stats:
+                merge_stats(total_stats, results)
+            log_games(log, results)
+            counts = tally(results, wins)
+        else:
+            counts = play_round(agent, cpu_agents, wins, n_matches, seeds[idx], total_stats, log)
         total_wins = update(total_wins, wins)
         total_timeouts += counts[0]
         total_forfeits += counts[1]
@@ -76,6 +188,11 @@ def play_matches(n_matches, player_agents, cpu_agents):
             ) for i in range(0, len(round_totals), 2)
         ]))
 
+    if pool is not None:
+        pool.shutdown()
+    if log is not None:
+        log.close()
+
     print('-'*74)
     print('{:^9}{:^13}'.format("", "Win Rate:") + 
             ''.join([
@@ -90,17 +207,183 @@ def play_matches(n_matches, player_agents, cpu_agents):
         print(("\nThere were {} forfeits during the game.").format(total_forfeits))
     if total_illegals:
         print(("\nThere were {} illegal moves during the game.".format(total_illegals)))
+    if stats:
+        print_stats(total_stats)
+
+# Expected score of a player rated elo points above its opponent
+def elo_to_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+def score_to_elo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+# Win, draw and loss counts of a player agent against one CPU agent, with the games scheduled so far
+class Pairing:
+    def __init__(self, player, cpu):
+        self.player = player
+        self.cpu = cpu
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.scheduled = 0
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    # Next game of the pairing, the players swap seats every game
+    def next_game(self):
+        self.scheduled += 1
+        if self.scheduled % 2:
+            return self.player, self.cpu
+        return self.cpu, self.player
+
+    def record(self, winner, termination):
+        if termination == 'Draw':
+            self.draws += 1
+        elif winner == self.player.name:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    # Mean and variance of the per-game score, half a win and half a loss are added so a clean sweep has some spread
+    def score_stats(self):
+        wins, draws, losses = self.wins + .5, self.draws, self.losses + .5
+        n = wins + draws + losses
+        mean = (wins + .5 * draws) / n
+        variance = (wins * (1 - mean) ** 2 + draws * (.5 - mean) ** 2 + losses * mean ** 2) / n
+        return mean, variance
+
+    # Elo of the player over the CPU agent with a 95% confidence interval
+    def elo(self):
+        mean, variance = self.score_stats()
+        margin = 1.96 * math.sqrt(variance / max(self.games, 1))
+        return score_to_elo(mean), score_to_elo(mean - margin), score_to_elo(mean + margin)
+
+    # Log likelihood ratio of elo1 over elo0 under a normal approximation of the game scores
+    def llr(self, elo0, elo1):
+        mean, variance = self.score_stats()
+        s0, s1 = elo_to_score(elo0), elo_to_score(elo1)
+        return self.games * (s1 - s0) * (2 * mean - s0 - s1) / (2 * variance)
+
+# Sequential probability ratio test of H0: elo <= elo0 against H1: elo >= elo1
+class SPRT:
+    def __init__(self, elo0=0., elo1=50., alpha=0.05, beta=0.05, min_games=10, max_games=400):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.min_games = min_games
+        self.max_games = max_games
+
+    # 'H1' if the player is stronger, 'H0' if not, 'max games' if it ran out, None while undecided
+    def decision(self, pairing):
+        if pairing.games < self.min_games:
+            return None
+        llr = pairing.llr(self.elo0, self.elo1)
+        if llr >= self.upper:
+            return 'H1'
+        if llr <= self.lower:
+            return 'H0'
+        if pairing.games >= self.max_games:
+            return 'max games'
+        return None
+
+    # How far the pairing is from a decision, 0 in the middle of the bounds and 1 at either bound
+    def closeness(self, pairing):
+        llr = pairing.llr(self.elo0, self.elo1)
+        middle = (self.upper + self.lower) / 2
+        return abs(llr - middle) / ((self.upper - self.lower) / 2)
+
+# Play every player agent against every CPU agent until each pairing is decided by the SPRT
+# Games go to the undecided pairings furthest from a decision, so close pairings get the most compute
+# With log every game is appended to the game log at that path
+def play_sequential_test(player_agents, cpu_agents, sprt=None, workers=1, seed=None, log=None):
+    sprt = sprt or SPRT()
+    log = GameLogWriter(log) if log else None
+    rng = random.Random(seed)
+    pairings = [Pairing(player, cpu) for player in player_agents for cpu in cpu_agents]
+
+    def next_pairing():
+        open_pairings = [pairing for pairing in pairings
+                         if sprt.decision(pairing) is None and pairing.scheduled < sprt.max_games]
+        if not open_pairings:
+            return None
+        return min(open_pairings, key=lambda pairing: (sprt.closeness(pairing), pairing.scheduled))
+
+    if workers > 1:
+        with game_pool(workers) as pool:
+            pending = {}
+            while True:
+                # Keep every worker busy with the pairings that need games most
+                while len(pending) < workers:
+                    pairing = next_pairing()
+                    if pairing is None:
+                        break
+                    player1, player2 = pairing.next_game()
+                    pending[pool.submit(play_game, player1, player2, rng.getrandbits(32),
+                                        log=log is not None)] = pairing
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    log_games(log, [result])
+                    pending.pop(future).record(*result[:2])
+    else:
+        while True:
+            pairing = next_pairing()
+            if pairing is None:
+                break
+            player1, player2 = pairing.next_game()
+            result = play_game(player1, player2, rng.getrandbits(32), log=log is not None)
+            log_games(log, [result])
+            pairing.record(*result[:2])
+    if log is not None:
+        log.close()
+
+    print('\n{:^13}{:^13}{:^7}{:^7}{:^7}{:^24}{:^9}{:^11}'.format(
+        'Agent', 'Opponent', 'Won', 'Drawn', 'Lost', 'Elo (95% CI)', 'LLR', 'Result'))
+    for pairing in pairings:
+        elo, low, high = pairing.elo()
+        print('{:^13}{:^13}{:^7}{:^7}{:^7}{:^24}{:^9.2f}{:^11}'.format(
+            pairing.player.name, pairing.cpu.name, pairing.wins, pairing.draws, pairing.losses,
+            '{:.0f} ({:.0f}, {:.0f})'.format(elo, low, high),
+            pairing.llr(sprt.elo0, sprt.elo1), str(sprt.decision(pairing))))
+
+    return pairings
 
 if __name__ == "__main__":
-    play_matches(5,
-                [
+    parser = argparse.ArgumentParser(description="Play the search agents against the CPU agents.")
+    parser.add_argument('--matches', type=int, default=5, help="matches per pairing, each agent plays first once per match")
+    parser.add_argument('--workers', type=int, default=1, help="processes to play games in, one per core")
+    parser.add_argument('--seed', type=int, default=None, help="seed for the per-game seeds")
+    parser.add_argument('--sprt', action='store_true', help="play each pairing until a sequential test decides it")
+    parser.add_argument('--elo0', type=float, default=0., help="Elo difference of the SPRT null hypothesis")
+    parser.add_argument('--elo1', type=float, default=50., help="Elo difference of the SPRT alternative hypothesis")
+    parser.add_argument('--stats', action='store_true', help="report the search statistics of the search agents")
+    parser.add_argument('--max-games', type=int, default=400, help="games per pairing before the SPRT gives up")
+    parser.add_argument('--log', default=None, help="game log file every game is appended to")
+    args = parser.parse_args()
+
+    player_agents = [
                 AlphaBetaPlayer(score_fn = custom_score_1),
                 AlphaBetaPlayer(score_fn = custom_score_2),
                 AlphaBetaPlayer(score_fn = custom_score_3),
                 MinimaxPlayer(score_fn = custom_score_1),
                 MinimaxPlayer(score_fn = custom_score_2),
-                MinimaxPlayer(score_fn = custom_score_3)],
-                [JewelPlayer(), 
+                MinimaxPlayer(score_fn = custom_score_3),
+                MCTSPlayer()]
+    cpu_agents = [JewelPlayer(), 
                 GreedyPlayer(),
                 RandomPlayer()]
-                )
\ No newline at end of file
+
+    if args.sprt:
+        play_sequential_test(player_agents, cpu_agents,
+                             SPRT(args.elo0, args.elo1, max_games=args.max_games),
+                             workers=args.workers, seed=args.seed, log=args.log)
+    else:
+        play_matches(args.matches, player_agents, cpu_agents, workers=args.workers, seed=args.seed, stats=args.stats,
+                     log=args.log)